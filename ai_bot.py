@@ -1,22 +1,32 @@
-import os, sys, re, time, requests, traceback, threading, hashlib, json, logging
-from flask import Flask, request, Response, stream_with_context, session, redirect, jsonify, Blueprint
+import os, sys, re, time, traceback, threading, hashlib, json, logging
+from functools import wraps
+from flask import Flask, request, Response, stream_with_context, session, redirect, jsonify, Blueprint, make_response, g
 from dotenv import load_dotenv
 from psycopg2.extras import RealDictCursor
 import psycopg2
 from cachetools import TTLCache
-from collections import defaultdict, deque
-from concurrent.futures import ThreadPoolExecutor
-from model import load_prompt_config
-from data.get_history import get_latest_history, get_long_term_context, get_full_history
-from data.import_data import insert_message, get_conn
+from model import load_model, start_config_updater
+from data.get_history import (
+    get_latest_history, get_long_term_context, get_full_history, get_embedding, request_embedding,
+    SESSION_VECTOR_INDEX, LEXICAL_INDEX, HIDDEN_SESSIONS,
+)
+from data.import_data import get_conn
+from data import write_behind
 from data.embed_messages import embedder
+from data.semantic_cache import SemanticCache, SEMANTIC_CACHE_ENABLED
+from data.short_term import ShortTermStore
+from data.knowledge_base import KnowledgeBase, KB_ENABLED, KB_TOP_K, KB_MIN_SCORE, KB_SHEETS, KB_COLUMNS
+from data.cache import response_cache_key, get_response_cache, save_response_cache, get_response_cache_stats
+from utils import http_client, tracing, metrics, request_scope
+from utils.singleflight import SingleFlight
+from utils.prompt_template import compile_template, RenderCache
 from datetime import datetime
 
 # ---------------- ENV ----------------
 load_dotenv()
 LOCAL_DB_URL = os.getenv("POSTGRES_URL")
-PROMPT_API_URL = "https://prompt.whoisme.ai/api/public/prompt/prompt_chatbot"
-WHOISME_API_URL = "https://api.whoisme.ai/api/archetype/code/{}"
+PROMPT_API_URL = os.getenv("PROMPT_API_URL", "https://prompt.whoisme.ai/api/public/prompt/prompt_chatbot")
+WHOISME_API_URL = os.getenv("WHOISME_API_URL", "https://api.whoisme.ai/api/archetype/code/{}")
 WHOISME_API_NO_LOGIN_PROMPT = "https://prompt.whoisme.ai/api/public/prompt/prompt_no_login"
 
 # ---------------- LOGGER ----------------
@@ -36,30 +46,110 @@ app.secret_key = os.getenv("FLASK_SECRET", "super-secret-key")
 whoisme_bp = Blueprint("whoisme", __name__)
 
 # ---------------- CACHE ----------------
-SHORT_TERM_CACHE = TTLCache(maxsize=5000, ttl=1800)
 LONG_TERM_CACHE = TTLCache(maxsize=5000, ttl=900)
-PROMPT_CACHE = {"systemPrompt": "", "userPromptFormat": "", "updatedAt": None, "timestamp": 0}
-PERSIONALITY_CACHE = {"data": {}, "updatedAt": None, "lock": threading.Lock()}
+PROMPT_CACHE = {"systemPrompt": "", "userPromptFormat": "", "updatedAt": None, "timestamp": 0, "retry_at": 0}
+# Cache prompt còn trống mà API lỗi: các request trong khoảng này không gọi API lại
+PROMPT_RETRY_INTERVAL = float(os.getenv("PROMPT_RETRY_INTERVAL", "10"))
 
-EXECUTOR = ThreadPoolExecutor(max_workers=8)
+# Lượt hội thoại được ghi DB theo micro-batch ở thread nền (data/write_behind.py)
+WRITE_BEHIND = write_behind.get_writer()
 
 # ---------------- RESPONSE CACHE ----------------
 class ResponseCache:
-    def __init__(self, ttl=120, max_hits=1):
-        self.cache = TTLCache(maxsize=5000, ttl=ttl)
-        self.hits = defaultdict(int)
+    """
+    Response cache dùng chung giữa các gunicorn worker qua Redis (data/cache.py),
+    key là hash nội dung ổn định (md5) thay vì hash() bị salt theo process.
+    Redis không truy cập được thì tạm dùng TTLCache giới hạn trong process.
+    """
+    def __init__(self, ttl=120, max_hits=1, maxsize=5000, retry_after=30, max_entry_chars=20000):
+        self.ttl = ttl
         self.max_hits = max_hits
-    def get(self, user_id, session_id, message):
-        key = f"{user_id}_{session_id or 'global'}_{hash(message)}"
-        if key in self.cache and self.hits[key] < self.max_hits:
-            self.hits[key] += 1
-            return self.cache[key]
+        self.retry_after = retry_after
+        self.max_entry_chars = max_entry_chars
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "redis_errors": 0}
+        self.redis_down_until = 0
+
+    def _key(self, user_id, session_id, message):
+        return response_cache_key(user_id, session_id or "global", message)
+
+    def _redis_available(self):
+        return time.time() >= self.redis_down_until
+
+    def _redis_failed(self, e):
+        logger.warning(f"[ResponseCache] Redis lỗi, dùng cache local {self.retry_after}s: {e}")
+        with self.lock:
+            self.counters["redis_errors"] += 1
+        self.redis_down_until = time.time() + self.retry_after
+
+    def _local_get(self, key):
+        with self.lock:
+            entry = self.local.get(key)
+            if entry and entry[1] < self.max_hits:
+                entry[1] += 1
+                return entry[0]
         return None
+
+    def get(self, user_id, session_id, message):
+        key = self._key(user_id, session_id, message)
+        value = None
+        if self._redis_available():
+            try:
+                value = get_response_cache(key, self.max_hits)
+            except Exception as e:
+                self._redis_failed(e)
+                value = self._local_get(key)
+        else:
+            value = self._local_get(key)
+        with self.lock:
+            self.counters["hits" if value else "misses"] += 1
+        return value
+
     def set(self, user_id, session_id, message, response):
-        key = f"{user_id}_{session_id or 'global'}_{hash(message)}"
-        self.cache[key] = response
-        self.hits[key] = 0
+        if not response or len(response) > self.max_entry_chars:
+            return
+        key = self._key(user_id, session_id, message)
+        if self._redis_available():
+            try:
+                save_response_cache(key, response, self.ttl)
+                return
+            except Exception as e:
+                self._redis_failed(e)
+        with self.lock:
+            self.local[key] = [response, 0]
+
+    def stats(self):
+        with self.lock:
+            local = dict(self.counters)
+        try:
+            shared = get_response_cache_stats() if self._redis_available() else None
+        except Exception:
+            shared = None
+        return {"worker": local, "shared": shared}
+
 RESPONSE_CACHE = ResponseCache(ttl=120, max_hits=1)
+SEMANTIC_CACHE = SemanticCache(get_embedding)
+
+def lookup_cached_response(user_id, session_id, message):
+    """Trả về (response, cache_type): khớp chính xác trước, sau đó semantic cache. Miss → (None, None)."""
+    with tracing.span("cache.lookup") as span:
+        cached = RESPONSE_CACHE.get(user_id, session_id, message)
+        metrics.cache_result("response", bool(cached))
+        if cached:
+            span.set_attribute("cache.type", "exact")
+            return cached, "exact"
+        if SEMANTIC_CACHE_ENABLED:
+            try:
+                answer, _ = SEMANTIC_CACHE.lookup(user_id, session_id, message)
+                metrics.cache_result("semantic", bool(answer))
+                if answer:
+                    span.set_attribute("cache.type", "semantic")
+                    return answer, "semantic"
+            except Exception as e:
+                logger.error(f"[SemanticCache lookup] {e}")
+        span.set_attribute("cache.type", "miss")
+        return None, None
 
 # ---------------- JWT ----------------
 try:
@@ -94,131 +184,180 @@ def to_serializable(obj):
         return f"<unserializable:{type(obj).__name__}>"
 
 # ---------------- PROMPT ----------------
+def parse_prompt_payload(body: dict) -> dict:
+    data = body.get("data",{})
+    return {
+        "systemPrompt": data.get("systemPrompt",""),
+        "userPromptFormat": data.get("userPromptFormat",""),
+        "updatedAt": data.get("updatedAt")
+    }
+
 def fetch_prompt_from_api():
     try:
-        resp = requests.get(PROMPT_API_URL, timeout=5)
-        data = resp.json().get("data",{})
-        return {
-            "systemPrompt": data.get("systemPrompt",""),
-            "userPromptFormat": data.get("userPromptFormat",""),
-            "updatedAt": data.get("updatedAt")
-        }
+        resp = http_client.get(PROMPT_API_URL, timeout=5)
+        return parse_prompt_payload(resp.json())
     except Exception as e:
         logger.error(f"[Prompt Fetch Error]: {e}")
         return PROMPT_CACHE
 
 def background_prompt_updater(interval=300):
+    preloaded = False
     while True:
         try:
             new_data = fetch_prompt_from_api()
-            if new_data.get("updatedAt") != PROMPT_CACHE.get("updatedAt"):
+            changed = new_data.get("updatedAt") != PROMPT_CACHE.get("updatedAt")
+            if changed:
                 PROMPT_CACHE.update(new_data)
                 PROMPT_CACHE["timestamp"] = time.time()
                 logger.info(f"[Prompt Updated] at {new_data.get('updatedAt')}")
+            # Lần đầu luôn render sẵn: request đầu tiên có thể đã nạp PROMPT_CACHE (get_cached_prompt)
+            # nên so sánh updatedAt không thấy thay đổi
+            if changed or not preloaded:
+                preload_rendered_prompts()
+                preloaded = bool(PROMPT_CACHE["systemPrompt"])
         except Exception as e:
             logger.error(f"[Prompt Updater Error]: {e}")
         time.sleep(interval)
-threading.Thread(target=background_prompt_updater, daemon=True).start()
+start_config_updater()
 
 def get_cached_prompt():
-    if PROMPT_CACHE["systemPrompt"]:
+    if PROMPT_CACHE["systemPrompt"] or time.monotonic() < PROMPT_CACHE["retry_at"]:
         return PROMPT_CACHE["systemPrompt"], PROMPT_CACHE["userPromptFormat"]
     data = fetch_prompt_from_api()
+    if data is PROMPT_CACHE:
+        PROMPT_CACHE["retry_at"] = time.monotonic() + PROMPT_RETRY_INTERVAL
     PROMPT_CACHE.update(data)
     PROMPT_CACHE["timestamp"] = time.time()
     return data.get("systemPrompt",""), data.get("userPromptFormat","User said: {{content}}")
 
 # ---------------- PERSONALITY ----------------
-def fetch_personality_source(archetype_code: str) -> dict:
-    if not archetype_code:
-        return {}
-    try:
-        resp = requests.get(WHOISME_API_URL.format(archetype_code), timeout=5)
+PERSONALITY_TTL = int(os.getenv("PERSONALITY_TTL", "600"))
+PERSONALITY_STALE_TTL = int(os.getenv("PERSONALITY_STALE_TTL", "86400"))
+
+def parse_personality_source(body: dict, archetype_code: str):
+    """Trả về (persionality, updatedAt) từ response của archetype API."""
+    data = body.get("data") or body
+    translation = data.get("translation") or {}
+    updated_at = data.get("updatedAt") or data.get("updated_at")
+    code = data.get("code") or archetype_code
+
+    mbti_match = re.match(r"[A-Z]+", code)
+    mbti_value = mbti_match.group(0) if mbti_match else ""
+
+    keys_map = {
+        "style": "style",
+        "tone": "tone",
+        "representativeSpirit": "representativeSpirit",
+        "archetypeName": "name",
+        "color": "color",
+        "slogan": "slogan",
+        "suggestedJobs": "suggestedJobs",
+        "strengths": "strengths",
+        "weaknesses": "weaknesses",
+        "note": "note",
+    }
+    persionality = {k: translation.get(v, "") for k, v in keys_map.items()}
+    persionality["mbti"] = mbti_value
+    return persionality, updated_at
+
+class PersonalityCache:
+    """
+    Cache personality theo từng archetype code.
+    - Còn trong TTL: trả ngay, không gọi mạng
+    - Quá TTL nhưng chưa quá stale_ttl: trả bản cũ, refresh nền (stale-while-revalidate)
+    - Miss: request đồng thời cho cùng code chỉ fetch một lần (single-flight)
+    """
+    def __init__(self, ttl=PERSONALITY_TTL, stale_ttl=PERSONALITY_STALE_TTL, maxsize=512):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = TTLCache(maxsize=maxsize, ttl=stale_ttl)
+        self.lock = threading.Lock()
+        self.flight = SingleFlight()
+
+    def peek(self, code):
+        """(data, fresh) hoặc (None, False) nếu chưa có."""
+        with self.lock:
+            entry = self.entries.get(code)
+        if not entry:
+            return None, False
+        return entry["data"], time.time() - entry["fetched_at"] < self.ttl
+
+    def version(self, code):
+        with self.lock:
+            entry = self.entries.get(code)
+        if not entry:
+            return None
+        return entry["updatedAt"] or entry["fetched_at"]
+
+    def codes(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def store(self, code, data, updated_at):
+        with self.lock:
+            self.entries[code] = {"data": data, "updatedAt": updated_at, "fetched_at": time.time()}
+        return data
+
+    def load(self, code):
+        resp = http_client.get(WHOISME_API_URL.format(code), timeout=5)
         resp.raise_for_status()
-        data = resp.json().get("data") or resp.json()
-        translation = data.get("translation") or {}
-        updated_at = data.get("updatedAt") or data.get("updated_at")
-        code = data.get("code") or archetype_code
-
-        mbti_match = re.match(r"[A-Z]+", code)
-        mbti_value = mbti_match.group(0) if mbti_match else ""
-
-        with PERSIONALITY_CACHE["lock"]:
-            if PERSIONALITY_CACHE.get("updatedAt") != updated_at:
-                keys_map = {
-                    "style": "style",
-                    "tone": "tone",
-                    "representativeSpirit": "representativeSpirit",
-                    "archetypeName": "name",
-                    "color": "color",
-                    "slogan": "slogan",
-                    "suggestedJobs": "suggestedJobs",
-                    "strengths": "strengths",
-                    "weaknesses": "weaknesses",
-                    "note": "note",
-                }
-                persionality = {k: translation.get(v, "") for k, v in keys_map.items()}
-                persionality["mbti"] = mbti_value
+        return self.store(code, *parse_personality_source(resp.json(), code))
+
+    def refresh_in_background(self, code):
+        if self.flight.in_flight(code):
+            return
+
+        def _refresh():
+            try:
+                self.flight.do(code, self.load, code)
+            except Exception as e:
+                logger.error(f"[PersonalityCache refresh] {code}: {e}")
+        threading.Thread(target=_refresh, daemon=True).start()
 
-                PERSIONALITY_CACHE["data"] = persionality
-                PERSIONALITY_CACHE["updatedAt"] = updated_at
-            else:
-                persionality = PERSIONALITY_CACHE["data"]
+    def get(self, code):
+        data, fresh = self.peek(code)
+        if data is not None:
+            if not fresh:
+                self.refresh_in_background(code)
+            return data
+        return self.flight.do(code, self.load, code)
 
-        return persionality
+PERSIONALITY_CACHE = PersonalityCache()
 
+def fetch_personality_source(archetype_code: str) -> dict:
+    if not archetype_code:
+        return {}
+    try:
+        with tracing.span("personality.load", **{"archetype.code": archetype_code}):
+            return PERSIONALITY_CACHE.get(archetype_code)
     except Exception as e:
         logger.error(f"[fetch_personality_source] {e}")
-        return PERSIONALITY_CACHE.get("data") or {}
+        return {}
     
 # ---------------- CONTEXT ----------------
 def _normalize_id(x):
     return str(x) if x is not None else "global"
 
-SHORT_TERM_LOCK = threading.Lock()
-SHORT_TERM_CACHE = {}
-CACHE_TTL = 30 * 60
-MAX_CACHE_LENGTH = 50
+def _load_short_term(user_id, session_id, n):
+    # get_latest_history trả về mới → cũ, store giữ cũ → mới
+    return list(reversed(get_latest_history(user_id, session_id, n) or []))
+
+# Các lượt gần nhất theo session (ring buffer + LRU, data/short_term.py)
+SHORT_TERM_STORE = ShortTermStore(_load_short_term)
 
 def get_short_term(
     user_id, session_id=None, limit=5,
     new_message=None, new_reply=None,
     force_refresh=False
 ):
-    user_id_s = _normalize_id(user_id)
-    sess_s = _normalize_id(session_id)
-    key = f"{user_id_s}_{sess_s}"
-    now = time.time()
-    with SHORT_TERM_LOCK:
-
-        cache = SHORT_TERM_CACHE.get(key)
-        if cache and (now - cache["timestamp"] > CACHE_TTL):
-            del SHORT_TERM_CACHE[key]
-            cache = None
-
-        if force_refresh or cache is None:
-            rows = get_latest_history(user_id_s, session_id, MAX_CACHE_LENGTH) or []
-            messages = deque(maxlen=MAX_CACHE_LENGTH)
-            for m in rows:
-                messages.append({
-                    "message": m.get("message", "") or "",
-                    "reply": m.get("reply", "") or "",
-                })
-            SHORT_TERM_CACHE[key] = {
-                "messages": messages,
-                "timestamp": now
-            }
-            cache = SHORT_TERM_CACHE[key]
+    """Trả về tối đa `limit` lượt gần nhất (cũ → mới); có new_message/new_reply thì ghi thêm lượt đó."""
+    with tracing.span("context.short_term", **{"context.append": new_message is not None}):
+        user_id_s = _normalize_id(user_id)
+        if force_refresh:
+            SHORT_TERM_STORE.invalidate(user_id_s, session_id)
         if new_message is not None and new_reply is not None:
-            cache["messages"].append({
-                "message": new_message,
-                "reply": new_reply
-            })
-            cache["timestamp"] = now
-        msgs = list(cache["messages"])
-        msgs = msgs[::-1]
-        msgs = msgs[-limit:]
-        return msgs
+            SHORT_TERM_STORE.append(user_id_s, session_id, new_message, new_reply)
+        return SHORT_TERM_STORE.get(user_id_s, session_id, limit)
 
 # def get_short_term(
 #     user_id, session_id=None, limit=5,
@@ -259,7 +398,8 @@ def get_long_term(user_id, query, session_id=None, top_k=5, max_chars=300):
         if cached:
             return cached["dicts"] 
 
-    rows = get_long_term_context(user_id_s, query, session_id, top_k=top_k) or []
+    with tracing.span("context.long_term", **{"context.top_k": top_k}):
+        rows = get_long_term_context(user_id_s, query, session_id, top_k=top_k) or []
     now_ts = datetime.utcnow().timestamp()
     results = []
 
@@ -270,10 +410,11 @@ def get_long_term(user_id, query, session_id=None, top_k=5, max_chars=300):
         score = r.get("score")
         dist  = r.get("distance")
 
-        if dist is not None:
-            similarity = 1 - dist
-        elif score is not None:
+        # Hybrid search (RRF) trả về score; dòng chỉ có vector thì dùng distance
+        if score is not None:
             similarity = score
+        elif dist is not None:
+            similarity = 1 - dist
         else:
             similarity = 0
 
@@ -301,44 +442,127 @@ def get_long_term(user_id, query, session_id=None, top_k=5, max_chars=300):
 def get_context_parallel(user_id, user_msg, session_id=None, short_limit=5, long_top_k=3, max_long_chars=300):
     short_msgs_local = []
     long_msgs_local = []
+    errors = []
 
     def short_fn():
         nonlocal short_msgs_local
-        short_msgs_local = get_short_term(user_id, session_id, limit=short_limit)
+        try:
+            short_msgs_local = get_short_term(user_id, session_id, limit=short_limit)
+        except Exception as e:
+            errors.append(("short_term", e))
 
     def long_fn():
         nonlocal long_msgs_local
     #     long_msgs_local = [c[:max_long_chars] for c in get_long_term(user_id, user_msg, session_id=session_id, top_k=long_top_k)]
-
-        long_msgs_local = [
-        (c["message"] + "\n" + c["reply"])[:max_long_chars] 
-        for c in get_long_term(user_id, user_msg, session_id=session_id, top_k=long_top_k)
-            ]
-
-    t1 = threading.Thread(target=short_fn)
-    t2 = threading.Thread(target=long_fn)
-    t1.start(); t2.start(); t1.join(); t2.join()
+        try:
+            long_msgs_local = [
+            (c["message"] + "\n" + c["reply"])[:max_long_chars] 
+            for c in get_long_term(user_id, user_msg, session_id=session_id, top_k=long_top_k)
+                ]
+        except Exception as e:
+            errors.append(("long_term", e))
+
+    with tracing.span("context.fetch") as span:
+        # Mỗi thread một bản sao context để span con gắn đúng vào request
+        t1 = threading.Thread(target=tracing.wrap_context(short_fn))
+        t2 = threading.Thread(target=tracing.wrap_context(long_fn))
+        t1.start(); t2.start(); t1.join(); t2.join()
+        # Lỗi (vd. db_pool.PoolTimeout khi pool hết chỗ) không làm hỏng request nhưng phải thấy được
+        for source, e in errors:
+            logger.error(f"[get_context_parallel] Lấy {source} lỗi, trả lời không có ngữ cảnh này: "
+                         f"{type(e).__name__}: {e}")
+            span.record_error(e)
+            span.set_attribute(f"context.{source}.failed", True)
     return short_msgs_local, long_msgs_local
 
+# ---------------- KNOWLEDGE BASE ----------------
+# Sheet kiến thức (data/embeddings/*.pkl) embed lại bằng embedder của request, index FAISS
+# trong process, tự nạp lại khi data_hash của sheet đổi (data/knowledge_base.py)
+KNOWLEDGE_BASE = KnowledgeBase(embedder.embed_batch_cached)
+if KB_ENABLED:
+    KNOWLEDGE_BASE.start()
+
+def get_knowledge(user_msg, top_k=KB_TOP_K, sheet_name=None, column_name=None, level=None):
+    """Các dòng knowledge base gần câu hỏi nhất, dạng text cho prompt."""
+    if not KB_ENABLED or not user_msg or not user_msg.strip():
+        return []
+    with tracing.span("context.knowledge", **{"knowledge.top_k": top_k}) as span:
+        # Câu hỏi thường đã được embed cho long-term trong request này
+        vec = request_embedding(user_msg)
+        if vec is None:
+            try:
+                vec = get_embedding(user_msg)
+            except Exception as e:
+                # Embedding lỗi (vd. sidecar đang back-off) → trả lời không kèm knowledge
+                logger.error(f"[get_knowledge] {e}")
+                span.record_error(e)
+                return []
+        hits = KNOWLEDGE_BASE.search(
+            vec, top_k, KB_MIN_SCORE,
+            sheet_name=sheet_name or KB_SHEETS or None,
+            column_name=column_name or KB_COLUMNS or None,
+            level=level,
+        )
+        span.set_attribute("knowledge.hits", len(hits))
+    lines = []
+    for h in hits:
+        source = f"{h['sheet_name']} / {h['column_name']}" + (f" / Mức {h['level']}" if h["level"] else "")
+        lines.append(f"- [{source}] {h['text']}")
+    return lines
+
 # ---------------- PROMPT INJECTION ----------------
+PRELOAD_ARCHETYPES = [c.strip() for c in os.getenv("PRELOAD_ARCHETYPES", "").split(",") if c.strip()]
+RENDERED_PROMPTS = RenderCache(maxsize=int(os.getenv("PROMPT_RENDER_CACHE_SIZE", "1024")))
+
+def _personality_values(personality: dict, extra: dict=None):
+    values = {f"%{k}%":v for k,v in (personality or {}).items()}
+    if isinstance(extra, dict):
+        values.update({f"%{k}%":v for k,v in extra.items()})
+    return values
+
 def inject_personality(system_prompt: str, personality: dict, userPromptFormat: dict=None):
-    mapping = {f"%{k}%":v for k,v in (personality or {}).items()}
-    if isinstance(userPromptFormat, dict):
-        mapping.update({f"%{k}%":v for k,v in userPromptFormat.items()})
-    for k,v in mapping.items(): 
-        system_prompt = system_prompt.replace(k,v or "")
-    return re.sub(r"%\w+%","",system_prompt)
-
-def build_structured_prompt(user_msg, short_msgs, long_context, archetype_code=None, max_long_lines=5):
+    return compile_template(system_prompt).render(_personality_values(personality, userPromptFormat))
+
+def render_system_prompt(system_prompt: str, personality: dict, archetype_code=None):
+    """System prompt đã inject personality, cache theo (phiên bản prompt, archetype, phiên bản personality)."""
+    prompt_version = PROMPT_CACHE.get("updatedAt")
+    if not archetype_code or not personality or not prompt_version or system_prompt != PROMPT_CACHE["systemPrompt"]:
+        return inject_personality(system_prompt, personality)
+    key = (prompt_version, archetype_code, PERSIONALITY_CACHE.version(archetype_code))
+    return RENDERED_PROMPTS.get_or_render(key, lambda: inject_personality(system_prompt, personality))
+
+def preload_rendered_prompts(codes=None):
+    """Render sẵn system prompt cho các archetype đã biết (PRELOAD_ARCHETYPES + đang có trong cache)."""
+    system_prompt = PROMPT_CACHE["systemPrompt"]
+    if not system_prompt:
+        return
+    for code in dict.fromkeys(list(codes or []) + PRELOAD_ARCHETYPES + PERSIONALITY_CACHE.codes()):
+        try:
+            render_system_prompt(system_prompt, PERSIONALITY_CACHE.get(code), archetype_code=code)
+        except Exception as e:
+            logger.error(f"[preload_rendered_prompts] {code}: {e}")
+
+def build_structured_prompt(user_msg, short_msgs, long_context, archetype_code=None, max_long_lines=5, personality=None,
+                            knowledge=None):
+    if personality is None:
+        personality = fetch_personality_source(archetype_code) if archetype_code else {}
+    if knowledge is None:
+        knowledge = get_knowledge(user_msg)
+    with tracing.span("prompt.build"):
+        return _build_structured_prompt(user_msg, short_msgs, long_context, archetype_code, max_long_lines, personality,
+                                        knowledge)
+
+def _build_structured_prompt(user_msg, short_msgs, long_context, archetype_code, max_long_lines, personality, knowledge):
     system_prompt, user_prompt_format = get_cached_prompt()
-    personality = fetch_personality_source(archetype_code) if archetype_code else {}
-    final_system_prompt = inject_personality(system_prompt, personality)
+    final_system_prompt = render_system_prompt(system_prompt, personality, archetype_code)
     messages = [{"role":"system","content":final_system_prompt}]
     for m in short_msgs:
         if m.get("message"): messages.append({"role":"user","content":m.get("message")})
         if m.get("reply"): messages.append({"role":"assistant","content":m.get("reply")})
     if long_context:
         messages.append({"role":"system","content":"LONG-TERM CONTEXT:\n"+ "\n".join(long_context[:max_long_lines])})
+    if knowledge:
+        messages.append({"role":"system","content":"KNOWLEDGE BASE:\n" + "\n".join(knowledge)})
     fmt = user_prompt_format
     if not isinstance(fmt, str) or not fmt.strip():
         fmt = "User's question: {{content}}"
@@ -348,15 +572,222 @@ def build_structured_prompt(user_msg, short_msgs, long_context, archetype_code=N
     messages.append({"role":"user","content":formatted_user_msg})
     return messages
 
+def build_chat_messages(user_msg, short_msgs, long_ctx, personality, max_long_lines=5, archetype_code=None):
+    """Prompt cho /v1/chat: trả về (messages, final_system_prompt, formatted_user_msg)."""
+    with tracing.span("prompt.build"):
+        return _build_chat_messages(user_msg, short_msgs, long_ctx, personality, max_long_lines, archetype_code)
+
+def _build_chat_messages(user_msg, short_msgs, long_ctx, personality, max_long_lines, archetype_code):
+    system_prompt, user_prompt_format = get_cached_prompt()
+    final_system_prompt = render_system_prompt(system_prompt, personality, archetype_code)
+
+    messages = [{"role": "system", "content": final_system_prompt}]
+    for m in short_msgs:
+        if m.get("message"):
+            messages.append({"role": "user", "content": m.get("message")})
+        if m.get("reply"):
+            messages.append({"role": "assistant", "content": m.get("reply")})
+    if long_ctx:
+        messages.append({"role": "system", "content": "LONG-TERM CONTEXT:\n" + "\n".join(long_ctx[:max_long_lines])})
+    fmt = user_prompt_format or "User: {{content}}"
+    values = _personality_values(personality)
+    values["{{content}}"] = user_msg
+    formatted_user_msg = compile_template(fmt).render(values)
+    messages.append({"role": "user", "content": formatted_user_msg})
+    return messages, final_system_prompt, formatted_user_msg
+
 # ---------------- ASYNC DB ----------------
-def async_embed_message(user_id, message, reply, session_id=None, time_spent=None):
-    EXECUTOR.submit(insert_message, user_id, message, reply, session_id, time_spent)
+def async_embed_message(user_id, message, reply, session_id=None, time_spent=None, vector=None):
+    WRITE_BEHIND.submit(user_id, message, reply, session_id=session_id, time_spent=time_spent, vector=vector)
+
+def record_turn(user_id, session_id, user_msg, reply, time_spent=None, short_limit=10):
+    """Ghi lượt hội thoại vừa xong vào short-term cache, DB (bất đồng bộ) và response cache."""
+    with tracing.span("persist"):
+        _record_turn(user_id, session_id, user_msg, reply, time_spent, short_limit)
+
+def _record_turn(user_id, session_id, user_msg, reply, time_spent, short_limit):
+    try:
+        get_short_term(user_id, session_id, limit=short_limit, new_message=user_msg, new_reply=reply)
+    except Exception:
+        pass
+    # Vector của câu hỏi đã tính lúc truy xuất long-term trong request này → không encode lại
+    vector = request_embedding(user_msg)
+    async_embed_message(user_id, user_msg, reply, session_id=session_id, time_spent=time_spent, vector=vector)
+    if session_id:
+        SESSION_VECTOR_INDEX.append(_normalize_id(user_id), session_id, user_msg, reply, vector)
+        LEXICAL_INDEX.append(_normalize_id(user_id), session_id, user_msg, reply)
+    RESPONSE_CACHE.set(user_id, session_id, user_msg, reply)
+    if SEMANTIC_CACHE_ENABLED:
+        try:
+            SEMANTIC_CACHE.add(user_id, session_id, user_msg, reply)
+        except Exception as e:
+            logger.error(f"[SemanticCache add] {e}")
+
+# ---------------- REQUEST HELPERS ----------------
+def authenticate_bearer(auth_header: str):
+    """Trả về (user_info, error). Dùng chung cho Flask và ASGI handler."""
+    if not auth_header.startswith("Bearer "):
+        return None, "Missing or invalid Authorization header"
+    token = auth_header.split(" ")[1]
+    with tracing.span("auth"):
+        user_info = verify_whoisme_token(token)
+    if not user_info:
+        return None, "Invalid WhoIsMe token"
+    return user_info, None
+
+def parse_chat_payload(payload: dict):
+    user_msg = (payload.get("message") or "").strip()
+    session_id = payload.get("session_id")
+    code_raw = payload.get("code")
+    archetype_code = code_raw.strip() if isinstance(code_raw, str) and code_raw.strip() else None
+    return user_msg, session_id, archetype_code
+
+# ---------------- STREAMING ----------------
+STREAM_MIMETYPES = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def resolve_stream_format(payload: dict, accept_header: str = ""):
+    """Chế độ stream (opt-in): payload "stream": "sse"/"ndjson"/true hoặc header Accept. None = JSON buffered."""
+    mode = payload.get("stream")
+    if isinstance(mode, str) and mode.lower() in STREAM_MIMETYPES:
+        return mode.lower()
+    accept = accept_header or ""
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    if mode is True:
+        return "sse"
+    return None
+
+def format_stream_event(fmt: str, event: str, data: dict) -> str:
+    data = to_serializable(data)
+    if fmt == "sse":
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"type": event, **data}, ensure_ascii=False) + "\n"
+
+def iter_llm_content(llm, messages, parent=None, model_key=None):
+    """
+    Các đoạn text từ llm.stream, kèm span llm.completion / llm.first_token và metrics TTFT, tokens/sec.
+    model_key: key của model trong model.models (load_model), label của metrics.
+    """
+    model_key = model_key or metrics.model_label(llm)
+    completion = tracing.start_span("llm.completion", parent=parent, **{"llm.model": model_key})
+    first = tracing.start_span("llm.first_token", parent=completion)
+    start = time.perf_counter()
+    ttft = None
+    chunks = 0
+    error = False
+    try:
+        for chunk in llm.stream(messages):
+            content = getattr(chunk, "content", "")
+            if content:
+                if not chunks:
+                    ttft = time.perf_counter() - start
+                    first.end()
+                chunks += 1
+                yield content
+    except Exception as e:
+        error = True
+        completion.record_error(e)
+        raise
+    finally:
+        # Model không trả nội dung nào / lỗi trước chunk đầu: vẫn đóng span first_token
+        first.end()
+        metrics.observe_llm(model_key, ttft, time.perf_counter() - start, chunks, error=error)
+        completion.set_attribute("llm.chunks", chunks)
+        completion.end()
+
+def stream_llm_events(llm, messages, fmt, finalize, parent=None, model_key=None):
+    """
+    Đẩy từng token delta ngay khi model trả về; event cuối "done" là trailer do finalize() dựng.
+    Generator chạy sau khi view đã return nên span cha của request được truyền qua `parent`.
+    """
+    start = time.perf_counter()
+    first_token = None
+    buffer = ""
+    with tracing.use_span(parent):
+        try:
+            for content in iter_llm_content(llm, messages, model_key=model_key):
+                if first_token is None:
+                    first_token = round(time.perf_counter() - start, 3)
+                buffer += content
+                yield format_stream_event(fmt, "delta", {"content": content})
+        except Exception as e:
+            logger.error(f"[MODEL ERROR] {e}")
+            yield format_stream_event(fmt, "error", {"error": f"Lỗi khi gọi model: {e}"})
+            return
+        model_elapsed = round(time.perf_counter() - start, 3)
+        yield format_stream_event(fmt, "done", finalize(buffer, model_elapsed, first_token))
+
+def cached_stream_events(fmt, content, trailer):
+    yield format_stream_event(fmt, "delta", {"content": content})
+    yield format_stream_event(fmt, "done", trailer)
+
+def stream_response(fmt, events):
+    return Response(stream_with_context(events), mimetype=STREAM_MIMETYPES[fmt], headers=STREAM_HEADERS)
+
+# ---------------- METRICS / TRACING ----------------
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(resp):
+    start = g.get("request_start")
+    if start is None:
+        return resp
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+
+    def observe():
+        metrics.observe_request(endpoint, method, resp.status_code, time.perf_counter() - start)
+    # Response stream: đo tới khi stream đóng, không phải lúc view return
+    if resp.is_streamed:
+        resp.call_on_close(observe)
+    else:
+        observe()
+    return resp
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, mimetype=content_type)
+
+def traced_route(fn):
+    """
+    Root span cho mỗi request, request id lấy từ header X-Request-ID (hoặc sinh mới) và trả lại trong response.
+    Response dạng stream thì root span kết thúc khi stream đóng.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        request_scope.begin()
+        root = tracing.start_trace(
+            f"{request.method} {request.path}", request.headers.get("X-Request-ID"),
+            **{"http.method": request.method, "http.route": request.path},
+        )
+        try:
+            with tracing.use_span(root):
+                resp = make_response(fn(*args, **kwargs))
+        except Exception as e:
+            root.record_error(e)
+            root.end()
+            raise
+        resp.headers["X-Request-ID"] = root.request_id
+        root.set_attribute("http.status_code", resp.status_code)
+        if resp.is_streamed:
+            resp.call_on_close(root.end)
+        else:
+            root.end()
+        return resp
+    return wrapper
 
 # ---------------- BLUEPRINT ----------------
 whoisme_bp = Blueprint("whoisme", __name__)
 
 # ---------------- CHAT ----------------
 @app.route("/chat", methods=["POST"])
+@traced_route
 def chat():
     if not session.get("user"):
         return Response("Bạn chưa đăng nhập", status=401)
@@ -368,7 +799,7 @@ def chat():
     session_id = data.get("session_id")
     archetype_code = data.get("code")  
 
-    cached_resp = RESPONSE_CACHE.get(user_id, session_id, user_msg)
+    cached_resp, cache_type = lookup_cached_response(user_id, session_id, user_msg)
     if cached_resp:
         return jsonify({
             "user_id": user_id,
@@ -379,58 +810,45 @@ def chat():
             ]
         })
 
-    llm = load_prompt_config()
+    model_key, llm = load_model()
     if not llm:
         return Response("Model không hợp lệ", status=400)
     
     short_msgs = get_short_term(user_id, session_id, limit=5)
     long_ctx = get_long_term(user_id, user_msg, session_id=session_id, top_k=5)
     messages = build_structured_prompt(user_msg, short_msgs, long_ctx, archetype_code=archetype_code)
+    parent = tracing.current_span()
 
     @stream_with_context
     def generate():
         buf = ""
         start = time.perf_counter()
-        try:
-            for chunk in llm.stream(messages):
-                content = getattr(chunk, "content", "")
-                if content:
+        with tracing.use_span(parent):
+            try:
+                for content in iter_llm_content(llm, messages, model_key=model_key):
                     buf += content
                     yield content
-            elapsed = round(time.perf_counter() - start, 3)
-            try:
-                get_short_term(user_id, session_id, limit=10, new_message=user_msg, new_reply=buf)
-            except Exception:
-                pass
-            async_embed_message(user_id, user_msg, buf, session_id=session_id, time_spent=elapsed)
-            RESPONSE_CACHE.set(user_id, session_id, user_msg, buf)
-        except Exception as e:
-            yield f"\n[ERROR]: {e}"
+                elapsed = round(time.perf_counter() - start, 3)
+                record_turn(user_id, session_id, user_msg, buf, time_spent=elapsed)
+            except Exception as e:
+                yield f"\n[ERROR]: {e}"
 
     return Response(generate(), mimetype="text/plain")
 
 # ---------------- WHOISME /v1/chat ----------------
 @whoisme_bp.route("/v1/chatbot", methods=["POST"])
+@traced_route
 def whoisme_chat_parallel():
     t0 = time.perf_counter()
 
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return jsonify({"error": "Missing or invalid Authorization header"}), 401
-
-    token = auth_header.split(" ")[1]
-    user_info = verify_whoisme_token(token)
+    user_info, auth_error = authenticate_bearer(request.headers.get("Authorization", ""))
     if not user_info:
-        return jsonify({"error": "Invalid WhoIsMe token"}), 401
+        return jsonify({"error": auth_error}), 401
 
     user_id = user_info["userId"]
     payload = request.get_json(force=True, silent=True) or {}
-
-    user_msg = (payload.get("message") or "").strip()
-    session_id = payload.get("session_id")
-
-    code_raw = payload.get("code")
-    archetype_code = code_raw.strip() if isinstance(code_raw, str) and code_raw.strip() else None
+    user_msg, session_id, archetype_code = parse_chat_payload(payload)
+    stream_fmt = resolve_stream_format(payload, request.headers.get("Accept", ""))
 
     if not user_msg:
         return jsonify({"error": "Message không được để trống"}), 400
@@ -439,68 +857,88 @@ def whoisme_chat_parallel():
     auth_elapsed = round(t1 - t0, 3)
 
     cache_start = time.perf_counter()
-    cached_resp = RESPONSE_CACHE.get(user_id, session_id, user_msg)
+    cached_resp, cache_type = lookup_cached_response(user_id, session_id, user_msg)
     cache_elapsed = round(time.perf_counter() - cache_start, 3)
 
     if cached_resp:
         total_elapsed = round(time.perf_counter() - t0, 3)
-        return jsonify({
+        cached_payload = {
             "user_id": user_id,
             "session_id": session_id,
             "model": "cache",
+            "cache_type": cache_type,
             "archetype_code": archetype_code,
             "elapsed": {
                 "total": total_elapsed,
                 "auth": auth_elapsed,
                 "cache": cache_elapsed,
                 "cached": True
-            },
-            "message": [
-                {"role": "user", "content": user_msg},
-                {"role": "assistant", "content": cached_resp}
-            ]
-        })
+            }
+        }
+        if stream_fmt:
+            return stream_response(stream_fmt, cached_stream_events(stream_fmt, cached_resp, cached_payload))
+        cached_payload["message"] = [
+            {"role": "user", "content": user_msg},
+            {"role": "assistant", "content": cached_resp}
+        ]
+        return jsonify(cached_payload)
 
     prompt_start = time.perf_counter()
-    llm = load_prompt_config()
+    model_key, llm = load_model()
     if not llm:
         return jsonify({"error": "Model không hợp lệ"}), 400
     model_name = getattr(llm, "model", None) or getattr(llm, "model_name", "Unknown")
     prompt_elapsed = round(time.perf_counter() - prompt_start, 3)
-    print(f"[MODEL USED] {model_name}", flush=True)
+    tracing.current_span().set_attribute("llm.model.name", model_name)
 
     prepare_start = time.perf_counter()
     short_msgs, long_ctx = get_context_parallel(user_id, user_msg, session_id, short_limit=5, long_top_k=5)
     messages = build_structured_prompt(user_msg, short_msgs, long_ctx, archetype_code=archetype_code)
     prepare_elapsed = round(time.perf_counter() - prepare_start, 3)
 
+    if stream_fmt:
+        def finalize(buffer, model_elapsed, first_token):
+            update_start = time.perf_counter()
+            record_turn(user_id, session_id, user_msg, buffer, time_spent=model_elapsed)
+            update_elapsed = round(time.perf_counter() - update_start, 3)
+            return {
+                "user_id": user_id,
+                "session_id": session_id,
+                "model": model_name,
+                "archetype_code": archetype_code,
+                "elapsed": {
+                    "total": round(time.perf_counter() - t0, 3),
+                    "auth": auth_elapsed,
+                    "cache": cache_elapsed,
+                    "prompt": prompt_elapsed,
+                    "prepare": prepare_elapsed,
+                    "first_token": first_token,
+                    "model": model_elapsed,
+                    "update": update_elapsed,
+                    "cached": False
+                }
+            }
+        return stream_response(stream_fmt, stream_llm_events(llm, messages, stream_fmt, finalize, parent=tracing.current_span(), model_key=model_key))
+
     model_start = time.perf_counter()
     buffer = ""
     try:
-        for chunk in llm.stream(messages):
-            content = getattr(chunk, "content", "")
-            if content:
-                buffer += content
+        for content in iter_llm_content(llm, messages, model_key=model_key):
+            buffer += content
     except Exception as e:
-        print(f"[MODEL ERROR] {e}", flush=True)
+        logger.error(f"[MODEL ERROR] {e}")
         return jsonify({"error": f"Lỗi khi gọi model: {e}"}), 500
     model_elapsed = round(time.perf_counter() - model_start, 3)
 
     update_start = time.perf_counter()
-    try:
-        get_short_term(user_id, session_id, limit=10, new_message=user_msg, new_reply=buffer)
-    except Exception:
-        pass
-    async_embed_message(user_id, user_msg, buffer, session_id=session_id, time_spent=model_elapsed)
-    RESPONSE_CACHE.set(user_id, session_id, user_msg, buffer)
+    record_turn(user_id, session_id, user_msg, buffer, time_spent=model_elapsed)
     update_elapsed = round(time.perf_counter() - update_start, 3)
 
     total_elapsed = round(time.perf_counter() - t0, 3)
-    print(
+    logger.debug(
         f"[PROFILE] model={model_name} | total={total_elapsed}s | "
         f"auth={auth_elapsed}s | cache={cache_elapsed}s | prompt={prompt_elapsed}s | "
-        f"prepare={prepare_elapsed}s | model={model_elapsed}s | update={update_elapsed}s",
-        flush=True
+        f"prepare={prepare_elapsed}s | model={model_elapsed}s | update={update_elapsed}s"
     )
 
     payload_out = {
@@ -527,87 +965,82 @@ def whoisme_chat_parallel():
 
 #=========v2=================
 @whoisme_bp.route("/v1/chat", methods=["POST"])
+@traced_route
 def whoisme_chat_parallell():
     t0 = time.perf_counter()
 
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return jsonify({"error": "Missing or invalid Authorization header"}), 401
-    token = auth_header.split(" ")[1]
-    user_info = verify_whoisme_token(token)
+    user_info, auth_error = authenticate_bearer(request.headers.get("Authorization", ""))
     if not user_info:
-        return jsonify({"error": "Invalid WhoIsMe token"}), 401
+        return jsonify({"error": auth_error}), 401
 
     user_id = user_info["userId"]
     payload = request.get_json(force=True, silent=True) or {}
-    user_msg = (payload.get("message") or "").strip()
-    session_id = payload.get("session_id")
-    code_raw = payload.get("code")
-    archetype_code = code_raw.strip() if isinstance(code_raw, str) and code_raw.strip() else None
+    user_msg, session_id, archetype_code = parse_chat_payload(payload)
+    stream_fmt = resolve_stream_format(payload, request.headers.get("Accept", ""))
 
     if not user_msg:
         return jsonify({"error": "Message không được để trống"}), 400
 
-    cached_resp = RESPONSE_CACHE.get(user_id, session_id, user_msg)
+    cached_resp, cache_type = lookup_cached_response(user_id, session_id, user_msg)
     if cached_resp:
         total_elapsed = round(time.perf_counter() - t0, 3)
-        return jsonify({
+        cached_payload = {
             "user_id": user_id,
             "session_id": session_id,
             "model": "cache",
+            "cache_type": cache_type,
             "archetype_code": archetype_code,
             "elapsed": {
                 "total": total_elapsed,
                 "cached": True
             },
-            "system_prompt": None,
-            "message": [
-                {"role": "user", "content": user_msg},
-                {"role": "assistant", "content": cached_resp}
-            ]
-        })
+            "system_prompt": None
+        }
+        if stream_fmt:
+            return stream_response(stream_fmt, cached_stream_events(stream_fmt, cached_resp, cached_payload))
+        cached_payload["message"] = [
+            {"role": "user", "content": user_msg},
+            {"role": "assistant", "content": cached_resp}
+        ]
+        return jsonify(cached_payload)
 
-    llm = load_prompt_config()
+    model_key, llm = load_model()
     if not llm:
         return jsonify({"error": "Model không hợp lệ"}), 400
     model_name = getattr(llm, "model", None) or getattr(llm, "model_name", "Unknown")
 
     short_msgs, long_ctx = get_context_parallel(user_id, user_msg, session_id, short_limit=5, long_top_k=3)
 
-    system_prompt, user_prompt_format = get_cached_prompt()
     personality = fetch_personality_source(archetype_code) if archetype_code else {}
-    final_system_prompt = inject_personality(system_prompt, personality)
-
-    messages = [{"role": "system", "content": final_system_prompt}]
-    for m in short_msgs:
-        if m.get("message"):
-            messages.append({"role": "user", "content": m.get("message")})
-        if m.get("reply"):
-            messages.append({"role": "assistant", "content": m.get("reply")})
-    if long_ctx:
-        messages.append({"role": "system", "content": "LONG-TERM CONTEXT:\n" + "\n".join(long_ctx[:5])})
-    fmt = user_prompt_format or "User: {{content}}"
-    fmt = inject_personality(fmt, personality)  
-    formatted_user_msg = fmt.replace("{{content}}", user_msg)
-    messages.append({"role": "user", "content": formatted_user_msg})
+    messages, final_system_prompt, formatted_user_msg = build_chat_messages(user_msg, short_msgs, long_ctx, personality, archetype_code=archetype_code)
+
+    if stream_fmt:
+        def finalize(buffer, model_elapsed, first_token):
+            record_turn(user_id, session_id, user_msg, buffer, time_spent=model_elapsed, short_limit=5)
+            return {
+                "user_id": user_id,
+                "session_id": session_id,
+                "model": model_name,
+                "archetype_code": archetype_code,
+                "cached": False,
+                "elapsed": {
+                    "total": round(time.perf_counter() - t0, 3),
+                    "first_token": first_token,
+                    "model": model_elapsed
+                }
+            }
+        return stream_response(stream_fmt, stream_llm_events(llm, messages, stream_fmt, finalize, parent=tracing.current_span(), model_key=model_key))
 
     buffer = ""
     model_start = time.perf_counter()
     try:
-        for chunk in llm.stream(messages):
-            content = getattr(chunk, "content", "")
-            if content:
-                buffer += content
+        for content in iter_llm_content(llm, messages, model_key=model_key):
+            buffer += content
     except Exception as e:
         return jsonify({"error": f"Lỗi khi gọi model: {e}"}), 500
     model_elapsed = round(time.perf_counter() - model_start, 3)
 
-    try:
-        get_short_term(user_id, session_id, limit=5, new_message=user_msg, new_reply=buffer)
-    except Exception:
-        pass
-    async_embed_message(user_id, user_msg, buffer, session_id=session_id, time_spent=model_elapsed)
-    RESPONSE_CACHE.set(user_id, session_id, user_msg, buffer)
+    record_turn(user_id, session_id, user_msg, buffer, time_spent=model_elapsed, short_limit=5)
 
     total_elapsed = round(time.perf_counter() - t0, 3)
     payload_out = {
@@ -657,6 +1090,12 @@ def whoisme_hidden_history():
                 WHERE user_id = %s AND session_id = %s;
             """, (str(user_id), str(session_id)))
             conn.commit()
+        SEMANTIC_CACHE.invalidate(user_id, session_id)
+        SHORT_TERM_STORE.invalidate(_normalize_id(user_id), session_id)
+        SESSION_VECTOR_INDEX.invalidate(_normalize_id(user_id), session_id)
+        LEXICAL_INDEX.invalidate(_normalize_id(user_id), session_id)
+        # Worker khác bỏ bản trong process ở lần tìm kiếm tiếp theo
+        HIDDEN_SESSIONS.publish(_normalize_id(user_id), session_id)
         return jsonify({
             "session_id": session_id, 
             "user_id": user_id
@@ -772,6 +1211,9 @@ def whoisme_sessions():
 
 app.register_blueprint(whoisme_bp)
 
+# Khởi động sau khi mọi hàm đã được định nghĩa (background_prompt_updater gọi preload_rendered_prompts)
+threading.Thread(target=background_prompt_updater, daemon=True, name="prompt-updater").start()
+
 # ------------------------------------------------------------
 # -------------------------- MAIN -----------------------------
 # ------------------------------------------------------------
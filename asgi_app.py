@@ -0,0 +1,493 @@
+"""
+ASGI entrypoint - chế độ phục vụ asyncio cho /v1/chatbot và /v1/chat.
+
+Hai endpoint chat chạy trực tiếp trên event loop: LLM stream bằng `astream`,
+truy vấn PostgreSQL trên executor riêng, HTTP ra ngoài qua httpx.AsyncClient dùng chung (utils.http_client). Một worker
+giữ được hàng trăm stream LLM cùng lúc thay vì 1 request/worker như sync.
+Mọi route còn lại (/chat, /v1/history, /v1/hidden, ...) được chuyển về Flask app.
+
+Chạy:
+    SERVING_MODE=asgi gunicorn --config gunicorn.conf.py asgi_app:app
+"""
+import os, json, time, asyncio, functools, logging, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+
+from ai_bot import (
+    app as flask_app,
+    PROMPT_CACHE, PROMPT_RETRY_INTERVAL, PERSIONALITY_CACHE, PROMPT_API_URL, WHOISME_API_URL,
+    STREAM_MIMETYPES, STREAM_HEADERS,
+    authenticate_bearer, parse_chat_payload, lookup_cached_response, parse_prompt_payload, parse_personality_source,
+    get_context_parallel, get_knowledge, build_structured_prompt, build_chat_messages, record_turn, to_serializable,
+    resolve_stream_format, format_stream_event, cached_stream_events,
+)
+from model import CONFIG_CACHE, load_model, upstream_hosts
+from utils import http_client, tracing, metrics, request_scope
+from data import write_behind, db_pool
+
+logger = logging.getLogger(__name__)
+
+# Mỗi get_context_parallel giữ tới 2 kết nối (short-term + long-term song song): mặc định số thread
+# vừa đủ để executor không đòi nhiều kết nối hơn DB_POOL_MAX
+ASYNC_DB_THREADS = int(os.getenv("ASYNC_DB_THREADS", str(max(1, db_pool.DB_POOL_MAX // 2))))
+FLASK_THREADS = int(os.getenv("ASGI_FLASK_THREADS", "16"))
+if ASYNC_DB_THREADS * 2 > db_pool.DB_POOL_MAX:
+    logger.warning(f"[asgi] ASYNC_DB_THREADS={ASYNC_DB_THREADS} có thể cần {ASYNC_DB_THREADS * 2} kết nối, "
+                   f"DB_POOL_MAX={db_pool.DB_POOL_MAX}: request sẽ chờ pool (PoolTimeout sau {db_pool.DB_POOL_TIMEOUT}s)")
+
+# psycopg2 không có API async: truy vấn DB chạy trên executor riêng để không chặn event loop
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_DB_THREADS, thread_name_prefix="async-db")
+metrics.watch_executor("async_db", DB_EXECUTOR)
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # run_in_executor không mang theo contextvars → copy để span trên thread DB gắn đúng request
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(ctx.run, fn, *args, **kwargs))
+
+# ---------------- OUTBOUND HTTP ----------------
+async def aensure_prompt():
+    if PROMPT_CACHE["systemPrompt"] or time.monotonic() < PROMPT_CACHE["retry_at"]:
+        return
+    try:
+        resp = await http_client.get_async_client().get(PROMPT_API_URL, timeout=5)
+        PROMPT_CACHE.update(parse_prompt_payload(resp.json()))
+        PROMPT_CACHE["timestamp"] = time.time()
+    except Exception as e:
+        PROMPT_CACHE["retry_at"] = time.monotonic() + PROMPT_RETRY_INTERVAL
+        logger.error(f"[aensure_prompt] {e}")
+
+async def aload_model():
+    """load_model() không chặn event loop: cache config còn trống (cold start / API config lỗi) thì tải trên thread."""
+    if CONFIG_CACHE["config"] is None:
+        return await asyncio.to_thread(load_model)
+    return load_model()
+
+async def abuild_prompt(build_fn, *args, **kwargs):
+    """build_structured_prompt / build_chat_messages: cache prompt còn trống thì get_cached_prompt gọi API đồng bộ → chạy trên thread."""
+    if not PROMPT_CACHE["systemPrompt"]:
+        return await asyncio.to_thread(build_fn, *args, **kwargs)
+    return build_fn(*args, **kwargs)
+
+PERSONALITY_INFLIGHT = {}
+
+async def _aload_personality(archetype_code: str) -> dict:
+    resp = await http_client.get_async_client().get(WHOISME_API_URL.format(archetype_code), timeout=5)
+    resp.raise_for_status()
+    return PERSIONALITY_CACHE.store(archetype_code, *parse_personality_source(resp.json(), archetype_code))
+
+async def afetch_personality_source(archetype_code: str) -> dict:
+    """Bản async của fetch_personality_source: dùng chung PERSIONALITY_CACHE, single-flight bằng Future."""
+    if not archetype_code:
+        return {}
+    data, fresh = PERSIONALITY_CACHE.peek(archetype_code)
+    if data is not None:
+        if not fresh:
+            PERSIONALITY_CACHE.refresh_in_background(archetype_code)
+        return data
+
+    task = PERSONALITY_INFLIGHT.get(archetype_code)
+    if task is None:
+        task = asyncio.ensure_future(_aload_personality(archetype_code))
+        PERSONALITY_INFLIGHT[archetype_code] = task
+        task.add_done_callback(lambda _: PERSONALITY_INFLIGHT.pop(archetype_code, None))
+    try:
+        with tracing.span("personality.load", **{"archetype.code": archetype_code}):
+            return await asyncio.shield(task)
+    except Exception as e:
+        logger.error(f"[afetch_personality_source] {e}")
+        return {}
+
+# ---------------- ASGI HELPERS ----------------
+def get_header(scope, name: str) -> str:
+    name = name.lower().encode("latin-1")
+    for k, v in scope.get("headers", []):
+        if k.lower() == name:
+            return v.decode("latin-1")
+    return ""
+
+async def read_json(receive) -> dict:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+async def send_json(send, payload, status=200):
+    body = json.dumps(to_serializable(payload)).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def send_stream(send, fmt, events):
+    headers = [(b"content-type", STREAM_MIMETYPES[fmt].encode("latin-1"))]
+    headers += [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in STREAM_HEADERS.items()]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    async for event in events:
+        await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def aiter_events(events):
+    for event in events:
+        yield event
+
+async def aiter_llm_content(llm, messages, model_key=None):
+    """Bản async của ai_bot.iter_llm_content."""
+    model_key = model_key or metrics.model_label(llm)
+    completion = tracing.start_span("llm.completion", **{"llm.model": model_key})
+    first = tracing.start_span("llm.first_token", parent=completion)
+    start = time.perf_counter()
+    ttft = None
+    chunks = 0
+    error = False
+    try:
+        async for chunk in llm.astream(messages):
+            content = getattr(chunk, "content", "")
+            if content:
+                if not chunks:
+                    ttft = time.perf_counter() - start
+                    first.end()
+                chunks += 1
+                yield content
+    except Exception as e:
+        error = True
+        completion.record_error(e)
+        raise
+    finally:
+        # Model không trả nội dung nào / lỗi trước chunk đầu: vẫn đóng span first_token
+        first.end()
+        metrics.observe_llm(model_key, ttft, time.perf_counter() - start, chunks, error=error)
+        completion.set_attribute("llm.chunks", chunks)
+        completion.end()
+
+async def astream_llm_events(llm, messages, fmt, finalize, model_key=None):
+    """Bản async của ai_bot.stream_llm_events; finalize là coroutine trả về trailer."""
+    start = time.perf_counter()
+    first_token = None
+    buffer = ""
+    try:
+        async for content in aiter_llm_content(llm, messages, model_key):
+            if first_token is None:
+                first_token = round(time.perf_counter() - start, 3)
+            buffer += content
+            yield format_stream_event(fmt, "delta", {"content": content})
+    except Exception as e:
+        logger.error(f"[MODEL ERROR] {e}")
+        yield format_stream_event(fmt, "error", {"error": f"Lỗi khi gọi model: {e}"})
+        return
+    model_elapsed = round(time.perf_counter() - start, 3)
+    yield format_stream_event(fmt, "done", await finalize(buffer, model_elapsed, first_token))
+
+async def collect_stream(llm, messages, model_key=None) -> str:
+    buffer = ""
+    async for content in aiter_llm_content(llm, messages, model_key):
+        buffer += content
+    return buffer
+
+def traced(handler):
+    """Bản ASGI của ai_bot.traced_route: root span + header X-Request-ID + latency histogram."""
+    @functools.wraps(handler)
+    async def wrapper(scope, receive, send):
+        start = time.perf_counter()
+        status = 500
+        request_scope.begin()
+        root = tracing.start_trace(
+            f"{scope['method']} {scope['path']}", get_header(scope, "X-Request-ID") or None,
+            **{"http.method": scope["method"], "http.route": scope["path"]},
+        )
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", root.request_id.encode("latin-1"))]
+                status = message["status"]
+                root.set_attribute("http.status_code", status)
+            await send(message)
+
+        with tracing.use_span(root):
+            try:
+                return await handler(scope, receive, send_with_request_id)
+            except Exception as e:
+                root.record_error(e)
+                raise
+            finally:
+                root.end()
+                metrics.observe_request(scope["path"], scope["method"], status, time.perf_counter() - start)
+    return wrapper
+
+# ---------------- WHOISME /v1/chatbot ----------------
+@traced
+async def whoisme_chat_parallel(scope, receive, send):
+    t0 = time.perf_counter()
+
+    user_info, auth_error = authenticate_bearer(get_header(scope, "Authorization"))
+    if not user_info:
+        return await send_json(send, {"error": auth_error}, 401)
+
+    user_id = user_info["userId"]
+    payload = await read_json(receive)
+    user_msg, session_id, archetype_code = parse_chat_payload(payload)
+    stream_fmt = resolve_stream_format(payload, get_header(scope, "Accept"))
+
+    if not user_msg:
+        return await send_json(send, {"error": "Message không được để trống"}, 400)
+
+    t1 = time.perf_counter()
+    auth_elapsed = round(t1 - t0, 3)
+
+    cache_start = time.perf_counter()
+    cached_resp, cache_type = await run_db(lookup_cached_response, user_id, session_id, user_msg)
+    cache_elapsed = round(time.perf_counter() - cache_start, 3)
+
+    if cached_resp:
+        total_elapsed = round(time.perf_counter() - t0, 3)
+        cached_payload = {
+            "user_id": user_id,
+            "session_id": session_id,
+            "model": "cache",
+            "cache_type": cache_type,
+            "archetype_code": archetype_code,
+            "elapsed": {
+                "total": total_elapsed,
+                "auth": auth_elapsed,
+                "cache": cache_elapsed,
+                "cached": True
+            }
+        }
+        if stream_fmt:
+            return await send_stream(send, stream_fmt, aiter_events(cached_stream_events(stream_fmt, cached_resp, cached_payload)))
+        cached_payload["message"] = [
+            {"role": "user", "content": user_msg},
+            {"role": "assistant", "content": cached_resp}
+        ]
+        return await send_json(send, cached_payload)
+
+    prompt_start = time.perf_counter()
+    model_key, llm = await aload_model()
+    if not llm:
+        return await send_json(send, {"error": "Model không hợp lệ"}, 400)
+    model_name = getattr(llm, "model", None) or getattr(llm, "model_name", "Unknown")
+    prompt_elapsed = round(time.perf_counter() - prompt_start, 3)
+    tracing.current_span().set_attribute("llm.model.name", model_name)
+
+    prepare_start = time.perf_counter()
+    (short_msgs, long_ctx), personality, _ = await asyncio.gather(
+        run_db(get_context_parallel, user_id, user_msg, session_id, short_limit=5, long_top_k=5),
+        afetch_personality_source(archetype_code),
+        aensure_prompt(),
+    )
+    # Embed câu hỏi (nếu chưa có) không được chạy trên event loop
+    knowledge = await run_db(get_knowledge, user_msg)
+    messages = await abuild_prompt(build_structured_prompt, user_msg, short_msgs, long_ctx, archetype_code=archetype_code,
+                                   personality=personality, knowledge=knowledge)
+    prepare_elapsed = round(time.perf_counter() - prepare_start, 3)
+
+    if stream_fmt:
+        async def finalize(buffer, model_elapsed, first_token):
+            update_start = time.perf_counter()
+            await run_db(record_turn, user_id, session_id, user_msg, buffer, time_spent=model_elapsed)
+            update_elapsed = round(time.perf_counter() - update_start, 3)
+            return {
+                "user_id": user_id,
+                "session_id": session_id,
+                "model": model_name,
+                "archetype_code": archetype_code,
+                "elapsed": {
+                    "total": round(time.perf_counter() - t0, 3),
+                    "auth": auth_elapsed,
+                    "cache": cache_elapsed,
+                    "prompt": prompt_elapsed,
+                    "prepare": prepare_elapsed,
+                    "first_token": first_token,
+                    "model": model_elapsed,
+                    "update": update_elapsed,
+                    "cached": False
+                }
+            }
+        return await send_stream(send, stream_fmt, astream_llm_events(llm, messages, stream_fmt, finalize, model_key))
+
+    model_start = time.perf_counter()
+    try:
+        buffer = await collect_stream(llm, messages, model_key)
+    except Exception as e:
+        logger.error(f"[MODEL ERROR] {e}")
+        return await send_json(send, {"error": f"Lỗi khi gọi model: {e}"}, 500)
+    model_elapsed = round(time.perf_counter() - model_start, 3)
+
+    update_start = time.perf_counter()
+    await run_db(record_turn, user_id, session_id, user_msg, buffer, time_spent=model_elapsed)
+    update_elapsed = round(time.perf_counter() - update_start, 3)
+
+    total_elapsed = round(time.perf_counter() - t0, 3)
+    logger.debug(
+        f"[PROFILE] model={model_name} | total={total_elapsed}s | "
+        f"auth={auth_elapsed}s | cache={cache_elapsed}s | prompt={prompt_elapsed}s | "
+        f"prepare={prepare_elapsed}s | model={model_elapsed}s | update={update_elapsed}s"
+    )
+
+    await send_json(send, {
+        "user_id": user_id,
+        "session_id": session_id,
+        "model": model_name,
+        "archetype_code": archetype_code,
+        "elapsed": {
+            "total": total_elapsed,
+            "auth": auth_elapsed,
+            "cache": cache_elapsed,
+            "prompt": prompt_elapsed,
+            "prepare": prepare_elapsed,
+            "model": model_elapsed,
+            "update": update_elapsed,
+            "cached": False
+        },
+        "message": [
+            {"role": "user", "content": user_msg},
+            {"role": "assistant", "content": buffer}
+        ]
+    })
+
+# ---------------- WHOISME /v1/chat ----------------
+@traced
+async def whoisme_chat_parallell(scope, receive, send):
+    t0 = time.perf_counter()
+
+    user_info, auth_error = authenticate_bearer(get_header(scope, "Authorization"))
+    if not user_info:
+        return await send_json(send, {"error": auth_error}, 401)
+
+    user_id = user_info["userId"]
+    payload = await read_json(receive)
+    user_msg, session_id, archetype_code = parse_chat_payload(payload)
+    stream_fmt = resolve_stream_format(payload, get_header(scope, "Accept"))
+
+    if not user_msg:
+        return await send_json(send, {"error": "Message không được để trống"}, 400)
+
+    cached_resp, cache_type = await run_db(lookup_cached_response, user_id, session_id, user_msg)
+    if cached_resp:
+        total_elapsed = round(time.perf_counter() - t0, 3)
+        cached_payload = {
+            "user_id": user_id,
+            "session_id": session_id,
+            "model": "cache",
+            "cache_type": cache_type,
+            "archetype_code": archetype_code,
+            "elapsed": {
+                "total": total_elapsed,
+                "cached": True
+            },
+            "system_prompt": None
+        }
+        if stream_fmt:
+            return await send_stream(send, stream_fmt, aiter_events(cached_stream_events(stream_fmt, cached_resp, cached_payload)))
+        cached_payload["message"] = [
+            {"role": "user", "content": user_msg},
+            {"role": "assistant", "content": cached_resp}
+        ]
+        return await send_json(send, cached_payload)
+
+    model_key, llm = await aload_model()
+    if not llm:
+        return await send_json(send, {"error": "Model không hợp lệ"}, 400)
+    model_name = getattr(llm, "model", None) or getattr(llm, "model_name", "Unknown")
+
+    (short_msgs, long_ctx), personality, _ = await asyncio.gather(
+        run_db(get_context_parallel, user_id, user_msg, session_id, short_limit=5, long_top_k=3),
+        afetch_personality_source(archetype_code),
+        aensure_prompt(),
+    )
+    messages, final_system_prompt, formatted_user_msg = await abuild_prompt(
+        build_chat_messages, user_msg, short_msgs, long_ctx, personality, archetype_code=archetype_code)
+
+    if stream_fmt:
+        async def finalize(buffer, model_elapsed, first_token):
+            await run_db(record_turn, user_id, session_id, user_msg, buffer, time_spent=model_elapsed, short_limit=5)
+            return {
+                "user_id": user_id,
+                "session_id": session_id,
+                "model": model_name,
+                "archetype_code": archetype_code,
+                "cached": False,
+                "elapsed": {
+                    "total": round(time.perf_counter() - t0, 3),
+                    "first_token": first_token,
+                    "model": model_elapsed
+                }
+            }
+        return await send_stream(send, stream_fmt, astream_llm_events(llm, messages, stream_fmt, finalize, model_key))
+
+    model_start = time.perf_counter()
+    try:
+        buffer = await collect_stream(llm, messages, model_key)
+    except Exception as e:
+        return await send_json(send, {"error": f"Lỗi khi gọi model: {e}"}, 500)
+    model_elapsed = round(time.perf_counter() - model_start, 3)
+
+    await run_db(record_turn, user_id, session_id, user_msg, buffer, time_spent=model_elapsed, short_limit=5)
+
+    total_elapsed = round(time.perf_counter() - t0, 3)
+    await send_json(send, {
+        "user_id": user_id,
+        "session_id": session_id,
+        "model": model_name,
+        "archetype_code": archetype_code,
+        "system_prompt": final_system_prompt,
+        "formatted_user_message": formatted_user_msg,
+        "long_term_context": long_ctx,
+        "short_term_messages": short_msgs,
+        "cached": False,
+        "elapsed": {
+            "total": total_elapsed,
+            "model": model_elapsed
+        },
+        "message": [
+            {"role": "user", "content": user_msg},
+            {"role": "assistant", "content": buffer}
+        ]
+    })
+
+# ---------------- APP ----------------
+ASYNC_ROUTES = {
+    ("POST", "/v1/chatbot"): whoisme_chat_parallel,
+    ("POST", "/v1/chat"): whoisme_chat_parallell,
+}
+
+flask_asgi = WSGIMiddleware(flask_app, workers=FLASK_THREADS)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Lần gọi đầu tải config qua mạng (sau đó chỉ đọc cache), rồi prewarm đúng provider của config
+            hosts = await asyncio.to_thread(upstream_hosts)
+            await http_client.aprewarm(hosts)
+            await asyncio.to_thread(db_pool.prewarm)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await http_client.aclose()
+            await asyncio.to_thread(write_behind.shutdown)
+            DB_EXECUTOR.shutdown(wait=False)
+            db_pool.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http":
+        handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if handler:
+            return await handler(scope, receive, send)
+    await flask_asgi(scope, receive, send)
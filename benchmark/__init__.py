@@ -0,0 +1 @@
+"""Load test cho chatbot: fake upstream LLM, seed PostgreSQL/pgvector, driver đo latency."""
@@ -0,0 +1,154 @@
+"""
+So sánh backend embedding: torch (SentenceTransformer) vs ONNX Runtime fp32 vs int8.
+
+Mỗi backend chạy trong một process riêng để đo thời gian import + load model và RSS
+một cách độc lập; process cha tính percentile, cosine so với torch, in bảng và lưu JSON.
+
+    python -m data.embed_onnx export
+    python -m benchmark.embedding --single 300 --batch-texts 512
+    python -m benchmark.embedding --backends torch,onnx-int8 --threads 1
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmark", "results")
+BACKENDS = ["torch", "onnx-fp32", "onnx-int8"]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def corpus(n):
+    from data.embed_onnx import PARITY_SENTENCES
+    return [f"{PARITY_SENTENCES[i % len(PARITY_SENTENCES)]} (#{i})" for i in range(n)]
+
+
+# ---------------- WORKER (process con) ----------------
+def run_worker(args):
+    rss_start = rss_mb()
+    t0 = time.perf_counter()
+    # Embedder của app, backend chọn qua biến môi trường do process cha đặt
+    from data.embed_messages import embedder
+    encoder = embedder.encoder
+    load_s = time.perf_counter() - t0
+    rss_loaded = rss_mb()
+
+    from data.embed_onnx import PARITY_SENTENCES
+    parity_vectors = encoder.encode(PARITY_SENTENCES)
+
+    for text in corpus(args.warmup):
+        encoder.encode([text])
+    single = []
+    for text in corpus(args.single):
+        t = time.perf_counter()
+        encoder.encode([text])
+        single.append(time.perf_counter() - t)
+
+    texts = corpus(args.batch_texts)
+    t = time.perf_counter()
+    encoder.encode(texts, batch_size=args.batch_size)
+    batch_s = time.perf_counter() - t
+
+    np.save(args.vectors_out, np.asarray(parity_vectors, dtype=np.float32))
+    print(json.dumps({
+        "load_s": round(load_s, 3),
+        "rss_start_mb": round(rss_start, 1),
+        "rss_loaded_mb": round(rss_loaded, 1),
+        "rss_end_mb": round(rss_mb(), 1),
+        "single_s": single,
+        "batch_texts_per_s": round(len(texts) / batch_s, 1),
+    }))
+
+
+# ---------------- PARENT ----------------
+def run_backend(backend, args):
+    vectors = tempfile.NamedTemporaryFile(suffix=".npy", delete=False).name
+    env = {**os.environ, "EMBED_BACKEND": "torch" if backend == "torch" else "onnx",
+           "EMBED_ONNX_QUANTIZE": "1" if backend == "onnx-int8" else "0", "EMBED_BATCHING": "0"}
+    if args.threads:
+        # Giới hạn thread cho cả torch và onnxruntime để so sánh công bằng
+        env.update({"OMP_NUM_THREADS": str(args.threads), "EMBED_ONNX_THREADS": str(args.threads)})
+    cmd = [sys.executable, "-m", "benchmark.embedding", "--worker", backend, "--vectors-out", vectors,
+           "--single", str(args.single), "--warmup", str(args.warmup),
+           "--batch-texts", str(args.batch_texts), "--batch-size", str(args.batch_size)]
+    out = subprocess.run(cmd, cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    if out.returncode != 0:
+        print(out.stderr[-2000:], file=sys.stderr)
+        raise RuntimeError(f"backend {backend} lỗi (exit {out.returncode})")
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["vectors"] = np.load(vectors)
+    os.remove(vectors)
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark latency / bộ nhớ của các backend embedding")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        type=lambda s: [b.strip() for b in s.split(",") if b.strip()])
+    parser.add_argument("--single", type=int, default=200, help="số lần encode 1 câu")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--batch-texts", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=0, help="số thread tính toán (0 = mặc định)")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--worker", choices=BACKENDS, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--vectors-out", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+        return
+
+    from benchmark.run import distribution, git_commit
+
+    results = {}
+    for backend in args.backends:
+        print(f"→ {backend} ...", flush=True)
+        results[backend] = run_backend(backend, args)
+
+    reference = results.get("torch", {}).get("vectors")
+    report = {}
+    print(f"\n{'backend':<10} {'load_s':>7} {'rss_mb':>7} {'p50_ms':>7} {'p95_ms':>7} {'p99_ms':>7} "
+          f"{'batch/s':>8} {'cos_min':>8}")
+    for backend, r in results.items():
+        single = distribution([s * 1000 for s in r.pop("single_s")])
+        vectors = r.pop("vectors")
+        cos_min = float(np.min(np.sum(reference * vectors, axis=1))) if reference is not None else None
+        report[backend] = {**r, "single_ms": single, "cosine_min_vs_torch": cos_min}
+        print(f"{backend:<10} {r['load_s']:>7} {r['rss_loaded_mb']:>7} {single['p50']:>7.2f} "
+              f"{single['p95']:>7.2f} {single['p99']:>7.2f} {r['batch_texts_per_s']:>8} "
+              f"{cos_min if cos_min is None else round(cos_min, 5)!s:>8}")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"embedding-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {"timestamp": datetime.now().isoformat(timespec="seconds"), "git_commit": git_commit(),
+                     "args": vars(args)},
+            "backends": report,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\nĐã lưu kết quả: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Fake upstream cho load test, thay cho OpenAI và các API prompt/archetype của WhoIsMe.
+
+- POST .../chat/completions : OpenAI-compatible, stream SSE hoặc JSON, TTFT và tokens/sec cấu hình được
+- GET  /prompt              : payload giống prompt.whoisme.ai (systemPrompt, userPromptFormat)
+- GET  /config              : payload giống chatgpt_prompt_chatbot (model, temperature, maxTokens)
+- GET  /archetype/<code>    : payload giống api.whoisme.ai/api/archetype/code/<code>
+
+Chạy riêng:
+    python -m benchmark.fake_llm --port 8900 --ttft 0.4 --tps 40 --tokens 120
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SYSTEM_PROMPT = "Bạn là trợ lý WhoIsMe cho nhóm tính cách %archetypeName% (%mbti%). Phong cách: %style%. Trả lời ngắn gọn."
+USER_PROMPT_FORMAT = "User's question: {{content}}"
+WORDS = "xin chào mình là trợ lý whoisme rất vui được trò chuyện cùng bạn về tính cách và công việc hôm nay".split()
+
+
+class FakeUpstream:
+    def __init__(self, ttft=0.3, tps=50.0, tokens=100, jitter=0.1, model="gpt-4o-mini"):
+        self.ttft = ttft
+        self.tps = tps
+        self.tokens = tokens
+        self.jitter = jitter
+        self.model = model
+        self.server = None
+        self.counters = {"completions": 0, "prompt": 0, "config": 0, "archetype": 0}
+        self.lock = threading.Lock()
+
+    def _count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def _delay(self, seconds):
+        """Độ trễ ± jitter (tỉ lệ), không âm."""
+        if seconds <= 0:
+            return
+        time.sleep(max(0.0, seconds * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    # ---------------- PAYLOADS ----------------
+    def prompt_payload(self):
+        return {"data": {"systemPrompt": SYSTEM_PROMPT, "userPromptFormat": USER_PROMPT_FORMAT, "updatedAt": "benchmark"}}
+
+    def config_payload(self):
+        return {"data": {"model": self.model, "temperature": 0.7, "maxTokens": self.tokens * 2, "topP": 1}}
+
+    def archetype_payload(self, code):
+        return {"data": {
+            "code": code,
+            "updatedAt": "benchmark",
+            "translation": {
+                "name": f"Benchmark {code}", "style": "thân thiện", "tone": "nhẹ nhàng",
+                "representativeSpirit": "tò mò", "color": "xanh", "slogan": "Học mỗi ngày",
+                "suggestedJobs": "kỹ sư", "strengths": "kiên nhẫn", "weaknesses": "cầu toàn", "note": "",
+            },
+        }}
+
+    def completion_chunk(self, cid, model, delta, finish_reason=None):
+        return {
+            "id": cid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def words(self):
+        return [WORDS[i % len(WORDS)] + " " for i in range(self.tokens)]
+
+    # ---------------- SERVER ----------------
+    def handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, payload, status=200):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0].rstrip("/")
+                if path.endswith("/prompt"):
+                    upstream._count("prompt")
+                    return self._json(upstream.prompt_payload())
+                if path.endswith("/config"):
+                    upstream._count("config")
+                    return self._json(upstream.config_payload())
+                if "/archetype/" in path:
+                    upstream._count("archetype")
+                    return self._json(upstream.archetype_payload(path.rsplit("/", 1)[-1]))
+                self._json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    body = {}
+                if not self.path.split("?", 1)[0].endswith("/chat/completions"):
+                    return self._json({"error": "not found"}, 404)
+                upstream._count("completions")
+                model = body.get("model") or upstream.model
+                cid = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+                interval = 1.0 / upstream.tps if upstream.tps > 0 else 0
+
+                if not body.get("stream"):
+                    upstream._delay(upstream.ttft + interval * upstream.tokens)
+                    return self._json({
+                        "id": cid, "object": "chat.completion", "created": int(time.time()), "model": model,
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": "".join(upstream.words())}}],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": upstream.tokens, "total_tokens": upstream.tokens},
+                    })
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    upstream._delay(upstream.ttft)
+                    for i, word in enumerate(upstream.words()):
+                        if i:
+                            upstream._delay(interval)
+                        delta = {"role": "assistant", "content": word} if i == 0 else {"content": word}
+                        event = upstream.completion_chunk(cid, model, delta)
+                        self._chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self._chunk(f"data: {json.dumps(upstream.completion_chunk(cid, model, {}, 'stop'))}\n\n".encode("utf-8"))
+                    self._chunk(b"data: [DONE]\n\n")
+                    self._chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="fake-llm").start()
+        return self.server.server_address
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def app_env(self):
+        """Biến môi trường trỏ app sang fake upstream này."""
+        base = self.base_url()
+        return {
+            "OPENAI_BASE_URL": f"{base}/v1",
+            "OPEN_API_KEY": "benchmark",
+            "PROMPT_API_URL": f"{base}/prompt",
+            "PROMPT_CONFIG_URL": f"{base}/config",
+            "WHOISME_API_URL": f"{base}/archetype/{{}}",
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible upstream cho load test")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--ttft", type=float, default=0.3, help="giây tới token đầu tiên")
+    parser.add_argument("--tps", type=float, default=50.0, help="tokens/giây sau token đầu")
+    parser.add_argument("--tokens", type=int, default=100, help="số token mỗi câu trả lời")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--model", default="gpt-4o-mini")
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(args.ttft, args.tps, args.tokens, args.jitter, args.model)
+    upstream.start(args.host, args.port)
+    print(f"Fake upstream: {upstream.base_url()}")
+    for k, v in upstream.app_env().items():
+        print(f"  export {k}={v}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        upstream.stop()
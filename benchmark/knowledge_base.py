@@ -0,0 +1,111 @@
+"""
+Đo ngưỡng KB_MIN_SCORE cho knowledge base trên câu hỏi thật (model embedding của app).
+
+    python -m benchmark.knowledge_base --queries kb_queries.jsonl --target-recall 0.95
+
+Mỗi dòng của file câu hỏi: {"query": "...", "expect": "đoạn text của dòng sheet đúng" | null}
+(null = câu hỏi không có dòng nào liên quan, vd. chào hỏi). Với mỗi câu lấy top-k không lọc:
+- positive: score của dòng khớp `expect` (nếu nằm trong top-k)
+- negative: score các dòng còn lại trong top-k (câu `expect = null` thì mọi dòng đều là negative)
+
+In phân phối score hai nhóm và với từng ngưỡng: recall (positive giữ lại) / tỉ lệ negative lọt
+qua. Ngưỡng đề xuất là ngưỡng cao nhất còn giữ >= --target-recall positive; đặt vào
+KB_MIN_SCORE (để trống = không lọc, chỉ lấy KB_TOP_K dòng).
+"""
+import os
+import json
+import argparse
+from datetime import datetime
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmark", "results")
+
+
+def load_queries(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def collect_scores(kb, embed_fn, queries, top_k):
+    positives, negatives, missed = [], [], []
+    for q in queries:
+        hits = kb.search(embed_fn(q["query"]), top_k)
+        expect = (q.get("expect") or "").strip().lower()
+        found = False
+        for h in hits:
+            if expect and not found and expect in h["text"].lower():
+                positives.append(h["score"])
+                found = True
+            else:
+                negatives.append(h["score"])
+        if expect and not found:
+            missed.append(q["query"])
+    return np.asarray(positives), np.asarray(negatives), missed
+
+
+def sweep(positives, negatives, thresholds):
+    rows = []
+    for t in thresholds:
+        rows.append({
+            "threshold": round(float(t), 3),
+            "recall": round(float((positives >= t).mean()), 4) if len(positives) else None,
+            "negative_pass": round(float((negatives >= t).mean()), 4) if len(negatives) else None,
+        })
+    return rows
+
+
+def percentiles(values):
+    if not len(values):
+        return None
+    return {f"p{p}": round(float(np.percentile(values, p)), 4) for p in (5, 25, 50, 75, 95)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Đo ngưỡng KB_MIN_SCORE cho knowledge base")
+    parser.add_argument("--queries", required=True, help="JSONL {query, expect}")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--kb-dir", default=None)
+    parser.add_argument("--out", default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    from benchmark.run import git_commit
+    from data.embed_messages import embedder, MODEL_NAME
+    from data.knowledge_base import KnowledgeBase, KB_DIR
+
+    kb = KnowledgeBase(embedder.embed_batch_cached, args.kb_dir or KB_DIR)
+    kb.refresh()
+    print(f"Knowledge base: {kb.stats()} | model: {MODEL_NAME}")
+
+    queries = load_queries(args.queries)
+    positives, negatives, missed = collect_scores(kb, embedder.embed_cached, queries, args.top_k)
+    table = sweep(positives, negatives, np.arange(0.50, 0.96, 0.01))
+    eligible = [r for r in table if r["recall"] is not None and r["recall"] >= args.target_recall]
+    suggested = eligible[-1]["threshold"] if eligible else None
+
+    print(f"\npositive (n={len(positives)}): {percentiles(positives)}")
+    print(f"negative (n={len(negatives)}): {percentiles(negatives)}")
+    print(f"không có dòng đúng trong top-{args.top_k}: {len(missed)} câu")
+    print(f"\n{'ngưỡng':>7} {'recall':>7} {'neg_pass':>9}")
+    for r in table[::5]:
+        print(f"{r['threshold']:>7.2f} {r['recall']!s:>7} {r['negative_pass']!s:>9}")
+    print(f"\nĐề xuất KB_MIN_SCORE={suggested} (recall >= {args.target_recall})")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"knowledge-base-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {"timestamp": datetime.now().isoformat(timespec="seconds"), "git_commit": git_commit(),
+                     "model": MODEL_NAME, "args": vars(args), "kb": kb.stats()},
+            "positive": percentiles(positives), "negative": percentiles(negatives),
+            "missed": missed, "sweep": table, "suggested": suggested,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"Đã lưu kết quả: {out}")
+
+
+if __name__ == "__main__":
+    main()
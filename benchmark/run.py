@@ -0,0 +1,322 @@
+"""
+Load test end-to-end: app thật (gunicorn + gunicorn.conf.py) chạy với fake upstream LLM
+(benchmark/fake_llm.py) và PostgreSQL/pgvector cục bộ đã seed (benchmark/seed_db.py).
+
+    docker compose -f benchmark/docker-compose.yml up -d
+    python -m benchmark.run --concurrency 32 --requests 300 --ttft 0.4 --tps 40
+    python -m benchmark.run --concurrency 32 --requests 300 --compare benchmark/results/baseline.json
+
+Mỗi endpoint (/v1/chatbot, /v1/chat, /chat) được chạy lần lượt ở cùng mức concurrency.
+Kết quả p50/p95/p99, TTFB, throughput, error rate được lưu JSON trong benchmark/results/;
+--compare trả exit code 1 nếu có chỉ số tệ hơn baseline quá --max-regression.
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import itertools
+import subprocess
+import tempfile
+from collections import Counter
+from datetime import datetime
+import httpx
+import jwt
+import psycopg2
+from flask import Flask
+
+from benchmark import seed_db
+from benchmark.fake_llm import FakeUpstream
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmark", "results")
+ENDPOINTS = ["/v1/chatbot", "/v1/chat", "/chat"]
+JWT_SECRET = "benchmark-jwt-secret-0123456789abcdef"
+FLASK_SECRET = "benchmark-flask-secret-0123456789abcdef"
+
+# ---------------- AUTH ----------------
+def bearer_token(user_id):
+    """Token HS256 giống verify_whoisme_token fallback trong ai_bot (JWT_SECRET)."""
+    return jwt.encode({"userId": user_id, "email": f"{user_id}@bench.local"}, JWT_SECRET, algorithm="HS256")
+
+_cookie_app = Flask("benchmark")
+_cookie_app.secret_key = FLASK_SECRET
+
+def session_cookie(user_id):
+    """Cookie session Flask ký bằng FLASK_SECRET, để /chat đọc được session["user"]."""
+    serializer = _cookie_app.session_interface.get_signing_serializer(_cookie_app)
+    return serializer.dumps({"user": {"id": user_id, "email": f"{user_id}@bench.local"}})
+
+# ---------------- APP PROCESS ----------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_app(port, workers, serving_mode, env_overrides, project_root):
+    os.makedirs(os.path.join(project_root, "logs"), exist_ok=True)
+    env = {**os.environ, **env_overrides, "PROJECT_ROOT": project_root, "SERVING_MODE": serving_mode}
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    cmd = [
+        sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py",
+        "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+    ]
+    log = open(os.path.join(project_root, "logs", "app_stdout.log"), "w")
+    return subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_ready(base_url, proc, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"App dừng khi khởi động (exit {proc.returncode})")
+        try:
+            if httpx.get(f"{base_url}/metrics", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"App không sẵn sàng sau {timeout}s")
+
+def stop_app(proc):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+# ---------------- DRIVER ----------------
+async def one_request(client, base_url, endpoint, user_id, session_id, args):
+    body = {"message": f"Benchmark {uuid.uuid4().hex[:8]}: mình nên chọn công việc nào?", "session_id": session_id}
+    if args.archetype:
+        body["code"] = args.archetype
+    headers = {}
+    if endpoint == "/chat":
+        headers["Cookie"] = f"session={session_cookie(user_id)}"
+    else:
+        headers["Authorization"] = f"Bearer {bearer_token(user_id)}"
+        if args.stream:
+            body["stream"] = "sse"
+
+    start = time.perf_counter()
+    ttfb = None
+    status = None
+    error = None
+    tail = b""
+    try:
+        async with client.stream("POST", base_url + endpoint, json=body, headers=headers) as resp:
+            status = resp.status_code
+            async for chunk in resp.aiter_bytes():
+                if ttfb is None and chunk:
+                    ttfb = time.perf_counter() - start
+                tail = (tail + chunk)[-4096:]
+    except Exception as e:
+        error = type(e).__name__
+    latency = time.perf_counter() - start
+
+    if error is None and status >= 400:
+        error = f"HTTP {status}"
+    if error is None and (b"[ERROR]" in tail or b"event: error" in tail or b"Error with " in tail):
+        error = "model error"
+    return {"latency": latency, "ttfb": ttfb, "status": status, "error": error}
+
+async def run_endpoint(base_url, endpoint, args, pairs, total, duration=None):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    samples = []
+    counter = itertools.count()
+    deadline = time.perf_counter() + duration if duration else None
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        async def worker():
+            while True:
+                i = next(counter)
+                if deadline is None and i >= total:
+                    return
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                user_id, session_id = random.choice(pairs)
+                samples.append(await one_request(client, base_url, endpoint, user_id, session_id, args))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - start
+    return samples, wall
+
+async def drive(base_url, args, pairs):
+    results = {}
+    for endpoint in args.endpoints:
+        if args.warmup:
+            await run_endpoint(base_url, endpoint, args, pairs, args.warmup)
+        samples, wall = await run_endpoint(base_url, endpoint, args, pairs, args.requests, args.duration)
+        results[endpoint] = summarize(samples, wall)
+        print_row(endpoint, results[endpoint])
+    return results
+
+# ---------------- STATS ----------------
+def percentile(values, q):
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def distribution(values):
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "mean": round(sum(values) / len(values), 4),
+        "max": round(max(values), 4),
+    }
+
+def summarize(samples, wall):
+    ok = [s for s in samples if s["error"] is None]
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "error_rate": round((len(samples) - len(ok)) / len(samples), 4) if samples else 0.0,
+        "error_kinds": dict(Counter(s["error"] for s in samples if s["error"])),
+        "duration_s": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 3) if wall else 0.0,
+        "latency_s": distribution([s["latency"] for s in ok]),
+        "ttfb_s": distribution([s["ttfb"] for s in ok if s["ttfb"] is not None]),
+    }
+
+def _fmt(dist, key):
+    return f"{dist[key]:.3f}" if dist else "-"
+
+def print_row(endpoint, r):
+    lat, ttfb = r["latency_s"], r["ttfb_s"]
+    print(
+        f"{endpoint:<12} req={r['requests']:<5} err={r['error_rate']:.2%} rps={r['throughput_rps']:<8} "
+        f"p50={_fmt(lat, 'p50')} p95={_fmt(lat, 'p95')} p99={_fmt(lat, 'p99')} ttfb_p50={_fmt(ttfb, 'p50')}",
+        flush=True,
+    )
+
+def compare(current, baseline, max_regression):
+    """Danh sách chỉ số tệ hơn baseline: latency tăng / throughput giảm quá ngưỡng, error rate tăng > 1 điểm %."""
+    regressions = []
+    for endpoint, cur in current.items():
+        base = baseline.get(endpoint)
+        if not base:
+            continue
+        for key in ("p50", "p95", "p99"):
+            c, b = (cur["latency_s"] or {}).get(key), (base["latency_s"] or {}).get(key)
+            if c and b and (c - b) / b > max_regression:
+                regressions.append(f"{endpoint} latency {key}: {b:.3f}s → {c:.3f}s (+{(c - b) / b:.0%})")
+        c, b = cur["throughput_rps"], base["throughput_rps"]
+        if b and (b - c) / b > max_regression:
+            regressions.append(f"{endpoint} throughput: {b} → {c} rps (-{(b - c) / b:.0%})")
+        if cur["error_rate"] - base["error_rate"] > 0.01:
+            regressions.append(f"{endpoint} error rate: {base['error_rate']:.2%} → {cur['error_rate']:.2%}")
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except Exception:
+        return None
+
+# ---------------- MAIN ----------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test /v1/chatbot, /v1/chat, /chat")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), type=lambda s: [e.strip() for e in s.split(",") if e.strip()])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="số request mỗi endpoint")
+    parser.add_argument("--duration", type=float, default=None, help="chạy theo thời gian (giây) thay vì số request")
+    parser.add_argument("--warmup", type=int, default=5, help="số request làm nóng mỗi endpoint (không tính)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--stream", action="store_true", help="/v1/* trả SSE thay vì JSON")
+    parser.add_argument("--archetype", default="ENFP-A", help="code archetype gửi kèm (rỗng = không gửi)")
+    # Fake upstream
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--tps", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--upstream-port", type=int, default=0)
+    # Database
+    parser.add_argument("--pg-url", default=seed_db.DEFAULT_PG_URL)
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--skip-seed", action="store_true")
+    # App
+    parser.add_argument("--app-url", default=None, help="dùng app đang chạy sẵn (tự trỏ upstream) thay vì khởi động gunicorn")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--serving-mode", choices=["sync", "asgi"], default="sync")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    # Output
+    parser.add_argument("--out", default=None, help="file JSON kết quả (mặc định benchmark/results/bench-<time>.json)")
+    parser.add_argument("--compare", default=None, help="file JSON baseline để so sánh")
+    parser.add_argument("--max-regression", type=float, default=0.10)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    upstream = FakeUpstream(args.ttft, args.tps, args.tokens, args.jitter)
+    upstream.start(port=args.upstream_port)
+    print(f"Fake upstream: {upstream.base_url()} (ttft={args.ttft}s, tps={args.tps}, tokens={args.tokens})")
+
+    pairs = seed_db.bench_users(args.users, args.sessions)
+    if not args.skip_seed:
+        with psycopg2.connect(args.pg_url) as conn:
+            seed_db.create_schema(conn)
+            seed_db.reset(conn)
+            print(f"Seed {seed_db.seed(conn, args.users, args.sessions, args.messages)} dòng whoisme.messages")
+
+    proc = None
+    base_url = args.app_url
+    try:
+        if not base_url:
+            port = free_port()
+            project_root = tempfile.mkdtemp(prefix="chatbot-bench-")
+            env = {**upstream.app_env(), "POSTGRES_URL": args.pg_url, "JWT_SECRET": JWT_SECRET, "FLASK_SECRET": FLASK_SECRET}
+            if args.redis_url:
+                env["REDIS_URL"] = args.redis_url
+            proc = start_app(port, args.workers, args.serving_mode, env, project_root)
+            base_url = f"http://127.0.0.1:{port}"
+            print(f"App: {base_url} ({args.serving_mode}, {args.workers} workers, log: {project_root}/logs)")
+            wait_ready(base_url, proc, args.startup_timeout)
+        results = asyncio.run(drive(base_url, args, pairs))
+    finally:
+        stop_app(proc)
+        upstream.stop()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "args": vars(args),
+            "upstream": {**upstream.counters},
+        },
+        "endpoints": results,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Đã lưu kết quả: {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["endpoints"]
+        regressions = compare(results, baseline, args.max_regression)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("Không có regression so với baseline")
+
+
+if __name__ == "__main__":
+    main()
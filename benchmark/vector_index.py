@@ -0,0 +1,152 @@
+"""
+Recall / latency của truy vấn vector qua index HNSW so với exact search (pgvector cục bộ).
+
+    docker compose -f benchmark/docker-compose.yml up -d
+    python -m benchmark.seed_db --users 50 --messages 2000
+    python -m benchmark.vector_index --build --ef-search 10,20,40,80,160 --scope all,user,session
+
+Exact search chạy cùng truy vấn với `SET LOCAL enable_indexscan = off` (HNSW chỉ có index
+scan nên planner buộc phải quét + sort). Mỗi mức ef_search đo recall@k (tỉ lệ id trùng với
+exact), latency p50/p95/p99 và plan có dùng index HNSW không. Scope:
+- session: đúng truy vấn của app (lọc user + session)
+- user: chỉ lọc user
+- all: toàn bảng (trường hợp HNSW có lợi rõ nhất)
+"""
+import os
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+import numpy as np
+
+from benchmark import seed_db
+from data import vector_index
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmark", "results")
+
+SCOPE_WHERE = {
+    "session": "AND user_id = %s AND session_id = %s",
+    "user": "AND user_id = %s",
+    "all": "",
+}
+
+
+def scope_sql(scope):
+    return (
+        "SELECT id FROM whoisme.messages WHERE is_deleted = FALSE "
+        f"{SCOPE_WHERE[scope]} ORDER BY embedding_vector <=> %s::vector LIMIT %s"
+    )
+
+
+def scope_params(scope, user_id, session_id, vec, top_k):
+    head = {"session": (user_id, session_id), "user": (user_id,), "all": ()}[scope]
+    return head + (seed_db._vec_literal(vec), top_k)
+
+
+def timed_ids(conn, settings, sql, params):
+    """Chạy truy vấn trong transaction riêng với SET LOCAL `settings`. Trả về (ids, giây)."""
+    with conn.cursor() as cur:
+        if settings:
+            cur.execute(settings)
+        start = time.perf_counter()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        elapsed = time.perf_counter() - start
+    conn.rollback()
+    return [r["id"] for r in rows], elapsed
+
+
+def run_scope(conn, scope, queries, ef_values, top_k):
+    sql = scope_sql(scope)
+    exact_ids, exact_s = [], []
+    for user_id, session_id, vec in queries:
+        ids, s = timed_ids(conn, "SET LOCAL enable_indexscan = off;", sql,
+                           scope_params(scope, user_id, session_id, vec, top_k))
+        exact_ids.append(set(ids))
+        exact_s.append(s)
+
+    from benchmark.run import distribution
+    report = {"exact": {"latency_ms": distribution([s * 1000 for s in exact_s])}}
+    for ef in ef_values:
+        recalls, latencies = [], []
+        for (user_id, session_id, vec), expected in zip(queries, exact_ids):
+            ids, s = timed_ids(conn, vector_index.search_sql("", ef, top_k), sql,
+                               scope_params(scope, user_id, session_id, vec, top_k))
+            latencies.append(s)
+            if expected:
+                recalls.append(len(expected.intersection(ids)) / len(expected))
+        plan = vector_index.explain_search(conn, sql, scope_params(scope, *queries[0], top_k), ef, top_k)
+        report[f"ef={ef}"] = {
+            "recall": round(float(np.mean(recalls)), 4) if recalls else None,
+            "recall_min": round(float(np.min(recalls)), 4) if recalls else None,
+            "latency_ms": distribution([s * 1000 for s in latencies]),
+            "uses_hnsw": vector_index.VECTOR_INDEX_NAME in plan,
+        }
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark recall / latency index HNSW")
+    parser.add_argument("--pg-url", default=seed_db.DEFAULT_PG_URL)
+    parser.add_argument("--ef-search", default="10,20,40,80,160",
+                        type=lambda s: [int(x) for x in s.split(",") if x.strip()])
+    parser.add_argument("--scope", default="all,user,session",
+                        type=lambda s: [x.strip() for x in s.split(",") if x.strip() in SCOPE_WHERE])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--users", type=int, default=50, help="như lúc seed (để chọn user / session)")
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=seed_db.EMBED_DIM)
+    parser.add_argument("--build", action="store_true", help="tạo index HNSW nếu chưa có")
+    parser.add_argument("--m", type=int, default=vector_index.HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=vector_index.HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out", default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    from benchmark.run import git_commit
+
+    conn = vector_index.connect(args.pg_url)
+    if args.build:
+        vector_index.create(conn, m=args.m, ef_construction=args.ef_construction)
+    problems = vector_index.verify(conn, m=args.m, ef_construction=args.ef_construction)
+    for p in problems:
+        print(f"[verify] {p}")
+    conn.autocommit = False
+
+    rng = np.random.default_rng(args.seed)
+    pairs = seed_db.bench_users(args.users, args.sessions)
+    random.seed(args.seed)
+    queries = [(*random.choice(pairs), v) for v in seed_db.random_vectors(rng, args.queries, args.dim)]
+
+    results = {}
+    for scope in args.scope:
+        print(f"→ scope={scope} ...", flush=True)
+        results[scope] = run_scope(conn, scope, queries, args.ef_search, args.top_k)
+    conn.close()
+
+    print(f"\n{'scope':<8} {'mode':<8} {'recall':>7} {'p50_ms':>7} {'p95_ms':>7} {'p99_ms':>7} {'hnsw':>5}")
+    for scope, report in results.items():
+        for mode, r in report.items():
+            lat = r["latency_ms"]
+            print(f"{scope:<8} {mode:<8} {r.get('recall', 1.0)!s:>7} {lat['p50']:>7.2f} {lat['p95']:>7.2f} "
+                  f"{lat['p99']:>7.2f} {str(r.get('uses_hnsw', False)):>5}")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"vector-index-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {"timestamp": datetime.now().isoformat(timespec="seconds"), "git_commit": git_commit(),
+                     "args": vars(args), "verify": problems},
+            "scopes": results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\nĐã lưu kết quả: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 # cache.py
+import os
 import redis
 import json
 import hashlib
 from datetime import timedelta
 
-r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    r = redis.Redis.from_url(REDIS_URL, decode_responses=True, socket_connect_timeout=0.2, socket_timeout=0.5)
+else:
+    r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True,
+                    socket_connect_timeout=0.2, socket_timeout=0.5)
 
 # Cache context (history/session)
 def get_context(session_id):
@@ -36,3 +42,39 @@ def clear_context_cache(session_id):
 
 def clear_rag_cache(question):
     r.delete(f"rag:{hash_question(question)}")
+
+# Cache response LLM (dùng chung giữa các gunicorn worker)
+RESPONSE_STATS_KEY = "resp:stats"
+
+# Trả về response nếu còn lượt hit (<= max_hits), đồng thời đếm hit/miss dùng chung
+_GET_RESPONSE_LUA = r.register_script("""
+local v = redis.call('HGET', KEYS[1], 'r')
+if not v then
+    redis.call('HINCRBY', KEYS[2], 'misses', 1)
+    return false
+end
+local h = redis.call('HINCRBY', KEYS[1], 'h', 1)
+if h > tonumber(ARGV[1]) then
+    redis.call('HINCRBY', KEYS[2], 'misses', 1)
+    return false
+end
+redis.call('HINCRBY', KEYS[2], 'hits', 1)
+return v
+""")
+
+def response_cache_key(user_id, session_id, message):
+    return f"resp:{user_id}:{session_id}:{hash_question(message)}"
+
+def get_response_cache(key, max_hits=1):
+    return _GET_RESPONSE_LUA(keys=[key, RESPONSE_STATS_KEY], args=[max_hits]) or None
+
+def save_response_cache(key, response, ttl_seconds=120):
+    pipe = r.pipeline()
+    pipe.hset(key, mapping={"r": response, "h": 0})
+    pipe.expire(key, ttl_seconds)
+    pipe.execute()
+
+def get_response_cache_stats():
+    stats = r.hgetall(RESPONSE_STATS_KEY)
+    return {"hits": int(stats.get("hits", 0)), "misses": int(stats.get("misses", 0))}
+
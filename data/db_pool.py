@@ -0,0 +1,257 @@
+"""
+Pool kết nối PostgreSQL dùng chung cho cả app (mỗi worker một pool).
+
+    from data import db_pool
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(...)
+        conn.commit()
+
+- Thread-safe, tối đa DB_POOL_MAX kết nối; hết chỗ thì chờ tối đa DB_POOL_TIMEOUT giây
+  rồi raise PoolTimeout
+- Kết nối idle quá DB_POOL_CHECK_IDLE giây được ping (SELECT 1) trước khi cho mượn; sống
+  quá DB_POOL_MAX_LIFETIME giây thì đóng và mở lại
+- Giống `with psycopg2.connect() as conn`: thoát khối bình thường → commit, có exception
+  → rollback; kết nối lỗi (đứt mạng, server restart) bị bỏ khỏi pool
+- prewarm() (gunicorn post_fork) mở sẵn DB_POOL_MIN kết nối
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+from utils import metrics
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DB_URL = os.getenv("POSTGRES_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "16"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+
+class PoolTimeout(PoolError):
+    """Không mượn được kết nối trong thời gian chờ."""
+
+
+class ConnectionPool:
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 check_idle=DB_POOL_CHECK_IDLE, max_lifetime=DB_POOL_MAX_LIFETIME,
+                 connect_timeout=DB_CONNECT_TIMEOUT, cursor_factory=RealDictCursor):
+        self.dsn = dsn
+        self.minconn = min(minconn, maxconn)
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.max_lifetime = max_lifetime
+        self.connect_timeout = connect_timeout
+        self.cursor_factory = cursor_factory
+        self.cond = threading.Condition()
+        self.idle = []          # [(conn, created_at, last_used)], dùng như stack (LIFO)
+        self.in_use = {}        # id(conn) -> created_at
+        self.opening = 0        # số kết nối đang mở (ngoài lock)
+        self.closed = False
+
+    # ---------------- PUBLIC ----------------
+    @contextmanager
+    def connection(self):
+        conn, created = self._acquire()
+        broken = False
+        try:
+            yield conn
+            if not conn.closed:
+                conn.commit()
+        except Exception as e:
+            broken = self._is_broken(conn, e)
+            if not broken:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            self._release(conn, created, broken)
+
+    def prewarm(self, n=None):
+        """Mở sẵn n kết nối (mặc định minconn). Trả về số kết nối mở được."""
+        n = self.minconn if n is None else n
+        opened = 0
+        while opened < n:
+            with self.cond:
+                if self.closed or len(self.idle) + len(self.in_use) + self.opening >= min(n, self.maxconn):
+                    break
+                self.opening += 1
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                logger.warning(f"[db_pool] Pre-warm lỗi: {e}")
+                with self.cond:
+                    self.opening -= 1
+                    self.cond.notify()
+                break
+            now = time.monotonic()
+            with self.cond:
+                self.opening -= 1
+                self.idle.append((conn, now, now))
+                self._update_gauges()
+                self.cond.notify()
+            opened += 1
+        return opened
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self._update_gauges()
+            self.cond.notify_all()
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self.cond:
+            return {"idle": len(self.idle), "in_use": len(self.in_use), "max": self.maxconn}
+
+    # ---------------- INTERNAL ----------------
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=self.cursor_factory,
+                                connect_timeout=self.connect_timeout)
+        metrics.DB_POOL_EVENTS.labels("created").inc()
+        return conn
+
+    def _close(self, conn, event="closed"):
+        metrics.DB_POOL_EVENTS.labels(event).inc()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _update_gauges(self):
+        # gọi trong self.cond
+        metrics.DB_POOL_CONNECTIONS.labels("idle").set(len(self.idle))
+        metrics.DB_POOL_CONNECTIONS.labels("in_use").set(len(self.in_use))
+
+    def _alive(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        try:
+            while True:
+                candidate = None
+                with self.cond:
+                    while True:
+                        if self.closed:
+                            raise PoolTimeout("Pool đã đóng")
+                        if self.idle:
+                            candidate = self.idle.pop()
+                            self.in_use[id(candidate[0])] = candidate[1]
+                            break
+                        if len(self.in_use) + self.opening < self.maxconn:
+                            self.opening += 1
+                            break
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            metrics.DB_POOL_EVENTS.labels("timeout").inc()
+                            raise PoolTimeout(
+                                f"Không mượn được kết nối PostgreSQL sau {self.timeout}s "
+                                f"(đang dùng {len(self.in_use)}/{self.maxconn})"
+                            )
+                        self.cond.wait(remaining)
+                    self._update_gauges()
+
+                if candidate is None:
+                    # Mở kết nối mới ngoài lock để không chặn thread khác
+                    try:
+                        conn = self._connect()
+                    except Exception:
+                        with self.cond:
+                            self.opening -= 1
+                            self.cond.notify()
+                        raise
+                    created = time.monotonic()
+                    with self.cond:
+                        self.opening -= 1
+                        self.in_use[id(conn)] = created
+                        self._update_gauges()
+                    return conn, created
+
+                conn, created, last_used = candidate
+                if time.monotonic() - created < self.max_lifetime and self._alive(conn, last_used):
+                    return conn, created
+                # Kết nối hỏng / quá tuổi: bỏ rồi thử lại (slot được trả lại ngay)
+                self._close(conn, "broken" if conn.closed else "recycled")
+                with self.cond:
+                    self.in_use.pop(id(conn), None)
+                    self._update_gauges()
+                    self.cond.notify()
+        finally:
+            metrics.DB_POOL_WAIT_SECONDS.observe(time.monotonic() - start)
+
+    @staticmethod
+    def _is_broken(conn, e):
+        return conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def _release(self, conn, created, broken=False):
+        if not broken and not conn.closed:
+            # Caller bắt exception bên trong khối with → transaction có thể còn mở / aborted
+            if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+        with self.cond:
+            self.in_use.pop(id(conn), None)
+            keep = not (broken or conn.closed or self.closed)
+            if keep:
+                self.idle.append((conn, created, time.monotonic()))
+            self._update_gauges()
+            self.cond.notify()
+        if not keep:
+            self._close(conn, "broken" if broken or conn.closed else "closed")
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Pool dùng chung trong process, tạo ở lần gọi đầu (sau fork, trong từng worker)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_URL)
+    return _pool
+
+def connection():
+    """Mượn một kết nối từ pool dùng chung (dùng với `with`)."""
+    return get_pool().connection()
+
+def prewarm():
+    try:
+        return get_pool().prewarm()
+    except Exception as e:
+        logger.warning(f"[db_pool] Pre-warm lỗi: {e}")
+        return 0
+
+def close():
+    if _pool is not None:
+        _pool.close()
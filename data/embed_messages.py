@@ -1,56 +1,228 @@
 import os
-from functools import lru_cache
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
 from typing import List
-from sentence_transformers import SentenceTransformer
 import numpy as np
-import torch
+from utils import metrics
+
+logger = logging.getLogger(__name__)
 
 MODEL_NAME = os.getenv("EMBED_MODEL", "intfloat/e5-small-v2")
 # Bạn có thể đổi model nhanh hơn như:
 # MODEL_NAME = "intfloat/e5-small-v2"
 # MODEL_NAME = "nomic-ai/nomic-embed-text-v1.5"
 
-class Embedder:
-    def __init__(self):
-        print(f"Loading embedding model: {MODEL_NAME}")
+# "torch" (SentenceTransformer) hoặc "onnx" (ONNX Runtime, int8 mặc định, xem data/embed_onnx.py)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+
+# Dùng chung model ở sidecar qua Unix domain socket (data/embed_sidecar.py)
+EMBED_SIDECAR = os.getenv("EMBED_SIDECAR", "0") == "1"
+
+# Gom các lời gọi embed một câu đồng thời thành một batch encode
+EMBED_BATCHING = os.getenv("EMBED_BATCHING", "1") == "1"
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "3"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+
+
+class EmbedDispatcher:
+    """
+    Micro-batching cho embedding câu đơn: submit() trả về Future, một thread nền gom các
+    câu tới trong cửa sổ EMBED_BATCH_WINDOW_MS (tối đa EMBED_MAX_BATCH câu, câu trùng chỉ
+    encode một lần) rồi gọi encode_fn một lần cho cả batch.
+
+    Khi rảnh (batch trước chỉ có 1 câu và hàng đợi trống) không chờ cửa sổ, nên request đơn
+    lẻ không bị cộng thêm latency; có tải thì các câu tới trong lúc đang encode tự gom vào batch sau.
+    """
+
+    def __init__(self, encode_fn, window_ms=EMBED_BATCH_WINDOW_MS, max_batch=EMBED_MAX_BATCH):
+        self.encode_fn = encode_fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_batch_size = 0
+
+    def submit(self, text: str) -> Future:
+        if self.thread is None:
+            self._start()
+        fut = Future()
+        self.queue.put((text, fut))
+        return fut
+
+    def embed(self, text: str):
+        return self.submit(text).result()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, daemon=True, name="embed-dispatcher")
+            self.thread.start()
+        metrics.watch_queue("embedding", self.queue.qsize)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if len(batch) == 1 and self.last_batch_size <= 1:
+            return batch
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self.last_batch_size = len(batch)
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            metrics.EMBEDDING_BATCH_SIZE.observe(len(texts))
+            try:
+                vectors = self.encode_fn(texts)
+            except Exception as e:
+                logger.error(f"[EmbedDispatcher] encode batch {len(texts)} câu lỗi: {e}")
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            index = {text: i for i, text in enumerate(texts)}
+            for text, fut in batch:
+                fut.set_result(vectors[index[text]])
+
+
+class TorchEncoder:
+    def __init__(self, model_name):
+        # Import ở đây để worker chạy backend onnx không phải nạp torch
+        import torch
+        from sentence_transformers import SentenceTransformer
         # Ưu tiên GPU nếu có
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = SentenceTransformer(MODEL_NAME, device=device)
-        print(f"Model loaded on {device}")
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = SentenceTransformer(model_name, device=self.device)
+        self.dim = self.model.get_sentence_embedding_dimension()
 
-    @lru_cache(maxsize=10000)
-    def embed_cached(self, text: str):
-        if not text or not text.strip():
-            return np.zeros((self.model.get_sentence_embedding_dimension(),), dtype=np.float32)
-        vec = self.model.encode(
-            text,
+    def encode(self, texts: List[str], batch_size: int = 32):
+        return self.model.encode(
+            texts,
             convert_to_numpy=True,
             normalize_embeddings=True,
+            batch_size=batch_size,
             show_progress_bar=False
         )
+
+
+def load_encoder(backend: str = EMBED_BACKEND):
+    print(f"Loading embedding model: {MODEL_NAME} (backend={backend})")
+    if backend == "onnx":
+        from data.embed_onnx import OnnxEncoder
+        encoder = OnnxEncoder(MODEL_NAME)
+        print(f"Model loaded from {encoder.path}")
+    else:
+        encoder = TorchEncoder(MODEL_NAME)
+        print(f"Model loaded on {encoder.device}")
+    return encoder
+
+
+class Embedder:
+    def __init__(self, backend: str = EMBED_BACKEND, sidecar: bool = EMBED_SIDECAR):
+        self.backend = backend
+        if sidecar:
+            # Model nằm ở sidecar (data/embed_sidecar.py), sidecar tự gom batch giữa các worker;
+            # chỉ nạp model trong process khi sidecar không dùng được
+            from data.embed_sidecar import SidecarEncoder
+            self.encoder = SidecarEncoder(lambda: load_encoder(backend))
+            self.dispatcher = None
+            print(f"Embedding qua sidecar: {self.encoder.client.path}")
+        else:
+            self.encoder = load_encoder(backend)
+            self.dispatcher = EmbedDispatcher(self._encode_many) if EMBED_BATCHING else None
+        # Cache embedding dùng chung giữa các worker (data/embed_store.py), mở khi cần lần đầu
+        self._store = None
+        self._store_lock = threading.Lock()
+
+    @property
+    def dim(self):
+        return self.encoder.dim
+
+    def _zeros(self):
+        return np.zeros((self.dim,), dtype=np.float32)
+
+    def _encode_many(self, texts: List[str]):
+        return self.encoder.encode(texts, batch_size=len(texts))
+
+    def _encode_one(self, text: str):
+        if self.dispatcher is not None:
+            return self.dispatcher.embed(text)
+        return self.encoder.encode([text])[0]
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._store_lock:
+                if self._store is None:
+                    from data.embed_store import open_store
+                    self._store = open_store(MODEL_NAME, self.dim)
+        return self._store
+
+    def lookup(self, text: str):
+        """Vector đã có trong cache embedding, chưa có thì None (không encode)."""
+        if not text or not text.strip():
+            return None
+        return self.store.get(text)
+
+    def embed_cached(self, text: str):
+        if not text or not text.strip():
+            return self._zeros()
+        vec = self.store.get(text)
+        if vec is None:
+            vec = self._encode_one(text)
+            self.store.put(text, vec)
         return vec
 
+    def embed_batch_cached(self, texts: List[str], batch_size: int = 32):
+        """
+        Như embed_batch nhưng qua cache embedding: text đã có (worker khác / lần nạp trước đã
+        encode) không encode lại, phần còn thiếu encode một lô rồi ghi vào cache.
+        Trả về ma trận (len(texts), dim) đúng thứ tự; text rỗng → vector 0.
+        """
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        missing = []
+        for i, text in enumerate(texts):
+            if not text or not text.strip():
+                continue
+            vec = self.store.get(text)
+            if vec is None:
+                missing.append(i)
+            else:
+                out[i] = vec
+        if missing:
+            encoded = self.encoder.encode([texts[i] for i in missing], batch_size=batch_size)
+            for i, vec in zip(missing, encoded):
+                out[i] = vec
+                self.store.put(texts[i], vec)
+        return out
+
     def embed(self, text: str):
         if not text or not text.strip():
-            return np.zeros((self.model.get_sentence_embedding_dimension(),), dtype=np.float32)
-        return self.model.encode(
-            text,
-            convert_to_numpy=True,
-            normalize_embeddings=True,
-            show_progress_bar=False
-        )
+            return self._zeros()
+        return self._encode_one(text)
 
     def embed_batch(self, texts: List[str], batch_size: int = 32):
         texts = [t.strip() for t in texts if t and t.strip()]
         if not texts:
             return np.array([], dtype=np.float32)
-        return self.model.encode(
-            texts,
-            convert_to_numpy=True,
-            normalize_embeddings=True,
-            batch_size=batch_size,
-            show_progress_bar=False
-        )
+        return self.encoder.encode(texts, batch_size=batch_size)
 embedder = Embedder()
 
 if __name__ == "__main__":
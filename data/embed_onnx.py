@@ -0,0 +1,224 @@
+"""
+Backend ONNX Runtime cho Embedder (EMBED_BACKEND=onnx).
+
+Model được export một lần ra EMBED_ONNX_DIR (fp32, thêm bản int8 quantize động), worker
+chỉ cần onnxruntime + tokenizers (tokenizer.json lưu lúc export), không import torch /
+transformers / sentence_transformers.
+Pooling giống SentenceTransformer của e5: mean pooling theo attention mask rồi chuẩn hóa L2.
+
+    pip install onnxruntime
+    python -m data.embed_onnx export               # fp32 + int8 (cần torch + transformers)
+    python -m data.embed_onnx parity               # cosine so với output torch, exit 1 nếu lệch
+    EMBED_BACKEND=onnx gunicorn --config gunicorn.conf.py
+
+Chưa export mà chạy EMBED_BACKEND=onnx thì worker đầu tiên tự export (có file lock để
+các worker khác chờ thay vì export trùng).
+"""
+import os
+import sys
+import json
+import fcntl
+import argparse
+import numpy as np
+
+MODEL_NAME = os.getenv("EMBED_MODEL", "intfloat/e5-small-v2")
+EMBED_ONNX_DIR = os.getenv(
+    "EMBED_ONNX_DIR", os.path.join(os.getenv("PROJECT_ROOT", "."), "models", "onnx")
+)
+EMBED_ONNX_QUANTIZE = os.getenv("EMBED_ONNX_QUANTIZE", "1") == "1"
+EMBED_ONNX_THREADS = int(os.getenv("EMBED_ONNX_THREADS", "0"))  # 0 = mặc định của onnxruntime
+EMBED_MAX_SEQ_LENGTH = int(os.getenv("EMBED_MAX_SEQ_LENGTH", "512"))
+
+FP32_FILE = "model.onnx"
+INT8_FILE = "model.int8.onnx"
+
+PARITY_SENTENCES = [
+    "Đồ ăn healthy là gì?",
+    "Tôi nên làm AI Engineer hay Data Engineer?",
+    "Mình là Hương, năm nay 24 tuổi, đang làm marketing.",
+    "Làm sao để bớt căng thẳng trước buổi phỏng vấn?",
+    "INFJ có hợp với công việc sáng tạo không?",
+    "Hôm nay trời mưa quá, mình chẳng muốn đi đâu.",
+    "Can you recommend a few books about personal growth?",
+    "query: cách quản lý thời gian hiệu quả cho sinh viên",
+    "ok",
+    "Mình vừa chia tay người yêu, cảm thấy rất trống rỗng và không biết nên bắt đầu lại từ đâu. "
+    "Bạn có thể cho mình vài lời khuyên để vượt qua giai đoạn này không?",
+]
+
+
+def model_dir(model_name, root=EMBED_ONNX_DIR):
+    return os.path.join(root, model_name.replace("/", "__"))
+
+
+def model_path(model_name, quantized=EMBED_ONNX_QUANTIZE, root=EMBED_ONNX_DIR):
+    return os.path.join(model_dir(model_name, root), INT8_FILE if quantized else FP32_FILE)
+
+
+# ---------------- EXPORT ----------------
+def export(model_name, out_dir=None, quantize=True, opset=17):
+    """Export transformer ra ONNX (trục batch / seq động), quantize int8 nếu cần. Trả về out_dir."""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    out_dir = out_dir or model_dir(model_name)
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.save_pretrained(out_dir)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    class _LastHidden(torch.nn.Module):
+        def __init__(self, m):
+            super().__init__()
+            self.m = m
+
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            return self.m(input_ids=input_ids, attention_mask=attention_mask,
+                          token_type_ids=token_type_ids).last_hidden_state
+
+    sample = tokenizer(["xin chào", "query: đồ ăn healthy là gì?"], padding=True, return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    dynamic_axes = {n: {0: "batch", 1: "seq"} for n in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "seq"}
+
+    fp32 = os.path.join(out_dir, FP32_FILE)
+    tmp = fp32 + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            _LastHidden(model), tuple(sample[n] for n in input_names), tmp,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False,
+        )
+    os.replace(tmp, fp32)
+    print(f"[embed_onnx] Đã export {model_name} → {fp32}")
+
+    if quantize:
+        quantize_int8(out_dir)
+    return out_dir
+
+
+def quantize_int8(out_dir):
+    """Quantize động int8 từ bản fp32 đã export trong out_dir (chỉ cần onnxruntime)."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    fp32 = os.path.join(out_dir, FP32_FILE)
+    int8 = os.path.join(out_dir, INT8_FILE)
+    quantize_dynamic(fp32, int8 + ".tmp", weight_type=QuantType.QInt8)
+    os.replace(int8 + ".tmp", int8)
+    print(f"[embed_onnx] Đã quantize int8 → {int8}")
+
+
+def ensure_exported(model_name, quantized=EMBED_ONNX_QUANTIZE, root=EMBED_ONNX_DIR):
+    path = model_path(model_name, quantized, root)
+    if os.path.exists(path):
+        return path
+    os.makedirs(root, exist_ok=True)
+    lock_path = os.path.join(root, model_name.replace("/", "__") + ".lock")
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            out_dir = model_dir(model_name, root)
+            if quantized and os.path.exists(os.path.join(out_dir, FP32_FILE)):
+                # Chỉ thiếu bản int8: quantize từ fp32 có sẵn, không export lại (cần torch)
+                quantize_int8(out_dir)
+            else:
+                export(model_name, out_dir, quantize=quantized)
+    return path
+
+
+# ---------------- RUNTIME ----------------
+def load_tokenizer(directory, max_length=EMBED_MAX_SEQ_LENGTH):
+    """Tokenizer nhanh (thư viện tokenizers) với padding / truncation như tokenizer của transformers."""
+    from tokenizers import Tokenizer
+
+    tokenizer = Tokenizer.from_file(os.path.join(directory, "tokenizer.json"))
+    with open(os.path.join(directory, "tokenizer_config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    pad = config.get("pad_token") or "[PAD]"
+    pad = pad["content"] if isinstance(pad, dict) else pad
+    max_length = min(max_length, int(config.get("model_max_length") or max_length))
+    tokenizer.enable_padding(pad_id=tokenizer.token_to_id(pad), pad_token=pad)
+    tokenizer.enable_truncation(max_length=max_length)
+    return tokenizer
+
+
+class OnnxEncoder:
+    def __init__(self, model_name, quantized=EMBED_ONNX_QUANTIZE, max_seq_length=EMBED_MAX_SEQ_LENGTH,
+                 threads=EMBED_ONNX_THREADS):
+        import onnxruntime as ort
+
+        path = ensure_exported(model_name, quantized)
+        self.tokenizer = load_tokenizer(os.path.dirname(path), max_seq_length)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.dim = int(self.session.get_outputs()[0].shape[-1])
+        self.path = path
+
+    def _encode_chunk(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {n: inputs[n] for n in self.input_names})[0]
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled / np.clip(norms, 1e-12, None)
+
+    def encode(self, texts, batch_size=32):
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        # Gom câu cùng độ dài vào một batch để giảm padding (như SentenceTransformer)
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i in range(0, len(texts), batch_size):
+            idx = order[i:i + batch_size]
+            out[idx] = self._encode_chunk([texts[j] for j in idx])
+        return out
+
+
+# ---------------- PARITY ----------------
+def parity(model_name, sentences=PARITY_SENTENCES, quantized=True):
+    """Cosine từng câu giữa output ONNX và SentenceTransformer (torch). Trả về mảng cosine."""
+    from sentence_transformers import SentenceTransformer
+    reference = SentenceTransformer(model_name, device="cpu").encode(
+        sentences, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+    )
+    onnx = OnnxEncoder(model_name, quantized=quantized).encode(sentences)
+    return np.sum(reference * onnx, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export / kiểm tra backend ONNX của Embedder")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--no-quantize", action="store_true", help="export: chỉ fp32")
+    parser.add_argument("--min-cosine", type=float, default=None,
+                        help="parity: ngưỡng cosine nhỏ nhất (mặc định 0.9999 fp32, 0.98 int8)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.model, quantize=not args.no_quantize)
+        return 0
+
+    failed = False
+    variants = [False] if args.no_quantize else [False, True]
+    for quantized in variants:
+        threshold = args.min_cosine or (0.98 if quantized else 0.9999)
+        cos = parity(args.model, quantized=quantized)
+        name = "int8" if quantized else "fp32"
+        ok = cos.min() >= threshold
+        failed |= not ok
+        print(f"{name}: cosine min={cos.min():.5f} mean={cos.mean():.5f} (ngưỡng {threshold}) "
+              f"{'OK' if ok else 'FAIL'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
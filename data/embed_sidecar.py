@@ -0,0 +1,364 @@
+"""
+Embedding sidecar: một process giữ model, mọi gunicorn worker gọi qua Unix domain socket.
+
+Bật bằng EMBED_SIDECAR=1. gunicorn.conf.py tự khởi động sidecar trong on_starting (chờ sẵn
+sàng rồi mới fork worker) và dừng trong on_exit; EMBED_SIDECAR_SPAWN=0 nếu chạy sidecar
+bằng service riêng:
+
+    python -m data.embed_sidecar serve --socket /path/embed.sock
+
+Mọi request đi vào EmbedDispatcher của sidecar nên câu từ nhiều worker được gom chung một
+batch encode. Worker không nạp model, trừ khi sidecar chắc chắn không chạy: bị từ chối kết nối
+(socket không có / không ai listen) EMBED_SIDECAR_FALLBACK_AFTER lần liên tiếp thì Embedder nạp
+model trong process và thử lại sidecar sau EMBED_SIDECAR_RETRY_INTERVAL giây. Sidecar chậm
+(timeout) chỉ mở circuit breaker: encode raise SidecarUnavailable ngay, thử lại sau back-off tăng
+gấp đôi tới EMBED_SIDECAR_MAX_BACKOFF, không để mọi worker cùng nạp model (tăng vọt bộ nhớ).
+
+Giao thức (little-endian), mỗi frame có tiền tố độ dài uint32:
+    request : u8 version | u8 op | u32 count | count × (u32 len | utf-8 bytes)
+    response: u8 version | u8 status | u32 count | u32 dim | count×dim float32
+              (status lỗi: thay payload bằng thông báo utf-8)
+"""
+import os
+import sys
+import time
+import struct
+import signal
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+import socketserver
+import numpy as np
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+EMBED_SIDECAR_SOCKET = os.getenv(
+    "EMBED_SIDECAR_SOCKET", os.path.join(os.getenv("PROJECT_ROOT", "."), "logs", "embed.sock")
+)
+EMBED_SIDECAR_TIMEOUT = float(os.getenv("EMBED_SIDECAR_TIMEOUT", "5"))
+EMBED_SIDECAR_RETRY_INTERVAL = float(os.getenv("EMBED_SIDECAR_RETRY_INTERVAL", "10"))
+EMBED_SIDECAR_MAX_BACKOFF = float(os.getenv("EMBED_SIDECAR_MAX_BACKOFF", "60"))
+EMBED_SIDECAR_FALLBACK_AFTER = int(os.getenv("EMBED_SIDECAR_FALLBACK_AFTER", "3"))
+EMBED_SIDECAR_STARTUP_TIMEOUT = float(os.getenv("EMBED_SIDECAR_STARTUP_TIMEOUT", "180"))
+
+VERSION = 1
+OP_PING = 0
+OP_EMBED = 1
+STATUS_OK = 0
+STATUS_ERROR = 1
+MAX_FRAME = 64 * 1024 * 1024
+
+_LEN = struct.Struct("<I")
+_REQ = struct.Struct("<BBI")
+_RESP = struct.Struct("<BBII")
+
+
+class SidecarUnavailable(Exception):
+    """Không kết nối / giao tiếp được với sidecar. refused: sidecar không chạy (socket không có / bị từ chối)."""
+
+    def __init__(self, message, refused=False):
+        super().__init__(message)
+        self.refused = refused
+
+
+class SidecarError(Exception):
+    """Sidecar nhận request nhưng encode lỗi."""
+
+
+# ---------------- PROTOCOL ----------------
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        k = sock.recv_into(view[pos:])
+        if k == 0:
+            raise EOFError("socket closed")
+        pos += k
+    return buf
+
+def read_frame(sock):
+    (n,) = _LEN.unpack(_recv_exact(sock, _LEN.size))
+    if n > MAX_FRAME:
+        raise ValueError(f"frame quá lớn: {n} bytes")
+    return _recv_exact(sock, n)
+
+def _frame(body):
+    return _LEN.pack(len(body)) + body
+
+def encode_request(op, texts=()):
+    parts = [_REQ.pack(VERSION, op, len(texts))]
+    for text in texts:
+        data = text.encode("utf-8")
+        parts.append(_LEN.pack(len(data)))
+        parts.append(data)
+    return _frame(b"".join(parts))
+
+def decode_request(body):
+    version, op, count = _REQ.unpack_from(body)
+    if version != VERSION:
+        raise ValueError(f"protocol version {version} không hỗ trợ")
+    offset = _REQ.size
+    texts = []
+    for _ in range(count):
+        (n,) = _LEN.unpack_from(body, offset)
+        offset += _LEN.size
+        texts.append(bytes(body[offset:offset + n]).decode("utf-8"))
+        offset += n
+    return op, texts
+
+def encode_response(vectors, dim):
+    arr = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, dim)
+    return _frame(_RESP.pack(VERSION, STATUS_OK, arr.shape[0], dim) + arr.tobytes())
+
+def encode_error(message):
+    return _frame(_RESP.pack(VERSION, STATUS_ERROR, 0, 0) + message.encode("utf-8"))
+
+def decode_response(body):
+    """Trả về (vectors (count, dim) float32, dim)."""
+    _, status, count, dim = _RESP.unpack_from(body)
+    if status != STATUS_OK:
+        raise SidecarError(bytes(body[_RESP.size:]).decode("utf-8", "replace"))
+    vectors = np.frombuffer(body, dtype=np.float32, count=count * dim, offset=_RESP.size)
+    return vectors.reshape(count, dim), dim
+
+
+# ---------------- CLIENT ----------------
+class SidecarClient:
+    """Mỗi thread một kết nối giữ lâu; kết nối hỏng (sidecar restart) thì nối lại một lần."""
+
+    def __init__(self, path=EMBED_SIDECAR_SOCKET, timeout=EMBED_SIDECAR_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _sock(self):
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self.local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self.local, "sock", None)
+        self.local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def request(self, op, texts=()):
+        payload = encode_request(op, texts)
+        for attempt in range(2):
+            try:
+                sock = self._sock()
+                sock.sendall(payload)
+                return decode_response(read_frame(sock))
+            except socket.timeout as e:
+                # Sidecar chậm: gửi lại chỉ chờ thêm một timeout nữa
+                self._close()
+                raise SidecarUnavailable(f"timeout sau {self.timeout}s") from e
+            except (ConnectionRefusedError, FileNotFoundError) as e:
+                self._close()
+                if attempt:
+                    raise SidecarUnavailable(f"{type(e).__name__}: {e}", refused=True) from e
+            except (OSError, EOFError, ValueError, struct.error) as e:
+                # Kết nối cũ hỏng (sidecar restart): nối lại một lần
+                self._close()
+                if attempt:
+                    raise SidecarUnavailable(f"{type(e).__name__}: {e}") from e
+
+    def ping(self):
+        """Trả về số chiều embedding của sidecar."""
+        return self.request(OP_PING)[1]
+
+    def embed(self, texts):
+        return self.request(OP_EMBED, texts)[0]
+
+
+class SidecarEncoder:
+    """
+    Encoder cho Embedder khi EMBED_SIDECAR=1: encode qua sidecar. Model trong process
+    (local_factory) chỉ được nạp khi sidecar từ chối kết nối fallback_after lần liên tiếp;
+    lỗi khác (timeout, kết nối đứt) mở circuit breaker với back-off tăng dần.
+    """
+
+    def __init__(self, local_factory, client=None, retry_interval=EMBED_SIDECAR_RETRY_INTERVAL,
+                 max_backoff=EMBED_SIDECAR_MAX_BACKOFF, fallback_after=EMBED_SIDECAR_FALLBACK_AFTER):
+        self.client = client or SidecarClient()
+        self.local_factory = local_factory
+        self.retry_interval = retry_interval
+        self.max_backoff = max_backoff
+        self.fallback_after = fallback_after
+        self.local = None
+        self.lock = threading.Lock()
+        self.down_until = 0.0
+        self.refused = 0        # số lần liên tiếp bị từ chối kết nối
+        self.failures = 0       # số lần liên tiếp lỗi khác (timeout, ...)
+        self._dim = None
+
+    @property
+    def dim(self):
+        if self._dim is None:
+            if time.monotonic() >= self.down_until:
+                try:
+                    self._dim = self.client.ping()
+                    self._recovered()
+                except SidecarUnavailable as e:
+                    self._failed(e)
+            if self._dim is None:
+                self._dim = self._fallback().dim
+        return self._dim
+
+    def _recovered(self):
+        self.refused = self.failures = 0
+
+    def _failed(self, e):
+        now = time.monotonic()
+        if e.refused:
+            self.failures = 0
+            self.refused += 1
+            if self.refused < self.fallback_after:
+                # Bị từ chối kết nối trả lỗi ngay, không tốn timeout: request sau thử lại luôn
+                return
+            delay = self.retry_interval
+        else:
+            self.refused = 0
+            self.failures += 1
+            delay = min(self.retry_interval * 2 ** (self.failures - 1), self.max_backoff)
+        if now >= self.down_until:
+            logger.warning(f"[embed_sidecar] Sidecar không dùng được ({e}), thử lại sau {delay:.0f}s")
+        self.down_until = now + delay
+
+    def _fallback(self):
+        """Model trong process nếu sidecar chắc chắn không chạy (hoặc đã nạp sẵn); không thì raise."""
+        if self.local is None and self.refused < self.fallback_after:
+            metrics.EMBED_SIDECAR_REQUESTS.labels("unavailable").inc()
+            raise SidecarUnavailable(
+                f"sidecar không trả lời, thử lại sau {max(0.0, self.down_until - time.monotonic()):.0f}s")
+        metrics.EMBED_SIDECAR_REQUESTS.labels("fallback").inc()
+        return self._local()
+
+    def _local(self):
+        if self.local is None:
+            with self.lock:
+                if self.local is None:
+                    logger.warning("[embed_sidecar] Sidecar không chạy, nạp model trong process")
+                    self.local = self.local_factory()
+        return self.local
+
+    def encode(self, texts, batch_size=32):
+        if time.monotonic() >= self.down_until:
+            try:
+                vectors = self.client.embed(list(texts))
+                self._recovered()
+                metrics.EMBED_SIDECAR_REQUESTS.labels("ok").inc()
+                return vectors
+            except SidecarUnavailable as e:
+                self._failed(e)
+        return self._fallback().encode(texts, batch_size=batch_size)
+
+
+# ---------------- SERVER ----------------
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        embedder, dispatcher = self.server.embedder, self.server.dispatcher
+        sock = self.request
+        while True:
+            try:
+                body = read_frame(sock)
+            except (EOFError, OSError, ValueError):
+                return
+            try:
+                op, texts = decode_request(body)
+                if op == OP_PING:
+                    response = encode_response(np.zeros((0, embedder.dim)), embedder.dim)
+                elif op == OP_EMBED:
+                    # Từng câu vào dispatcher chung → gom batch với request của worker khác
+                    futures = [dispatcher.submit(t) for t in texts]
+                    vectors = [f.result() for f in futures]
+                    response = encode_response(np.stack(vectors) if vectors else np.zeros((0, embedder.dim)),
+                                               embedder.dim)
+                else:
+                    response = encode_error(f"op {op} không hỗ trợ")
+            except Exception as e:
+                logger.error(f"[embed_sidecar] Lỗi xử lý request: {e}")
+                response = encode_error(f"{type(e).__name__}: {e}")
+            try:
+                sock.sendall(response)
+            except OSError:
+                return
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path=EMBED_SIDECAR_SOCKET):
+    # Sidecar luôn dùng model trong process của chính nó
+    os.environ["EMBED_SIDECAR"] = "0"
+    from data.embed_messages import embedder, EmbedDispatcher
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    server = _Server(path, _Handler)
+    server.embedder = embedder
+    server.dispatcher = embedder.dispatcher or EmbedDispatcher(embedder._encode_many)
+
+    def _stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, _stop)
+    print(f"[embed_sidecar] Listening on {path} (dim={embedder.dim}, backend={embedder.backend})", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def wait_ready(path=EMBED_SIDECAR_SOCKET, timeout=EMBED_SIDECAR_STARTUP_TIMEOUT, proc=None):
+    """Chờ sidecar trả lời ping. Trả về dim, hết timeout hoặc process chết thì raise."""
+    client = SidecarClient(path, timeout=2)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return client.ping()
+        except SidecarUnavailable:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"embed sidecar đã thoát (exit {proc.returncode})")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"embed sidecar chưa sẵn sàng sau {timeout}s")
+            time.sleep(0.2)
+
+
+def spawn(path=EMBED_SIDECAR_SOCKET, cwd=None):
+    """Chạy sidecar ở process con (dùng trong gunicorn on_starting)."""
+    return subprocess.Popen([sys.executable, "-m", "data.embed_sidecar", "serve", "--socket", path], cwd=cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding sidecar qua Unix domain socket")
+    parser.add_argument("command", choices=["serve", "ping"])
+    parser.add_argument("--socket", default=EMBED_SIDECAR_SOCKET)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "serve":
+        serve(args.socket)
+    else:
+        print(f"dim={SidecarClient(args.socket).ping()}")
+
+
+if __name__ == "__main__":
+    main()
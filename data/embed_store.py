@@ -0,0 +1,194 @@
+"""
+Cache embedding bền vững, dùng chung giữa các worker và qua các lần restart.
+
+Một file memory-mapped trong EMBED_STORE_DIR (mỗi model / dim một file) chứa bảng băm địa chỉ mở cố định
+EMBED_STORE_CAPACITY slot; key = blake2b(model, text đã chuẩn hóa NFC + khoảng trắng),
+vector lưu float16. Mọi worker map cùng một file nên dùng chung page cache của OS.
+- Đọc không khóa: mỗi slot có seq kiểu seqlock (lẻ = đang ghi), đọc lại nếu seq đổi
+- Ghi (chỉ khi miss) khóa bằng flock trên file .lock
+- Eviction: key chỉ được đặt trong EMBED_STORE_PROBE slot liền nhau tính từ hash; đầy thì
+  thay slot có tick (phút truy cập gần nhất) nhỏ nhất trong cửa sổ đó → LRU xấp xỉ, kích
+  thước file cố định
+- Header lệch (model / dim / capacity khác) thì file được tạo lại
+"""
+import os
+import time
+import fcntl
+import struct
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+import numpy as np
+from cachetools import LRUCache
+from data.semantic_cache import normalize_whitespace
+
+logger = logging.getLogger(__name__)
+
+EMBED_STORE = os.getenv("EMBED_STORE", "1") == "1"
+EMBED_STORE_DIR = os.getenv(
+    "EMBED_STORE_DIR", os.path.join(os.getenv("PROJECT_ROOT", "."), "cache")
+)
+EMBED_STORE_CAPACITY = int(os.getenv("EMBED_STORE_CAPACITY", "100000"))
+EMBED_STORE_PROBE = int(os.getenv("EMBED_STORE_PROBE", "8"))
+
+_MAGIC = b"EMBS"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIIQ16s")  # magic, version, dim, capacity, model digest
+_HEADER_SIZE = 64
+
+
+def _slot_dtype(dim):
+    return np.dtype([
+        ("seq", "<u4"), ("tick", "<u4"), ("k0", "<u8"), ("k1", "<u8"), ("vec", "<f2", (dim,)),
+    ])
+
+
+def _now_tick():
+    return int(time.time() // 60) & 0xFFFFFFFF
+
+
+class MmapEmbeddingStore:
+    def __init__(self, path, dim, model_name, capacity=EMBED_STORE_CAPACITY, probe=EMBED_STORE_PROBE):
+        self.path = path
+        self.dim = dim
+        self.model_name = model_name
+        self.capacity = capacity
+        self.probe = min(probe, capacity)
+        self.model_digest = hashlib.blake2b(model_name.encode("utf-8"), digest_size=16).digest()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock_file = open(path + ".lock", "a+")
+        with self._file_lock():
+            self._open()
+
+    # ---------------- FILE ----------------
+    @contextmanager
+    def _file_lock(self):
+        """Khóa ghi: lock thread trong process + flock giữa các process."""
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _expected_header(self):
+        return _HEADER.pack(_MAGIC, _VERSION, self.dim, self.capacity, self.model_digest)
+
+    def _open(self):
+        dtype = _slot_dtype(self.dim)
+        size = _HEADER_SIZE + dtype.itemsize * self.capacity
+        header = self._expected_header()
+        valid = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            with open(self.path, "rb") as f:
+                valid = f.read(len(header)) == header
+        if not valid:
+            # File mới (hoặc model / dim / capacity đổi): tạo file thưa rồi thay nguyên tử
+            tmp = f"{self.path}.tmp-{os.getpid()}"
+            with open(tmp, "wb") as f:
+                f.write(header.ljust(_HEADER_SIZE, b"\0"))
+                f.truncate(size)
+            os.replace(tmp, self.path)
+            logger.info(f"[embed_store] Tạo {self.path} ({self.capacity} slot, {size / 2**20:.0f}MB)")
+        self.slots = np.memmap(self.path, dtype=dtype, mode="r+", offset=_HEADER_SIZE, shape=(self.capacity,))
+        self.seq = self.slots["seq"]
+        self.tick = self.slots["tick"]
+        self.k0 = self.slots["k0"]
+        self.k1 = self.slots["k1"]
+        self.vec = self.slots["vec"]
+
+    # ---------------- KEY ----------------
+    def key(self, text):
+        digest = hashlib.blake2b(
+            self.model_digest + normalize_whitespace(text).encode("utf-8"), digest_size=16
+        ).digest()
+        k0 = int.from_bytes(digest[:8], "little") or 1  # k0 = 0 đánh dấu slot trống
+        return k0, int.from_bytes(digest[8:], "little")
+
+    def _window(self, k0):
+        base = k0 % self.capacity
+        return [(base + i) % self.capacity for i in range(self.probe)]
+
+    # ---------------- PUBLIC ----------------
+    def get(self, text):
+        k0, k1 = self.key(text)
+        for idx in self._window(k0):
+            for _ in range(3):
+                s1 = int(self.seq[idx])
+                if s1 & 1:
+                    continue  # đang được ghi
+                slot_k0 = int(self.k0[idx])
+                if slot_k0 == 0:
+                    return None  # không bao giờ xóa slot → gặp slot trống là chưa có key
+                if slot_k0 != k0 or int(self.k1[idx]) != k1:
+                    break
+                vec = np.array(self.vec[idx], dtype=np.float32)
+                if int(self.seq[idx]) != s1:
+                    continue
+                tick = _now_tick()
+                if self.tick[idx] != tick:
+                    self.tick[idx] = tick
+                return vec
+        return None
+
+    def put(self, text, vec):
+        k0, k1 = self.key(text)
+        vec = np.asarray(vec, dtype=np.float16).reshape(self.dim)
+        with self._file_lock():
+            window = self._window(k0)
+            target = None
+            for idx in window:
+                slot_k0 = int(self.k0[idx])
+                if slot_k0 == k0 and int(self.k1[idx]) == k1:
+                    return
+                if slot_k0 == 0:
+                    target = idx
+                    break
+            if target is None:
+                target = min(window, key=lambda i: int(self.tick[i]))
+            # seq lẻ trong lúc ghi (kể cả khi process trước chết giữa chừng để lại seq lẻ)
+            start = int(self.seq[target]) | 1
+            self.seq[target] = start
+            self.vec[target] = vec
+            self.k1[target] = k1
+            self.k0[target] = k0
+            self.tick[target] = _now_tick()
+            self.seq[target] = (start + 1) & 0xFFFFFFFF
+
+    def stats(self):
+        used = int(np.count_nonzero(self.k0))
+        return {"path": self.path, "capacity": self.capacity, "used": used, "dim": self.dim}
+
+
+class LocalEmbeddingCache:
+    """Cache trong process (khi tắt EMBED_STORE hoặc không mở được file)."""
+
+    def __init__(self, maxsize=10000):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def get(self, text):
+        with self.lock:
+            return self.cache.get(normalize_whitespace(text))
+
+    def put(self, text, vec):
+        with self.lock:
+            self.cache[normalize_whitespace(text)] = vec
+
+    def stats(self):
+        with self.lock:
+            return {"capacity": self.cache.maxsize, "used": len(self.cache)}
+
+
+def open_store(model_name, dim):
+    """Store mmap cho (model, dim); lỗi (quyền ghi, đĩa...) thì dùng cache trong process."""
+    if EMBED_STORE:
+        slug = model_name.strip("/").replace("/", "__")
+        path = os.path.join(EMBED_STORE_DIR, f"embeddings-{slug}-{dim}.f16")
+        try:
+            return MmapEmbeddingStore(path, dim, model_name)
+        except Exception as e:
+            logger.error(f"[embed_store] Không mở được {path}, dùng cache trong process: {e}")
+    return LocalEmbeddingCache()
@@ -1,44 +1,14 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import os
 from dotenv import load_dotenv
-from cachetools import LRUCache, TTLCache
-from contextlib import contextmanager
+from cachetools import TTLCache
 import numpy as np
 from data.embed_messages import embedder
+from data import db_pool, vector_index
+from data.session_vectors import SessionVectorIndex, SESSION_VECTORS
+from data.invalidation import HiddenSessions
+from data.lexical_index import LexicalIndex, load_vectorizer, rrf_fuse, HYBRID_SEARCH, HYBRID_CANDIDATES
+from utils import tracing, metrics, request_scope
 
 load_dotenv()
-class PostgresPool:
-    def __init__(self, dsn: str, maxconn: int = 10):
-        self.dsn = dsn
-        self.maxconn = maxconn
-        self.pool = []
-        self.used = set()
-
-    def _create_conn(self):
-        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
-
-    @contextmanager
-    def get_conn(self):
-        conn = None
-        try:
-            if self.pool:
-                conn = self.pool.pop()
-            else:
-                conn = self._create_conn()
-            self.used.add(conn)
-            yield conn
-        finally:
-            if conn:
-                self.used.discard(conn)
-                self.pool.append(conn)
-
-
-DB_URL = os.getenv("POSTGRES_URL")
-pg_pool = PostgresPool(DB_URL, maxconn=15)
-
-short_cache = {}
-embedding_cache = LRUCache(maxsize=5000)
 
 SQL_LATEST_HISTORY = """
 SELECT message, reply, created_at
@@ -51,7 +21,7 @@ LIMIT %s
 """
 
 SQL_VECTOR_SEARCH = """
-SELECT id, message, reply, embedding_vector <=> %s::vector AS distance
+SELECT id, message, reply, created_at, embedding_vector <=> %s::vector AS distance
 FROM whoisme.messages
 WHERE user_id = %s
     AND session_id = %s
@@ -60,6 +30,26 @@ ORDER BY distance ASC
 LIMIT %s
 """
 
+SQL_SESSION_VECTORS = """
+SELECT id, message, reply, created_at, embedding_vector::real[] AS vec
+FROM whoisme.messages
+WHERE user_id = %s
+    AND session_id = %s
+    AND is_deleted = FALSE
+    AND embedding_vector IS NOT NULL
+ORDER BY created_at DESC
+LIMIT %s
+"""
+
+SQL_USER_MESSAGES = """
+SELECT id, session_id, message, reply, created_at
+FROM whoisme.messages
+WHERE user_id = %s
+    AND is_deleted = FALSE
+ORDER BY created_at DESC
+LIMIT %s
+"""
+
 SQL_SESSION_HISTORY = """
 SELECT id, message, reply, created_at
 FROM whoisme.messages
@@ -70,26 +60,30 @@ ORDER BY created_at ASC
 """
 
 def get_embedding(text: str):
-    if text in embedding_cache:
-        return embedding_cache[text]
+    with tracing.span("embedding", **{"embedding.chars": len(text or "")}) as span:
+        vec = embedder.lookup(text)
+        if vec is not None:
+            span.set_attribute("embedding.cached", True)
+            metrics.cache_result("embedding", True)
+        else:
+            span.set_attribute("embedding.cached", False)
+            metrics.cache_result("embedding", False)
+            with metrics.EMBEDDING_SECONDS.labels("query").time():
+                vec = embedder.embed_cached(text)
+        request_scope.put(("embedding", text), vec)
+        return vec
 
-    vec = embedder.embed_cached(text)
-    embedding_cache[text] = vec
-    return vec
 
+def request_embedding(text: str):
+    """Vector của text đã tính bằng get_embedding trong request hiện tại, chưa có thì None."""
+    return request_scope.get(("embedding", text))
 
-def get_latest_history(user_id: str, session_id: str, limit: int = 20):
-    cache_key = f"{user_id}:{session_id}:{limit}"
-
-    if cache_key in short_cache:
-        return short_cache[cache_key]
 
-    with pg_pool.get_conn() as conn:
-        with conn.cursor() as cur:
+def get_latest_history(user_id: str, session_id: str, limit: int = 20):
+    with tracing.span("db.latest_history", **{"db.limit": limit}), db_pool.connection() as conn:
+        with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("latest_history").time():
             cur.execute(SQL_LATEST_HISTORY, (user_id, session_id, limit))
             rows = cur.fetchall()
-
-    short_cache[cache_key] = rows
     return rows
 
 
@@ -105,9 +99,9 @@ def rag_search(user_id: str, session_id: str, query: str, limit: int = 5):
     query_vec = get_embedding(query)
     vec_str = _vec_to_pgvector(query_vec)
 
-    with pg_pool.get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(SQL_VECTOR_SEARCH, (vec_str, user_id, session_id, limit))
+    with tracing.span("db.vector_search", **{"db.top_k": limit}), db_pool.connection() as conn:
+        with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("vector_search").time():
+            cur.execute(vector_index.search_sql(SQL_VECTOR_SEARCH, top_k=limit), (vec_str, user_id, session_id, limit))
             rows = cur.fetchall()
 
     if not rows or (rows and rows[0].get("distance", 1.0) > 0.40):
@@ -136,8 +130,8 @@ def get_context_messages(user_id: str, session_id: str, query: str = "", limit:
 
 def get_full_history(user_id: str, session_id: str):
     try:
-        with pg_pool.get_conn() as conn:
-            with conn.cursor() as cur:
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("session_history").time():
                 cur.execute(SQL_SESSION_HISTORY, (str(user_id), str(session_id)))
                 rows = cur.fetchall()
 
@@ -159,17 +153,84 @@ def get_latest_messages(user_id, session_id, limit=20):
     return full[-limit:]
 
 
-def get_long_term_context(user_id, query, session_id, top_k=5, debug=False):
-    vec = get_embedding(query)
+def _load_session_vectors(user_id, session_id, limit):
+    with tracing.span("db.session_vectors", **{"db.limit": limit}) as span, db_pool.connection() as conn:
+        with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("session_vectors").time():
+            cur.execute(SQL_SESSION_VECTORS, (user_id, session_id, limit))
+            rows = cur.fetchall()
+        span.set_attribute("db.rows", len(rows))
+    return rows
+
+# Vector của các session đang hoạt động giữ trong process (data/session_vectors.py)
+SESSION_VECTOR_INDEX = SessionVectorIndex(_load_session_vectors)
+# Mốc /v1/hidden dùng chung giữa các worker (data/invalidation.py)
+HIDDEN_SESSIONS = HiddenSessions()
+
+
+def _load_user_messages(user_id, limit):
+    with tracing.span("db.user_messages", **{"db.limit": limit}) as span, db_pool.connection() as conn:
+        with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("user_messages").time():
+            cur.execute(SQL_USER_MESSAGES, (user_id, limit))
+            rows = cur.fetchall()
+        span.set_attribute("db.rows", len(rows))
+    return rows
+
+# Ma trận TF-IDF (CSR) theo user cho hybrid search (data/lexical_index.py)
+LEXICAL_INDEX = LexicalIndex(_load_user_messages, load_vectorizer() if HYBRID_SEARCH else None)
+
+
+def expire_hidden(user_id):
+    """Bỏ entry trong process của các session user đã ẩn ở worker khác (trước khi tìm kiếm)."""
+    with tracing.span("context.hidden") as span:
+        stamps = HIDDEN_SESSIONS.stamps(user_id)
+        if stamps:
+            span.set_attribute("hidden.dropped", SESSION_VECTOR_INDEX.expire_hidden(user_id, stamps)
+                               + LEXICAL_INDEX.expire_hidden(user_id, stamps))
+
+
+def _dense_search(user_id, session_id, vec, top_k, ef_search):
+    if SESSION_VECTORS and session_id:
+        with tracing.span("context.session_vectors", **{"db.top_k": top_k}) as span:
+            rows = SESSION_VECTOR_INDEX.search(user_id, session_id, vec, top_k)
+            span.set_attribute("session_vectors.local", rows is not None)
+        if rows is not None:
+            return rows
+
     vec_str = _vec_to_pgvector(vec)
 
-    with pg_pool.get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(SQL_VECTOR_SEARCH, (vec_str, user_id, session_id, top_k))
+    with tracing.span("db.vector_search", **{"db.top_k": top_k}) as span, db_pool.connection() as conn:
+        with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("vector_search").time():
+            cur.execute(vector_index.search_sql(SQL_VECTOR_SEARCH, ef_search, top_k), (vec_str, user_id, session_id, top_k))
             rows = cur.fetchall()
+        span.set_attribute("db.rows", len(rows))
+    return rows
+
+
+def get_long_term_context(user_id, query, session_id, top_k=5, debug=False, ef_search=None):
+    """
+    Dòng vector gần nhất (distance). Có vectorizer TF-IDF thì lấy thêm ứng viên từ index từ
+    vựng và gộp hai danh sách bằng RRF: dòng trả về có "score" (RRF) thay cho thứ tự distance.
+    """
+    vec = get_embedding(query)
+    hybrid = LEXICAL_INDEX.enabled and bool(session_id)
+    if session_id and (SESSION_VECTORS or hybrid):
+        expire_hidden(user_id)
+    depth = top_k * HYBRID_CANDIDATES if hybrid else top_k
+    rows = _dense_search(user_id, session_id, vec, depth, ef_search)
+
+    lexical = None
+    if hybrid:
+        with tracing.span("context.lexical", **{"db.top_k": depth}) as span:
+            lexical = LEXICAL_INDEX.search(user_id, session_id, query, depth)
+            span.set_attribute("lexical.rows", len(lexical or []))
+        if lexical:
+            rows = rrf_fuse([rows, lexical], top_k)
+        else:
+            rows = rows[:top_k]
 
     if debug:
         print("→ Query vec:", (vec.tolist() if hasattr(vec, "tolist") else vec)[:5], "…")
+        print("→ Lexical:", lexical)
         print("→ Rows:", rows)
 
     return rows
@@ -1,21 +1,20 @@
-import psycopg2
-import os
-from psycopg2.extras import RealDictCursor
-from dotenv import load_dotenv
+from psycopg2.extras import execute_values
 from data.embed_messages import embedder
-
-load_dotenv()
-LOCAL_DB_URL = os.getenv("POSTGRES_URL")
+from data import db_pool
+from utils import tracing, metrics
 
 
 def get_conn():
-    return psycopg2.connect(LOCAL_DB_URL, cursor_factory=RealDictCursor)
+    """Mượn kết nối từ pool dùng chung (data/db_pool.py), dùng với `with`."""
+    return db_pool.connection()
 
 def insert_message(user_id, message, reply=None, session_id=None, time_spent=None):
     try:
-        embedding_vector = embedder.embed(message).tolist()
-        with get_conn() as conn:
-            with conn.cursor() as cur:
+        with tracing.span("embedding", **{"embedding.chars": len(message or "")}):
+            with metrics.EMBEDDING_SECONDS.labels("persist").time():
+                embedding_vector = embedder.embed(message).tolist()
+        with tracing.span("db.insert_message"), get_conn() as conn:
+            with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("insert_message").time():
                 cur.execute(
                     """
                     INSERT INTO whoisme.messages (user_id, session_id, message, reply, embedding_vector, time)
@@ -28,6 +27,24 @@ def insert_message(user_id, message, reply=None, session_id=None, time_spent=Non
     except Exception as e:
         print(f"[ERROR insert_message]: {e}")
 
+SQL_INSERT_MESSAGES = """
+INSERT INTO whoisme.messages (user_id, session_id, message, reply, embedding_vector, time, created_at)
+VALUES %s
+"""
+
+def insert_messages_batch(rows, page_size=500):
+    """
+    Chèn nhiều lượt hội thoại bằng một INSERT nhiều dòng.
+    rows: list tuple (user_id, session_id, message, reply, embedding_vector, time_spent, created_at).
+    Lỗi được raise lên để caller (write-behind) spool lại.
+    """
+    if not rows:
+        return 0
+    with tracing.span("db.insert_messages", **{"db.rows": len(rows)}), get_conn() as conn:
+        with conn.cursor() as cur, metrics.DB_QUERY_SECONDS.labels("insert_messages_batch").time():
+            execute_values(cur, SQL_INSERT_MESSAGES, rows, page_size=page_size)
+        conn.commit()
+    return len(rows)
 
 def insert_user(email: str, password_hash: str):
     try:
@@ -0,0 +1,84 @@
+"""
+Invalidation dùng chung giữa các worker cho index trong process (data/session_vectors.py,
+data/lexical_index.py).
+
+/v1/hidden chỉ xóa được bản trong worker xử lý request; worker khác vẫn giữ lượt đã ẩn tới
+hết TTL. publish() ghi mốc thời gian ẩn vào Redis hash `hidden:<user_id>` (field = session_id);
+get_long_term_context đọc hash của user (một HGETALL) trước khi tìm kiếm, index bỏ entry nạp
+trước mốc đó (expire_hidden) và nạp lại từ DB (đã lọc is_deleted).
+
+Redis lỗi → bỏ qua HIDDEN_RETRY_AFTER giây, index quay về giới hạn bằng TTL như trước.
+"""
+import os
+import time
+import logging
+import threading
+from data.session_vectors import SESSION_VECTORS_TTL
+from data.lexical_index import LEXICAL_TTL
+
+logger = logging.getLogger(__name__)
+
+# Mốc ẩn chỉ cần sống lâu hơn TTL của index: entry nạp trước đó đã tự hết hạn
+HIDDEN_STAMP_TTL = int(os.getenv("HIDDEN_STAMP_TTL", str(max(SESSION_VECTORS_TTL, LEXICAL_TTL) + 60)))
+HIDDEN_RETRY_AFTER = int(os.getenv("HIDDEN_RETRY_AFTER", "30"))
+
+
+class HiddenSessions:
+    def __init__(self, client=None, ttl=HIDDEN_STAMP_TTL, retry_after=HIDDEN_RETRY_AFTER):
+        """client: redis.Redis (decode_responses=True); mặc định là client dùng chung của data/cache.py."""
+        self._client = client
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.down_until = 0
+        self.lock = threading.Lock()
+        self.counters = {"published": 0, "redis_errors": 0}
+
+    @property
+    def client(self):
+        if self._client is None:
+            from data.cache import r
+            self._client = r
+        return self._client
+
+    @staticmethod
+    def _key(user_id):
+        return f"hidden:{user_id}"
+
+    def _count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def _failed(self, e):
+        logger.warning(f"[HiddenSessions] Redis lỗi, chỉ invalidate trong worker {self.retry_after}s: {e}")
+        self._count("redis_errors")
+        self.down_until = time.time() + self.retry_after
+
+    # ---------------- PUBLIC ----------------
+    def publish(self, user_id, session_id):
+        """Ghi mốc ẩn session (gọi sau khi UPDATE đã commit). False nếu Redis lỗi."""
+        key = self._key(user_id)
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(key, str(session_id or "global"), repr(time.time()))
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            self._failed(e)
+            return False
+        self._count("published")
+        return True
+
+    def stamps(self, user_id):
+        """{session_id: mốc ẩn (epoch giây)} của user; {} nếu chưa ẩn gì hoặc Redis đang lỗi."""
+        if time.time() < self.down_until:
+            return {}
+        try:
+            raw = self.client.hgetall(self._key(user_id))
+        except Exception as e:
+            self._failed(e)
+            return {}
+        return {session_id: float(stamp) for session_id, stamp in raw.items()}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
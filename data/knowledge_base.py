@@ -0,0 +1,223 @@
+"""
+Knowledge base từ Google Sheets (data/embed_google_sheets.py → data/embeddings/*.pkl) cho prompt chat.
+
+Pickle được tạo bằng model riêng (all-MiniLM-L6-v2), không cùng không gian vector với
+embedder của request (EMBED_MODEL), nên khi nạp mỗi sheet, text từng ô được embed lại bằng
+embedder của app qua cache embedding dùng chung (embed_batch_cached, data/embed_store.py): chỉ
+worker đầu tiên encode, các worker khác / lần nạp lại đọc từ cache. Không dùng vector trong pickle.
+Toàn bộ dòng nằm trong một index FAISS IndexFlatIP (vector chuẩn hóa → inner product =
+cosine, chính xác, vài trăm–vài nghìn dòng tìm dưới 1ms); lọc theo sheet_name / column_name /
+level bằng IDSelector của FAISS.
+
+- Thread nền kiểm tra KB_DIR mỗi KB_RELOAD_INTERVAL giây: file đổi (mtime / size) thì đọc
+  data_hash, chỉ sheet có data_hash khác mới được embed lại; index mới được dựng rồi thay
+  nguyên khối (search đang chạy vẫn dùng snapshot cũ)
+- Chưa cài faiss-cpu thì tìm bằng NumPy (cùng kết quả)
+"""
+import os
+import glob
+import time
+import pickle
+import logging
+import threading
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # pragma: no cover - faiss-cpu nằm trong requirements.txt
+    faiss = None
+
+logger = logging.getLogger(__name__)
+
+KB_ENABLED = os.getenv("KB_ENABLED", "1") == "1"
+# data/embeddings của checkout (nơi embed_google_sheets.py ghi), không theo PROJECT_ROOT / cwd
+KB_DIR = os.getenv("KB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "embeddings"))
+KB_RELOAD_INTERVAL = int(os.getenv("KB_RELOAD_INTERVAL", "60"))
+KB_TOP_K = int(os.getenv("KB_TOP_K", "3"))
+# Cosine của e5 dồn trong khoảng cao (câu không liên quan vẫn ~0.7+) nên ngưỡng phải đo trên câu
+# hỏi thật (python -m benchmark.knowledge_base); mặc định không lọc, chỉ lấy KB_TOP_K dòng
+KB_MIN_SCORE = float(os.getenv("KB_MIN_SCORE")) if os.getenv("KB_MIN_SCORE") else None
+KB_SHEETS = [s.strip() for s in os.getenv("KB_SHEETS", "").split(",") if s.strip()]
+KB_COLUMNS = [s.strip() for s in os.getenv("KB_COLUMNS", "").split(",") if s.strip()]
+
+LEVEL_COLUMN = "Mức"
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+class _Sheet:
+    __slots__ = ("name", "data_hash", "signature", "rows", "vectors")
+
+    def __init__(self, name, data_hash, signature, rows, vectors):
+        self.name = name
+        self.data_hash = data_hash
+        self.signature = signature
+        self.rows = rows
+        self.vectors = vectors
+
+
+class _Snapshot:
+    """Index bất biến dựng từ các sheet đã nạp."""
+
+    def __init__(self, sheets):
+        self.rows = [r for s in sheets for r in s.rows]
+        vectors = [s.vectors for s in sheets if len(s.vectors)]
+        self.vectors = np.ascontiguousarray(np.vstack(vectors), dtype=np.float32) if vectors else None
+        self.sheet_names = np.array([r["sheet_name"] for r in self.rows], dtype=object)
+        self.columns = np.array([r["column_name"] for r in self.rows], dtype=object)
+        self.levels = np.array([r["level"] for r in self.rows], dtype=object)
+        self.index = None
+        if faiss is not None and self.vectors is not None:
+            self.index = faiss.IndexFlatIP(self.vectors.shape[1])
+            self.index.add(self.vectors)
+
+    def _mask(self, sheet_name, column_name, level):
+        mask = None
+        for values, arr in ((sheet_name, self.sheet_names), (column_name, self.columns), (level, self.levels)):
+            values = _as_list(values)
+            if values is None:
+                continue
+            m = np.isin(arr, values)
+            mask = m if mask is None else mask & m
+        return mask
+
+    def search(self, query_vec, top_k, sheet_name=None, column_name=None, level=None):
+        if self.vectors is None or top_k <= 0:
+            return []
+        q = np.asarray(query_vec, dtype=np.float32).reshape(1, -1)
+        norm = np.linalg.norm(q)
+        if norm == 0 or q.shape[1] != self.vectors.shape[1]:
+            return []
+        q = q / norm
+        mask = self._mask(sheet_name, column_name, level)
+        ids = np.flatnonzero(mask) if mask is not None else None
+        if ids is not None and len(ids) == 0:
+            return []
+        k = min(top_k, len(self.rows) if ids is None else len(ids))
+
+        if self.index is not None:
+            params = None
+            if ids is not None:
+                params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(ids.astype(np.int64)))
+            scores, idx = self.index.search(q, k, params=params)
+            hits = [(int(i), float(s)) for i, s in zip(idx[0], scores[0]) if i >= 0]
+        else:
+            candidates = ids if ids is not None else np.arange(len(self.rows))
+            scores = self.vectors[candidates] @ q[0]
+            order = np.argsort(-scores, kind="stable")[:k]
+            hits = [(int(candidates[i]), float(scores[i])) for i in order]
+        return [{**self.rows[i], "score": s} for i, s in hits]
+
+
+class KnowledgeBase:
+    def __init__(self, embed_batch_fn, directory=KB_DIR, reload_interval=KB_RELOAD_INTERVAL):
+        """embed_batch_fn(texts) → ma trận (len(texts), dim), cùng model với truy vấn."""
+        self.embed_batch_fn = embed_batch_fn
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.sheets = {}
+        self.snapshot = _Snapshot([])
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ready = threading.Event()
+
+    # ---------------- PUBLIC ----------------
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, daemon=True, name="knowledge-base")
+            self.thread.start()
+
+    def search(self, query_vec, top_k=KB_TOP_K, min_score=None, sheet_name=None, column_name=None, level=None):
+        """Dòng gần nhất trước: {sheet_name, column_name, row_index, level, text, score}."""
+        hits = self.snapshot.search(query_vec, top_k, sheet_name, column_name, level)
+        if min_score is not None:
+            hits = [h for h in hits if h["score"] >= min_score]
+        return hits
+
+    def refresh(self):
+        """Nạp lại sheet có data_hash đổi. Trả về số sheet đã embed lại / bị xóa."""
+        with self.lock:
+            changed = 0
+            seen = set()
+            for path in sorted(glob.glob(os.path.join(self.directory, "*.pkl"))):
+                seen.add(path)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                signature = (st.st_mtime_ns, st.st_size)
+                current = self.sheets.get(path)
+                if current is not None and current.signature == signature:
+                    continue
+                try:
+                    sheet = self._load(path, signature, current)
+                except Exception as e:
+                    logger.error(f"[knowledge_base] Không nạp được {os.path.basename(path)}: {e}")
+                    continue
+                if sheet is not current:
+                    changed += 1
+                self.sheets[path] = sheet
+            for path in set(self.sheets) - seen:
+                del self.sheets[path]
+                changed += 1
+            if changed or not self.ready.is_set():
+                self.snapshot = _Snapshot(list(self.sheets.values()))
+                logger.info(f"[knowledge_base] {len(self.sheets)} sheet, {len(self.snapshot.rows)} dòng "
+                            f"({changed} sheet thay đổi)")
+            self.ready.set()
+            return changed
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {"sheets": len(self.sheets), "rows": len(snapshot.rows), "faiss": snapshot.index is not None}
+
+    # ---------------- INTERNAL ----------------
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"[knowledge_base] Lỗi nạp knowledge base: {e}")
+            time.sleep(self.reload_interval)
+
+    def _load(self, path, signature, current):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        data_hash = data.get("data_hash", "")
+        if current is not None and current.data_hash == data_hash:
+            # File ghi lại nhưng nội dung sheet không đổi → giữ vector cũ
+            current.signature = signature
+            return current
+
+        sheet_name = data.get("sheet_name") or os.path.splitext(os.path.basename(path))[0]
+        df = data.get("df")
+        columns = list((data.get("embeddings_by_col") or {}).keys())
+        if df is not None and not columns:
+            columns = [c for c in df.columns if c != LEVEL_COLUMN and not str(c).endswith("_embedding")]
+        rows = []
+        if df is not None:
+            levels = df[LEVEL_COLUMN].tolist() if LEVEL_COLUMN in df.columns else [None] * len(df)
+            for col in columns:
+                if col not in df.columns:
+                    continue
+                for idx, text in enumerate(df[col].astype(str).tolist()):
+                    text = text.strip()
+                    if text:
+                        level = levels[idx]
+                        rows.append({
+                            "sheet_name": sheet_name, "column_name": col, "row_index": idx,
+                            # ô trống của pandas là NaN (NaN != NaN)
+                            "level": None if level in (None, "") or level != level else str(level), "text": text,
+                        })
+        vectors = np.asarray(self.embed_batch_fn([r["text"] for r in rows]), dtype=np.float32) if rows else np.zeros((0, 0))
+        if len(vectors):
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return _Sheet(sheet_name, data_hash, signature, rows, vectors)
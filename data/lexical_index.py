@@ -0,0 +1,409 @@
+"""
+Index từ vựng (TF-IDF, scipy CSR) theo user cho long-term context, kết hợp với kết quả vector.
+
+Embedding 384 chiều hay bỏ sót tên riêng, con số, từ tiếng Việt hiếm ("anh Tuấn", "phòng 302").
+Vectorizer TF-IDF (data/train_vectorizer.py → data/vectorizer.pkl) biến mỗi tin nhắn thành một
+dòng thưa; mỗi user là một ma trận CSR (dòng đã chuẩn hóa L2 nên X @ q.T = cosine):
+- search(): user chưa có thì nạp tin nhắn của user một lần (single-flight) và transform cả lô;
+  lượt sau chỉ còn CSR × vector câu hỏi + argpartition, lọc session bằng mảng mã session
+- append(): record_turn thêm lượt vừa trả lời (một dòng, vstack ra ma trận mới)
+- invalidate(): soft delete (/v1/hidden) trong worker này; expire_hidden(): soft delete do
+  worker khác thực hiện (mốc ẩn dùng chung qua Redis, data/invalidation.py)
+- rrf_fuse(): reciprocal rank fusion danh sách vector + danh sách từ vựng (score = Σ 1/(k + hạng))
+
+Không có data/vectorizer.pkl (chưa train) thì index tắt, get_long_term_context chỉ dùng vector.
+Khóa chia shard và LRU như data/session_vectors.py.
+"""
+import os
+import sys
+import time
+import pickle
+import logging
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from collections import OrderedDict, Counter
+import numpy as np
+import scipy.sparse as sp
+from utils import metrics
+from utils.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+# Cạnh module (data/vectorizer.pkl của checkout), không theo PROJECT_ROOT (thư mục cha của checkout)
+LEXICAL_VECTORIZER_PATH = os.getenv(
+    "LEXICAL_VECTORIZER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vectorizer.pkl"))
+LEXICAL_MAX_ROWS = int(os.getenv("LEXICAL_MAX_ROWS", "5000"))
+LEXICAL_TTL = int(os.getenv("LEXICAL_TTL", "600"))
+LEXICAL_MAX_USERS = int(os.getenv("LEXICAL_MAX_USERS", "2000"))
+LEXICAL_MAX_BYTES = int(os.getenv("LEXICAL_MAX_BYTES", str(128 * 1024 * 1024)))
+LEXICAL_SHARDS = int(os.getenv("LEXICAL_SHARDS", "16"))
+# Số ứng viên mỗi nguồn = top_k × HYBRID_CANDIDATES; k của RRF (60 theo bài báo gốc)
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "4"))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+
+_ROW_OVERHEAD = 4 * 8 + 64
+
+
+def load_vectorizer(path=LEXICAL_VECTORIZER_PATH):
+    """TfidfVectorizer đã train, None nếu chưa có file."""
+    if not path or not os.path.exists(path):
+        logger.info(f"[lexical_index] Chưa có {path} (python -m data.train_vectorizer) → chỉ dùng vector")
+        return None
+    try:
+        with open(path, "rb") as f:
+            vectorizer = pickle.load(f)
+        vectorizer.transform([""])
+        return vectorizer
+    except Exception as e:
+        logger.error(f"[lexical_index] Không nạp được {path}: {e}")
+        return None
+
+
+def rrf_fuse(ranked_lists, top_k, k=HYBRID_RRF_K, key=None):
+    """
+    Reciprocal rank fusion: mỗi danh sách (tốt nhất trước) góp 1/(k + hạng) cho mỗi dòng.
+    Dòng trùng giữa các danh sách (cùng key) gộp làm một, giữ bản của danh sách đầu tiên.
+    Trả về top_k dòng kèm "score" = điểm RRF chia cho điểm tối đa có thể (1 = hạng 1 ở mọi nguồn).
+    """
+    key = key or (lambda r: (r.get("message") or "", r.get("reply") or ""))
+    codes, rows, ranks = {}, [], []
+    index = []
+    for lst in ranked_lists:
+        for rank, row in enumerate(lst, start=1):
+            code = codes.setdefault(key(row), len(rows))
+            if code == len(rows):
+                rows.append(row)
+            index.append(code)
+            ranks.append(rank)
+    if not rows or top_k <= 0:
+        return []
+    scores = np.zeros(len(rows))
+    np.add.at(scores, np.asarray(index), 1.0 / (k + np.asarray(ranks, dtype=np.float64)))
+    scores /= len(ranked_lists) / (k + 1.0)
+    top = np.argsort(-scores, kind="stable")[:top_k]
+    return [{**rows[i], "score": float(scores[i])} for i in top]
+
+
+class _Entry:
+    __slots__ = ("matrix", "ids", "messages", "replies", "created", "session_codes", "session_ids",
+                 "nbytes", "loaded_at", "oversized")
+
+    def __init__(self, matrix, rows, loaded_at, oversized=False):
+        self.matrix = matrix
+        self.ids = [r.get("id") for r in rows]
+        self.messages = [r.get("message") or "" for r in rows]
+        self.replies = [r.get("reply") or "" for r in rows]
+        self.created = [r.get("created_at") for r in rows]
+        self.session_ids = {}
+        self.session_codes = np.fromiter(
+            (self.session_ids.setdefault(str(r.get("session_id")), len(self.session_ids)) for r in rows),
+            dtype=np.int32, count=len(rows))
+        self.loaded_at = loaded_at
+        # User quá LEXICAL_MAX_ROWS dòng: chỉ ghi nhớ để không nạp lại tới hết TTL
+        self.oversized = oversized
+        self.nbytes = _matrix_bytes(matrix) + sum(
+            _ROW_OVERHEAD + sys.getsizeof(m) + sys.getsizeof(r) for m, r in zip(self.messages, self.replies))
+
+    def add(self, session_id, message, reply, created_at, row):
+        """Thêm một dòng (CSR 1 × V), trả về số byte thay đổi."""
+        before = _matrix_bytes(self.matrix)
+        # Ma trận / mảng mới: snapshot đang được search vẫn đọc bản cũ
+        self.matrix = row if self.matrix is None else sp.vstack([self.matrix, row], format="csr")
+        code = self.session_ids.setdefault(str(session_id), len(self.session_ids))
+        self.session_codes = np.append(self.session_codes, np.int32(code))
+        self.ids.append(None)
+        self.messages.append(message)
+        self.replies.append(reply)
+        self.created.append(created_at)
+        delta = _matrix_bytes(self.matrix) - before + _ROW_OVERHEAD + sys.getsizeof(message) + sys.getsizeof(reply)
+        self.nbytes += delta
+        return delta
+
+
+def _matrix_bytes(matrix):
+    if matrix is None:
+        return 0
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+class _Shard:
+    __slots__ = ("lock", "users", "nbytes", "loading")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+        self.nbytes = 0
+        # User đang nạp → True nếu bị append / invalidate trong lúc đọc DB (như session_vectors)
+        self.loading = {}
+
+
+class LexicalIndex:
+    def __init__(self, loader, vectorizer=None, max_rows=LEXICAL_MAX_ROWS, ttl=LEXICAL_TTL,
+                 max_users=LEXICAL_MAX_USERS, max_bytes=LEXICAL_MAX_BYTES, shards=LEXICAL_SHARDS):
+        """loader(user_id, limit) → list dòng {id, session_id, message, reply, created_at} (mới → cũ)."""
+        self.loader = loader
+        self.vectorizer = vectorizer
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.shards = [_Shard() for _ in range(max(1, shards))]
+        self.max_users = max(1, max_users // len(self.shards))
+        self.max_bytes = max_bytes // len(self.shards)
+        self.flight = SingleFlight()
+        self.counters_lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "loads": 0, "oversized": 0, "appends": 0, "evictions": 0,
+                         "hidden": 0}
+
+    @property
+    def enabled(self):
+        return self.vectorizer is not None
+
+    @property
+    def vectorizer(self):
+        return self._vectorizer
+
+    @vectorizer.setter
+    def vectorizer(self, vectorizer):
+        self._vectorizer = vectorizer
+        self._query_parts = None
+        if vectorizer is not None and getattr(vectorizer, "norm", "l2") in ("l2", None):
+            idf = getattr(vectorizer, "idf_", None) if getattr(vectorizer, "use_idf", False) else None
+            self._query_parts = (
+                vectorizer.build_analyzer(), vectorizer.vocabulary_,
+                None if idf is None else np.asarray(idf, dtype=np.float32),
+                len(vectorizer.vocabulary_),
+            )
+
+    def _shard(self, user_id):
+        return self.shards[hash(user_id) % len(self.shards)]
+
+    @staticmethod
+    @contextmanager
+    def _locked(shard):
+        start = time.perf_counter()
+        with shard.lock:
+            metrics.LOCK_WAIT_SECONDS.labels("lexical_index").observe(time.perf_counter() - start)
+            yield
+
+    def _count(self, key, n=1):
+        with self.counters_lock:
+            self.counters[key] += n
+
+    def _transform(self, texts):
+        return self.vectorizer.transform(texts).astype(np.float32).tocsr()
+
+    def _query_vector(self, text):
+        """
+        Vector TF-IDF dense (V,) của một câu hỏi, None nếu không có term nào trong vocabulary.
+        Tính trực tiếp từ analyzer + vocabulary_ + idf_ (giống transform() nhưng không qua
+        pipeline sparse của sklearn, ~50 lần nhanh hơn với một câu).
+        """
+        if self._query_parts is None:
+            row = self._transform([text])
+            return row.toarray().ravel() if row.nnz else None
+        analyzer, vocabulary, idf, size = self._query_parts
+        counts = Counter(vocabulary[t] for t in analyzer(text) if t in vocabulary)
+        if not counts:
+            return None
+        cols = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        if getattr(self.vectorizer, "binary", False):
+            tf[:] = 1
+        elif getattr(self.vectorizer, "sublinear_tf", False):
+            tf = np.log(tf) + 1
+        if idf is not None:
+            tf *= idf[cols]
+        if self.vectorizer.norm == "l2":
+            tf /= np.linalg.norm(tf)
+        query = np.zeros(size, dtype=np.float32)
+        query[cols] = tf
+        return query
+
+    # ---------------- PUBLIC ----------------
+    def search(self, user_id, session_id, query, top_k=5):
+        """
+        Top-k theo cosine TF-IDF trong session (hoặc mọi session của user khi session_id rỗng),
+        chỉ dòng có chung ít nhất một term với query. None nếu index tắt hoặc user quá lớn.
+        Dòng trả về: id, message, reply, created_at, lexical_score.
+        """
+        if not self.enabled:
+            return None
+        query_vec = self._query_vector(query or "")
+        if query_vec is None:
+            return []
+        shard = self._shard(user_id)
+        with self._locked(shard):
+            entry = self._lookup(shard, user_id, time.time())
+            if entry is not None:
+                snapshot = self._snapshot(entry)
+        metrics.cache_result("lexical_index", entry is not None)
+        if entry is None:
+            self._count("misses")
+            entry = self._load(user_id, shard)
+            with self._locked(shard):
+                snapshot = self._snapshot(entry)
+        else:
+            self._count("hits")
+        if entry.oversized:
+            return None
+        return self._top_k(snapshot, session_id, query_vec, top_k)
+
+    def append(self, user_id, session_id, message, reply):
+        """Thêm lượt mới vào user đã nạp. Chưa nạp thì bỏ qua (lần nạp sau đọc từ DB)."""
+        if not self.enabled:
+            return
+        row = self._transform([message or ""])
+        shard = self._shard(user_id)
+        with self._locked(shard):
+            entry = self._lookup(shard, user_id, time.time())
+            if entry is None:
+                # Lần nạp đang chạy có thể đã đọc DB trước khi lượt này được ghi → không cache
+                self._mark_stale(shard, user_id)
+                return
+            if entry.oversized:
+                return
+            if len(entry.messages) >= self.max_rows:
+                self._drop(shard, user_id)
+                return
+            if entry.messages and entry.messages[-1] == message and entry.replies[-1] == reply:
+                return
+            shard.nbytes += entry.add(session_id, message, reply, datetime.now(timezone.utc), row)
+            self._count("appends")
+            self._evict(shard)
+
+    def invalidate(self, user_id, session_id=None):
+        shard = self._shard(user_id)
+        with self._locked(shard):
+            self._drop(shard, user_id)
+            self._mark_stale(shard, user_id)
+
+    def expire_hidden(self, user_id, stamps):
+        """Bỏ ma trận của user nếu nạp trước một mốc ẩn {session_id: epoch giây}. Trả về 1 nếu bỏ."""
+        if not stamps:
+            return 0
+        shard = self._shard(user_id)
+        with self._locked(shard):
+            entry = shard.users.get(user_id)
+            if entry is None or entry.loaded_at > max(stamps.values()):
+                return 0
+            self._drop(shard, user_id)
+        self._count("hidden")
+        return 1
+
+    def stats(self):
+        users = nbytes = 0
+        for shard in self.shards:
+            with shard.lock:
+                users += len(shard.users)
+                nbytes += shard.nbytes
+        with self.counters_lock:
+            return {**self.counters, "enabled": self.enabled, "users": users, "bytes": nbytes}
+
+    # ---------------- INTERNAL ----------------
+    @staticmethod
+    def _snapshot(entry):
+        n = len(entry.messages)
+        return (entry.matrix, entry.session_codes, entry.session_ids.get, entry.ids[:n],
+                entry.messages[:n], entry.replies[:n], entry.created[:n])
+
+    @staticmethod
+    def _top_k(snapshot, session_id, query_vec, top_k):
+        matrix, session_codes, session_code, ids, messages, replies, created = snapshot
+        if matrix is None or matrix.shape[0] == 0 or top_k <= 0:
+            return []
+        # CSR × vector dense: O(nnz), không tạo ma trận thưa trung gian
+        scores = matrix.dot(query_vec)
+        if session_id:
+            code = session_code(str(session_id))
+            if code is None:
+                return []
+            scores[session_codes != code] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) == 0:
+            return []
+        k = min(top_k, len(candidates))
+        if k < len(candidates):
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [
+            {"id": ids[i], "message": messages[i], "reply": replies[i], "created_at": created[i],
+             "lexical_score": float(scores[i])}
+            for i in candidates
+        ]
+
+    def _lookup(self, shard, user_id, now):
+        entry = shard.users.get(user_id)
+        if entry is None:
+            return None
+        if now - entry.loaded_at > self.ttl:
+            self._drop(shard, user_id)
+            return None
+        shard.users.move_to_end(user_id)
+        return entry
+
+    def _load(self, user_id, shard):
+        start = time.perf_counter()
+        leader = []
+
+        def fetch():
+            leader.append(True)
+            return self._fetch(user_id, shard)
+
+        entry = self.flight.do(user_id, fetch)
+        if not leader:
+            metrics.LOCK_WAIT_SECONDS.labels("lexical_index_load").observe(time.perf_counter() - start)
+        return entry
+
+    @staticmethod
+    def _mark_stale(shard, user_id):
+        if user_id in shard.loading:
+            shard.loading[user_id] = True
+
+    def _fetch(self, user_id, shard):
+        # single-flight: mỗi user tối đa một lần nạp đang chạy
+        with shard.lock:
+            shard.loading[user_id] = False
+        self._count("loads")
+        # Mốc nạp = lúc bắt đầu đọc DB: lượt bị ẩn (worker khác) sau mốc này có thể chưa được lọc
+        started = time.time()
+        try:
+            entry = self._build(self.loader(user_id, self.max_rows + 1) or [], started)
+        except BaseException:
+            with shard.lock:
+                shard.loading.pop(user_id, None)
+            raise
+        with self._locked(shard):
+            stale = shard.loading.pop(user_id, False)
+            current = shard.users.get(user_id)
+            if current is not None:
+                shard.users.move_to_end(user_id)
+                return current
+            if not stale:
+                shard.users[user_id] = entry
+                shard.nbytes += entry.nbytes
+                self._evict(shard)
+            return entry
+
+    def _build(self, rows, loaded_at):
+        if len(rows) > self.max_rows:
+            self._count("oversized")
+            return _Entry(None, [], loaded_at, oversized=True)
+        rows = rows[::-1]
+        # Cả lô một lần transform (tokenize + tra vocabulary trong C của scipy / sklearn)
+        matrix = self._transform([r.get("message") or "" for r in rows]) if rows else None
+        return _Entry(matrix, rows, loaded_at)
+
+    def _drop(self, shard, user_id):
+        entry = shard.users.pop(user_id, None)
+        if entry is not None:
+            shard.nbytes -= entry.nbytes
+
+    def _evict(self, shard):
+        evicted = 0
+        while len(shard.users) > 1 and (len(shard.users) > self.max_users or shard.nbytes > self.max_bytes):
+            _, entry = shard.users.popitem(last=False)
+            shard.nbytes -= entry.nbytes
+            evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
@@ -0,0 +1,171 @@
+"""
+Semantic response cache theo (user, session).
+
+Mỗi session giữ một ma trận float32 các vector câu hỏi gần đây (giới hạn số dòng),
+lookup là một phép nhân ma trận NumPy + argmax (top-1), dưới 1ms.
+- Khớp chính xác sau khi chuẩn hóa NFC + gộp khoảng trắng + lowercase (giữ dấu) → trả ngay,
+  không cần embed
+- Khớp ngữ nghĩa: cosine >= SEMANTIC_CACHE_THRESHOLD trên câu đã chuẩn hóa NFC + khoảng trắng.
+  Không dùng bản bỏ dấu (làm key hay để embed) vì tiếng Việt không dấu quá mơ hồ
+  ("mua áo" / "múa áo", "bạn là ai" / "bán là ai")
+"""
+import os
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "600"))
+SEMANTIC_CACHE_MAX_HITS = int(os.getenv("SEMANTIC_CACHE_MAX_HITS", "1"))
+SEMANTIC_CACHE_PER_SESSION = int(os.getenv("SEMANTIC_CACHE_PER_SESSION", "64"))
+SEMANTIC_CACHE_MAX_BYTES = int(os.getenv("SEMANTIC_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_WS_RE = re.compile(r"\s+")
+
+def normalize_whitespace(text: str) -> str:
+    return _WS_RE.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+def exact_key(text: str) -> str:
+    """Key khớp chính xác: "Xin  Chào Đức" → "xin chào đức" (giữ dấu)."""
+    return normalize_whitespace(text).lower()
+
+class _SessionEntries:
+    """Ring buffer: ma trận vector + câu trả lời, tăng gấp đôi tới `capacity`."""
+
+    def __init__(self, dim, capacity):
+        self.capacity = capacity
+        self.vectors = np.zeros((min(8, capacity), dim), dtype=np.float32)
+        self.answers = []
+        self.keys = []
+        self.created = np.zeros(len(self.vectors), dtype=np.float64)
+        self.hits = np.zeros(len(self.vectors), dtype=np.int32)
+        self.exact = {}
+        self.size = 0
+        self.next = 0
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + self.created.nbytes + self.hits.nbytes
+
+    def _grow(self):
+        rows = min(len(self.vectors) * 2, self.capacity)
+        self.vectors = np.resize(self.vectors, (rows, self.vectors.shape[1]))
+        self.created = np.resize(self.created, rows)
+        self.hits = np.resize(self.hits, rows)
+
+    def add(self, key, vec, answer, now):
+        if self.size == len(self.vectors) and self.size < self.capacity:
+            self._grow()
+        slot = self.next
+        if slot < len(self.answers):
+            # Key cũ có thể đã trỏ sang slot mới hơn (cùng câu hỏi được add lại) → giữ nguyên
+            old = self.keys[slot]
+            if self.exact.get(old) == slot:
+                del self.exact[old]
+            self.answers[slot], self.keys[slot] = answer, key
+        else:
+            self.answers.append(answer)
+            self.keys.append(key)
+        self.vectors[slot] = vec
+        self.created[slot] = now
+        self.hits[slot] = 0
+        self.exact[key] = slot
+        self.size = max(self.size, slot + 1)
+        self.next = (slot + 1) % self.capacity
+
+    def valid_mask(self, now, ttl, max_hits):
+        n = self.size
+        return (now - self.created[:n] < ttl) & (self.hits[:n] < max_hits)
+
+
+class SemanticCache:
+    def __init__(self, embed_fn, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL,
+                 max_hits=SEMANTIC_CACHE_MAX_HITS, per_session=SEMANTIC_CACHE_PER_SESSION,
+                 max_bytes=SEMANTIC_CACHE_MAX_BYTES):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_hits = max_hits
+        self.per_session = per_session
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+
+    @staticmethod
+    def _skey(user_id, session_id):
+        return f"{user_id}:{session_id or 'global'}"
+
+    def _embed(self, text):
+        vec = np.asarray(self.embed_fn(text), dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _take(self, entries, slot, kind):
+        entries.hits[slot] += 1
+        self.counters[kind] += 1
+        return entries.answers[slot]
+
+    def lookup(self, user_id, session_id, message):
+        """Trả về (answer, similarity) hoặc (None, None)."""
+        skey = self._skey(user_id, session_id)
+        key = exact_key(message)
+        now = time.time()
+        with self.lock:
+            entries = self.sessions.get(skey)
+            if entries is None or entries.size == 0:
+                self.counters["misses"] += 1
+                return None, None
+            self.sessions.move_to_end(skey)
+            valid = entries.valid_mask(now, self.ttl, self.max_hits)
+            slot = entries.exact.get(key)
+            if slot is not None and valid[slot]:
+                return self._take(entries, slot, "exact_hits"), 1.0
+
+        vec = self._embed(normalize_whitespace(message))
+        with self.lock:
+            entries = self.sessions.get(skey)
+            if entries is None or entries.size == 0:
+                self.counters["misses"] += 1
+                return None, None
+            n = entries.size
+            sims = entries.vectors[:n] @ vec
+            sims[~entries.valid_mask(now, self.ttl, self.max_hits)] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                return self._take(entries, best, "semantic_hits"), float(sims[best])
+            self.counters["misses"] += 1
+        return None, None
+
+    def add(self, user_id, session_id, message, answer):
+        if not answer:
+            return
+        vec = self._embed(normalize_whitespace(message))
+        skey = self._skey(user_id, session_id)
+        with self.lock:
+            entries = self.sessions.get(skey)
+            if entries is None:
+                entries = self.sessions[skey] = _SessionEntries(vec.shape[0], self.per_session)
+                self.nbytes += entries.nbytes
+            self.sessions.move_to_end(skey)
+            before = entries.nbytes
+            entries.add(exact_key(message), vec, answer, time.time())
+            self.nbytes += entries.nbytes - before
+            while self.nbytes > self.max_bytes and len(self.sessions) > 1:
+                _, evicted = self.sessions.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def invalidate(self, user_id, session_id):
+        with self.lock:
+            entries = self.sessions.pop(self._skey(user_id, session_id), None)
+            if entries is not None:
+                self.nbytes -= entries.nbytes
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "sessions": len(self.sessions), "bytes": self.nbytes}
@@ -0,0 +1,305 @@
+"""
+Index vector trong process cho các session đang hoạt động (long-term context).
+
+Mỗi session là một ma trận NumPy liên tục (SESSION_VECTORS_DTYPE, các dòng đã chuẩn hóa L2) kèm id / message / reply / created_at. get_long_term_context tính top-k
+bằng một phép nhân ma trận thay vì round trip tới Postgres:
+- search(): session chưa có thì nạp toàn bộ vector của session từ DB một lần (single-flight),
+  sau đó mọi lượt tìm kiếm chạy cục bộ. Session có hơn SESSION_VECTORS_MAX_ROWS dòng không
+  được giữ (trả về None → caller truy vấn pgvector như cũ)
+- append(): record_turn thêm lượt vừa trả lời (vector dùng lại từ request) vào cuối ma trận
+- invalidate(): soft delete (/v1/hidden) trong worker này; expire_hidden(): soft delete do
+  worker khác thực hiện (mốc ẩn dùng chung qua Redis, data/invalidation.py)
+- LRU theo session trong SESSION_VECTORS_MAX_SESSIONS session / SESSION_VECTORS_MAX_BYTES bộ
+  nhớ; SESSION_VECTORS_TTL giới hạn độ lệch khi lượt mới của session đi qua worker khác
+
+Khóa chia shard như data/short_term.py; chỉ giữ lock khi đọc / ghi dict, tính top-k trên
+snapshot (n dòng đầu không bao giờ bị sửa, append chỉ ghi vào sau hoặc cấp ma trận mới).
+"""
+import os
+import sys
+import time
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+from utils import metrics
+from utils.singleflight import SingleFlight
+
+SESSION_VECTORS = os.getenv("SESSION_VECTORS", "1") == "1"
+SESSION_VECTORS_MAX_ROWS = int(os.getenv("SESSION_VECTORS_MAX_ROWS", "2000"))
+SESSION_VECTORS_TTL = int(os.getenv("SESSION_VECTORS_TTL", "600"))
+SESSION_VECTORS_MAX_SESSIONS = int(os.getenv("SESSION_VECTORS_MAX_SESSIONS", "2000"))
+SESSION_VECTORS_MAX_BYTES = int(os.getenv("SESSION_VECTORS_MAX_BYTES", str(128 * 1024 * 1024)))
+# float32 (mặc định) đi qua BLAS; float16 tốn nửa bộ nhớ nhưng mỗi lần search phải đổi cả ma
+# trận sang float32 (chậm hơn ~20 lần với 300 dòng × 384)
+SESSION_VECTORS_DTYPE = np.dtype(os.getenv("SESSION_VECTORS_DTYPE", "float32"))
+SESSION_VECTORS_SHARDS = int(os.getenv("SESSION_VECTORS_SHARDS", "16"))
+
+_ROW_OVERHEAD = 3 * 8 + 64
+
+
+def _normalize(vec):
+    vec = np.asarray(vec, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+class _Entry:
+    __slots__ = ("vectors", "n", "ids", "messages", "replies", "created", "nbytes", "loaded_at", "oversized")
+
+    def __init__(self, dim, capacity, loaded_at, oversized=False):
+        self.vectors = np.empty((capacity, dim), dtype=SESSION_VECTORS_DTYPE)
+        self.n = 0
+        self.ids, self.messages, self.replies, self.created = [], [], [], []
+        self.nbytes = self.vectors.nbytes
+        self.loaded_at = loaded_at
+        # Session quá SESSION_VECTORS_MAX_ROWS: chỉ ghi nhớ để không nạp lại tới hết TTL
+        self.oversized = oversized
+
+    def add(self, row_id, message, reply, created_at, vec):
+        """Thêm một dòng, trả về số byte thay đổi."""
+        vec = _normalize(vec)
+        delta = 0
+        if self.n == len(self.vectors) or self.vectors.shape[1] != vec.size:
+            # Ma trận mới (gấp đôi, hoặc session rỗng nhận dòng đầu tiên): snapshot đang
+            # được search vẫn đọc ma trận cũ
+            grown = np.empty((max(len(self.vectors) * 2, 8), vec.size), dtype=self.vectors.dtype)
+            if self.n:
+                grown[:self.n] = self.vectors[:self.n]
+            delta += grown.nbytes - self.vectors.nbytes
+            self.vectors = grown
+        self.vectors[self.n] = vec
+        self.ids.append(row_id)
+        self.messages.append(message)
+        self.replies.append(reply)
+        self.created.append(created_at)
+        self.n += 1
+        delta += _ROW_OVERHEAD + sys.getsizeof(message) + sys.getsizeof(reply)
+        self.nbytes += delta
+        return delta
+
+
+class _Shard:
+    __slots__ = ("lock", "sessions", "nbytes", "loading")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        # Session đang nạp → True nếu bị append / invalidate trong lúc đọc DB (kết quả không
+        # được cache). Theo từng session: ghi vào session khác cùng shard không ảnh hưởng
+        self.loading = {}
+
+
+class SessionVectorIndex:
+    def __init__(self, loader, max_rows=SESSION_VECTORS_MAX_ROWS, ttl=SESSION_VECTORS_TTL,
+                 max_sessions=SESSION_VECTORS_MAX_SESSIONS, max_bytes=SESSION_VECTORS_MAX_BYTES,
+                 shards=SESSION_VECTORS_SHARDS):
+        """loader(user_id, session_id, limit) → list dòng {id, message, reply, created_at, vec} (mới → cũ)."""
+        self.loader = loader
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.shards = [_Shard() for _ in range(max(1, shards))]
+        self.max_sessions = max(1, max_sessions // len(self.shards))
+        self.max_bytes = max_bytes // len(self.shards)
+        self.flight = SingleFlight()
+        self.counters_lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "loads": 0, "oversized": 0, "appends": 0, "evictions": 0,
+                         "hidden": 0}
+
+    @staticmethod
+    def _skey(user_id, session_id):
+        return f"{user_id}:{session_id or 'global'}"
+
+    def _shard(self, skey):
+        return self.shards[hash(skey) % len(self.shards)]
+
+    @staticmethod
+    @contextmanager
+    def _locked(shard):
+        start = time.perf_counter()
+        with shard.lock:
+            metrics.LOCK_WAIT_SECONDS.labels("session_vectors").observe(time.perf_counter() - start)
+            yield
+
+    def _count(self, key, n=1):
+        with self.counters_lock:
+            self.counters[key] += n
+
+    # ---------------- PUBLIC ----------------
+    def search(self, user_id, session_id, query_vec, top_k=5):
+        """
+        Top-k theo cosine distance (như `embedding_vector <=> q`), dòng gần nhất trước.
+        None nếu session quá lớn để giữ trong bộ nhớ (caller truy vấn pgvector).
+        Dòng trả về giống SQL_VECTOR_SEARCH: id, message, reply, distance, created_at.
+        """
+        skey = self._skey(user_id, session_id)
+        shard = self._shard(skey)
+        with self._locked(shard):
+            entry = self._lookup(shard, skey, time.time())
+            if entry is not None:
+                snapshot = self._snapshot(entry)
+        metrics.cache_result("session_vectors", entry is not None)
+        if entry is None:
+            self._count("misses")
+            entry = self._load(user_id, session_id, skey, shard)
+            with self._locked(shard):
+                snapshot = self._snapshot(entry)
+        else:
+            self._count("hits")
+        if entry.oversized:
+            return None
+        return self._top_k(snapshot, query_vec, top_k)
+
+    def append(self, user_id, session_id, message, reply, vector):
+        """Thêm lượt mới vào session đã nạp. Chưa nạp thì bỏ qua (lần nạp sau đọc từ DB)."""
+        skey = self._skey(user_id, session_id)
+        shard = self._shard(skey)
+        with self._locked(shard):
+            entry = self._lookup(shard, skey, time.time())
+            if entry is None:
+                # Lần nạp đang chạy có thể đã đọc DB trước khi lượt này được ghi → không cache
+                self._mark_stale(shard, skey)
+                return
+            if entry.oversized:
+                return
+            if vector is None or entry.n >= self.max_rows:
+                self._drop(shard, skey)
+                return
+            if entry.n and entry.messages[-1] == message and entry.replies[-1] == reply:
+                return
+            delta = entry.add(None, message, reply, datetime.now(timezone.utc), vector)
+            shard.nbytes += delta
+            self._count("appends")
+            self._evict(shard)
+
+    def invalidate(self, user_id, session_id):
+        skey = self._skey(user_id, session_id)
+        shard = self._shard(skey)
+        with self._locked(shard):
+            self._drop(shard, skey)
+            self._mark_stale(shard, skey)
+
+    def expire_hidden(self, user_id, stamps):
+        """Bỏ session của user nạp trước mốc ẩn {session_id: epoch giây}. Trả về số session bị bỏ."""
+        dropped = 0
+        for session_id, stamp in stamps.items():
+            skey = self._skey(user_id, session_id)
+            shard = self._shard(skey)
+            with self._locked(shard):
+                entry = shard.sessions.get(skey)
+                if entry is not None and entry.loaded_at <= stamp:
+                    self._drop(shard, skey)
+                    dropped += 1
+        if dropped:
+            self._count("hidden", dropped)
+        return dropped
+
+    def stats(self):
+        sessions = nbytes = 0
+        for shard in self.shards:
+            with shard.lock:
+                sessions += len(shard.sessions)
+                nbytes += shard.nbytes
+        with self.counters_lock:
+            return {**self.counters, "sessions": sessions, "bytes": nbytes}
+
+    # ---------------- INTERNAL ----------------
+    @staticmethod
+    def _snapshot(entry):
+        n = entry.n
+        return entry.vectors[:n], entry.ids[:n], entry.messages[:n], entry.replies[:n], entry.created[:n]
+
+    @staticmethod
+    def _top_k(snapshot, query_vec, top_k):
+        vectors, ids, messages, replies, created = snapshot
+        n = len(vectors)
+        if n == 0 or top_k <= 0:
+            return []
+        scores = np.dot(vectors, _normalize(query_vec))
+        k = min(top_k, n)
+        idx = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+        return [
+            {"id": ids[i], "message": messages[i], "reply": replies[i],
+             "distance": float(1.0 - scores[i]), "created_at": created[i]}
+            for i in idx
+        ]
+
+    def _lookup(self, shard, skey, now):
+        entry = shard.sessions.get(skey)
+        if entry is None:
+            return None
+        if now - entry.loaded_at > self.ttl:
+            self._drop(shard, skey)
+            return None
+        shard.sessions.move_to_end(skey)
+        return entry
+
+    def _load(self, user_id, session_id, skey, shard):
+        start = time.perf_counter()
+        leader = []
+
+        def fetch():
+            leader.append(True)
+            return self._fetch(user_id, session_id, skey, shard)
+
+        entry = self.flight.do(skey, fetch)
+        if not leader:
+            metrics.LOCK_WAIT_SECONDS.labels("session_vectors_load").observe(time.perf_counter() - start)
+        return entry
+
+    @staticmethod
+    def _mark_stale(shard, skey):
+        if skey in shard.loading:
+            shard.loading[skey] = True
+
+    def _fetch(self, user_id, session_id, skey, shard):
+        # single-flight: mỗi session tối đa một lần nạp đang chạy
+        with shard.lock:
+            shard.loading[skey] = False
+        self._count("loads")
+        # Mốc nạp = lúc bắt đầu đọc DB: lượt bị ẩn (worker khác) sau mốc này có thể chưa được lọc
+        started = time.time()
+        try:
+            entry = self._build(self.loader(user_id, session_id, self.max_rows + 1) or [], started)
+        except BaseException:
+            with shard.lock:
+                shard.loading.pop(skey, None)
+            raise
+        with self._locked(shard):
+            stale = shard.loading.pop(skey, False)
+            current = shard.sessions.get(skey)
+            if current is not None:
+                shard.sessions.move_to_end(skey)
+                return current
+            if not stale:
+                shard.sessions[skey] = entry
+                shard.nbytes += entry.nbytes
+                self._evict(shard)
+            return entry
+
+    def _build(self, rows, loaded_at):
+        if len(rows) > self.max_rows:
+            self._count("oversized")
+            return _Entry(0, 0, loaded_at, oversized=True)
+        rows = [r for r in rows if r.get("vec")]
+        entry = _Entry(len(rows[0]["vec"]) if rows else 0, len(rows) + 16, loaded_at)
+        for r in reversed(rows):
+            entry.add(r.get("id"), r.get("message") or "", r.get("reply") or "", r.get("created_at"), r["vec"])
+        return entry
+
+    def _drop(self, shard, skey):
+        entry = shard.sessions.pop(skey, None)
+        if entry is not None:
+            shard.nbytes -= entry.nbytes
+
+    def _evict(self, shard):
+        evicted = 0
+        while len(shard.sessions) > 1 and (len(shard.sessions) > self.max_sessions or shard.nbytes > self.max_bytes):
+            _, entry = shard.sessions.popitem(last=False)
+            shard.nbytes -= entry.nbytes
+            evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
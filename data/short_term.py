@@ -0,0 +1,225 @@
+"""
+Short-term history theo (user, session): các lượt hội thoại gần nhất, thứ tự cũ → mới.
+
+Mỗi session là một ring buffer (deque maxlen=SHORT_TERM_TURNS); cả store là LRU theo
+session, giới hạn SHORT_TERM_MAX_SESSIONS session và SHORT_TERM_MAX_BYTES bộ nhớ.
+- get(): chỉ đọc DB (loader) khi session chưa có trong store hoặc đã quá SHORT_TERM_TTL
+  (TTL giới hạn độ lệch khi lượt mới của session đi qua worker khác)
+- append(): lượt vừa trả lời được ghi thẳng vào buffer, không đọc lại DB
+- invalidate(): gọi khi soft delete (is_deleted) để lần đọc sau lấy lại từ DB
+
+Store chia thành SHORT_TERM_SHARDS shard theo hash(session), mỗi shard một lock riêng và
+chỉ giữ lock khi thao tác trên dict (không bao giờ trong lúc đọc DB). Các request cùng
+miss một session dùng chung một lần đọc DB (single-flight). Thời gian chờ lock / chờ lần
+đọc DB đang chạy được ghi vào chatbot_lock_wait_seconds{lock="short_term"|"short_term_load"}.
+"""
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from utils import metrics
+from utils.singleflight import SingleFlight
+
+SHORT_TERM_TURNS = int(os.getenv("SHORT_TERM_TURNS", "50"))
+SHORT_TERM_TTL = int(os.getenv("SHORT_TERM_TTL", "1800"))
+SHORT_TERM_MAX_SESSIONS = int(os.getenv("SHORT_TERM_MAX_SESSIONS", "5000"))
+SHORT_TERM_MAX_BYTES = int(os.getenv("SHORT_TERM_MAX_BYTES", str(64 * 1024 * 1024)))
+SHORT_TERM_SHARDS = int(os.getenv("SHORT_TERM_SHARDS", "16"))
+
+_TURN_OVERHEAD = sys.getsizeof({}) + 64
+
+
+def _turn_size(turn):
+    return _TURN_OVERHEAD + sys.getsizeof(turn["message"]) + sys.getsizeof(turn["reply"])
+
+
+class _Session:
+    __slots__ = ("turns", "nbytes", "loaded_at")
+
+    def __init__(self, capacity, loaded_at):
+        self.turns = deque(maxlen=capacity)
+        self.nbytes = 0
+        self.loaded_at = loaded_at
+
+    def add(self, turn):
+        """Thêm lượt vào cuối buffer, trả về số byte thay đổi (lượt cũ nhất bị đẩy ra khi đầy)."""
+        delta = _turn_size(turn)
+        if len(self.turns) == self.turns.maxlen:
+            delta -= _turn_size(self.turns[0])
+        self.turns.append(turn)
+        self.nbytes += delta
+        return delta
+
+
+class _Shard:
+    __slots__ = ("lock", "sessions", "nbytes", "version")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        # Tăng khi invalidate: lần nạp DB bắt đầu trước đó không được ghi vào store
+        self.version = 0
+
+
+class ShortTermStore:
+    def __init__(self, loader, capacity=SHORT_TERM_TURNS, ttl=SHORT_TERM_TTL,
+                 max_sessions=SHORT_TERM_MAX_SESSIONS, max_bytes=SHORT_TERM_MAX_BYTES,
+                 shards=SHORT_TERM_SHARDS):
+        """loader(user_id, session_id, n) → list lượt {"message", "reply"} thứ tự cũ → mới."""
+        self.loader = loader
+        self.capacity = capacity
+        self.ttl = ttl
+        self.shards = [_Shard() for _ in range(max(1, shards))]
+        # Giới hạn chia đều cho từng shard
+        self.max_sessions = max(1, max_sessions // len(self.shards))
+        self.max_bytes = max_bytes // len(self.shards)
+        self.flight = SingleFlight()
+        self.counters_lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "appends": 0, "evictions": 0, "loads": 0}
+
+    @staticmethod
+    def _skey(user_id, session_id):
+        return f"{user_id}:{session_id or 'global'}"
+
+    def _shard(self, skey):
+        return self.shards[hash(skey) % len(self.shards)]
+
+    @staticmethod
+    @contextmanager
+    def _locked(shard):
+        start = time.perf_counter()
+        with shard.lock:
+            metrics.LOCK_WAIT_SECONDS.labels("short_term").observe(time.perf_counter() - start)
+            yield
+
+    def _count(self, key, n=1):
+        with self.counters_lock:
+            self.counters[key] += n
+
+    # ---------------- PUBLIC ----------------
+    def get(self, user_id, session_id, limit=5):
+        skey = self._skey(user_id, session_id)
+        shard = self._shard(skey)
+        with self._locked(shard):
+            entry = self._lookup(shard, skey, time.time())
+            if entry is not None:
+                turns = self._tail(entry, limit)
+        if entry is not None:
+            self._count("hits")
+            metrics.cache_result("short_term", True)
+            return turns
+        self._count("misses")
+        metrics.cache_result("short_term", False)
+        entry = self._load(user_id, session_id, skey, shard)
+        with self._locked(shard):
+            return self._tail(entry, limit)
+
+    def append(self, user_id, session_id, message, reply):
+        turn = {"message": message or "", "reply": reply or ""}
+        skey = self._skey(user_id, session_id)
+        shard = self._shard(skey)
+        with self._locked(shard):
+            entry = self._lookup(shard, skey, time.time())
+            if entry is not None:
+                self._add(shard, skey, entry, turn)
+                return
+        # Session chưa có trong store: nạp từ DB rồi ghi thêm lượt mới. Write-behind có thể
+        # đã ghi lượt này xuống DB trước khi nạp → bỏ qua nếu trùng lượt cuối.
+        entry = self._load(user_id, session_id, skey, shard)
+        with self._locked(shard):
+            if not entry.turns or entry.turns[-1] != turn:
+                self._add(shard, skey, entry, turn)
+
+    def invalidate(self, user_id, session_id):
+        skey = self._skey(user_id, session_id)
+        shard = self._shard(skey)
+        with self._locked(shard):
+            self._drop(shard, skey)
+            shard.version += 1
+
+    def stats(self):
+        sessions = nbytes = 0
+        for shard in self.shards:
+            with shard.lock:
+                sessions += len(shard.sessions)
+                nbytes += shard.nbytes
+        with self.counters_lock:
+            return {**self.counters, "sessions": sessions, "bytes": nbytes, "shards": len(self.shards)}
+
+    # ---------------- INTERNAL (gọi trong shard.lock trừ _load / _fetch) ----------------
+    def _lookup(self, shard, skey, now):
+        entry = shard.sessions.get(skey)
+        if entry is None:
+            return None
+        if now - entry.loaded_at > self.ttl:
+            self._drop(shard, skey)
+            return None
+        shard.sessions.move_to_end(skey)
+        return entry
+
+    def _load(self, user_id, session_id, skey, shard):
+        """Nạp session từ DB; các thread cùng miss một session chờ chung một lần đọc."""
+        start = time.perf_counter()
+        leader = []
+
+        def fetch():
+            leader.append(True)
+            return self._fetch(user_id, session_id, skey, shard)
+
+        entry = self.flight.do(skey, fetch)
+        if not leader:
+            metrics.LOCK_WAIT_SECONDS.labels("short_term_load").observe(time.perf_counter() - start)
+        return entry
+
+    def _fetch(self, user_id, session_id, skey, shard):
+        with shard.lock:
+            version = shard.version
+        self._count("loads")
+        rows = self.loader(user_id, session_id, self.capacity) or []
+        entry = _Session(self.capacity, time.time())
+        for r in rows:
+            entry.add({"message": r.get("message") or "", "reply": r.get("reply") or ""})
+        with self._locked(shard):
+            # Thread khác đã ghi session trước (vd. append) thì dùng bản đó
+            current = shard.sessions.get(skey)
+            if current is not None:
+                shard.sessions.move_to_end(skey)
+                return current
+            # Bị invalidate (soft delete) trong lúc đọc DB → trả kết quả nhưng không cache
+            if shard.version == version:
+                shard.sessions[skey] = entry
+                shard.nbytes += entry.nbytes
+                self._evict(shard)
+            return entry
+
+    def _add(self, shard, skey, entry, turn):
+        delta = entry.add(turn)
+        self._count("appends")
+        # entry đã bị evict / invalidate sau khi nạp thì không đưa lại vào store
+        if shard.sessions.get(skey) is entry:
+            shard.nbytes += delta
+            self._evict(shard)
+
+    def _drop(self, shard, skey):
+        entry = shard.sessions.pop(skey, None)
+        if entry is not None:
+            shard.nbytes -= entry.nbytes
+
+    def _evict(self, shard):
+        evicted = 0
+        while len(shard.sessions) > 1 and (len(shard.sessions) > self.max_sessions or shard.nbytes > self.max_bytes):
+            _, entry = shard.sessions.popitem(last=False)
+            shard.nbytes -= entry.nbytes
+            evicted += 1
+        if evicted:
+            self._count("evictions", evicted)
+
+    @staticmethod
+    def _tail(entry, limit):
+        if limit <= 0:
+            return []
+        turns = list(entry.turns)
+        return turns[-limit:]
@@ -1,37 +1,47 @@
 import os
 import pickle
-from supabase import create_client
+import numpy as np
 from dotenv import load_dotenv
 from sklearn.feature_extraction.text import TfidfVectorizer
+from data import db_pool
+from data.lexical_index import LEXICAL_VECTORIZER_PATH
 
 load_dotenv()
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-VECTORIZER_PATH = "data/vectorizer.pkl"
+VECTORIZER_PATH = LEXICAL_VECTORIZER_PATH
+# Vocabulary đủ lớn để giữ tên riêng / con số / từ hiếm (mục đích của hybrid search)
+LEXICAL_MAX_FEATURES = int(os.getenv("LEXICAL_MAX_FEATURES", "50000"))
 
 def train_vectorizer():
     # 1. Lấy toàn bộ messages từ DB
-    res = supabase.table("messages_test").select("message").execute()
-    records = res.data
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT message FROM whoisme.messages WHERE is_deleted = FALSE AND message IS NOT NULL")
+        records = cur.fetchall()
 
     texts = [r["message"] for r in records if r.get("message")]
     if not texts:
         print("⚠️ Không có dữ liệu message nào trong DB để train.")
         return
 
-    # 2. Train TF-IDF
-    vectorizer = TfidfVectorizer(max_features=2000)
+    # 2. Train TF-IDF: unigram + bigram (từ ghép tiếng Việt), giữ token 1 ký tự (số, âm tiết)
+    vectorizer = TfidfVectorizer(
+        max_features=LEXICAL_MAX_FEATURES,
+        ngram_range=(1, 2),
+        token_pattern=r"(?u)\b\w+\b",
+        sublinear_tf=True,
+        dtype=np.float32,
+    )
     vectorizer.fit(texts)
 
-    # 3. Lưu vectorizer ra file pkl
-    os.makedirs("data", exist_ok=True)
-    with open(VECTORIZER_PATH, "wb") as f:
+    # 3. Lưu vectorizer ra file pkl (ghi file tạm rồi đổi tên: worker đang nạp không đọc file dở)
+    os.makedirs(os.path.dirname(VECTORIZER_PATH) or ".", exist_ok=True)
+    tmp = VECTORIZER_PATH + ".tmp"
+    with open(tmp, "wb") as f:
         pickle.dump(vectorizer, f)
+    os.replace(tmp, VECTORIZER_PATH)
 
-    print(f"✅ Vectorizer đã được train trên {len(texts)} messages và lưu vào {VECTORIZER_PATH}")
+    print(f"✅ Vectorizer đã được train trên {len(texts)} messages "
+          f"({len(vectorizer.vocabulary_)} term) và lưu vào {VECTORIZER_PATH}")
 
 if __name__ == "__main__":
     train_vectorizer()
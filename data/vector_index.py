@@ -0,0 +1,236 @@
+"""
+Quản lý index ANN (pgvector HNSW) cho whoisme.messages.embedding_vector.
+
+SQL_VECTOR_SEARCH sắp xếp theo `embedding_vector <=> q` (cosine distance) và luôn lọc
+`is_deleted = FALSE`, nên index là HNSW vector_cosine_ops partial trên đúng điều kiện đó
+(planner chỉ dùng partial index khi WHERE của truy vấn bao hàm điều kiện của index).
+
+    python -m data.vector_index create             # CREATE INDEX CONCURRENTLY (không khóa ghi)
+    python -m data.vector_index rebuild --m 24     # build index mới song song rồi đổi tên, bỏ index cũ
+    python -m data.vector_index verify             # hợp lệ? đúng tham số? planner có dùng không?
+    python -m data.vector_index drop
+    python -m benchmark.vector_index               # recall / latency so với exact search
+
+Truy vấn vector của app đặt `hnsw.ef_search` theo từng truy vấn bằng SET LOCAL (chỉ có hiệu
+lực trong transaction của lần mượn connection đó, xem search_sql). Index HNSW lọc user /
+session sau khi quét nên ef_search quá nhỏ có thể trả về ít hơn top_k dòng; pgvector ≥ 0.8
+có HNSW_ITERATIVE_SCAN=relaxed_order để quét tiếp tới khi đủ.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from data.db_pool import DB_URL
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_NAME = os.getenv("VECTOR_INDEX_NAME", "messages_embedding_hnsw_idx")
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+# "" (tắt) | relaxed_order | strict_order — chỉ đặt khi pgvector ≥ 0.8
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "")
+VECTOR_INDEX_MAINTENANCE_MEM = os.getenv("VECTOR_INDEX_MAINTENANCE_MEM", "512MB")
+
+SCHEMA = "whoisme"
+TABLE = "messages"
+COLUMN = "embedding_vector"
+OPCLASS = "vector_cosine_ops"
+PARTIAL_WHERE = "is_deleted = FALSE"
+
+_ITERATIVE_MODES = ("relaxed_order", "strict_order")
+
+
+# ---------------- SEARCH ----------------
+def search_sql(sql, ef_search=None, top_k=None):
+    """
+    Ghép SET LOCAL tham số HNSW trước truy vấn (một round trip, cùng transaction).
+    ef_search không nhỏ hơn top_k, nếu không HNSW trả về tối đa ef_search ứng viên.
+    """
+    ef = max(int(ef_search or HNSW_EF_SEARCH), int(top_k or 0))
+    settings = [f"SET LOCAL hnsw.ef_search = {ef};"]
+    if HNSW_ITERATIVE_SCAN in _ITERATIVE_MODES:
+        settings.append(f"SET LOCAL hnsw.iterative_scan = {HNSW_ITERATIVE_SCAN};")
+    return "\n".join(settings) + "\n" + sql
+
+
+# ---------------- DDL ----------------
+def index_sql(name=VECTOR_INDEX_NAME, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, partial=True,
+              concurrently=True):
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name} "
+        f"ON {SCHEMA}.{TABLE} USING hnsw ({COLUMN} {OPCLASS}) "
+        f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+        + (f" WHERE {PARTIAL_WHERE}" if partial else "")
+    )
+
+
+def connect(url=None):
+    """Connection riêng cho DDL: CREATE / DROP INDEX CONCURRENTLY cần autocommit, không dùng pool."""
+    url = url or DB_URL
+    if not url:
+        raise RuntimeError("Thiếu POSTGRES_URL (hoặc --pg-url)")
+    conn = psycopg2.connect(url, cursor_factory=RealDictCursor)
+    conn.autocommit = True
+    return conn
+
+
+def _exec(conn, sql, params=None):
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall() if cur.description else None
+
+
+def index_info(conn, name=VECTOR_INDEX_NAME):
+    rows = _exec(conn, """
+        SELECT i.indisvalid AS valid, i.indisready AS ready, pg_get_indexdef(i.indexrelid) AS definition,
+               pg_relation_size(i.indexrelid) AS bytes
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s
+    """, (SCHEMA, name))
+    return rows[0] if rows else None
+
+
+def _build(conn, name, m, ef_construction, partial):
+    _exec(conn, f"SET maintenance_work_mem = '{VECTOR_INDEX_MAINTENANCE_MEM}'")
+    start = time.perf_counter()
+    _exec(conn, index_sql(name, m, ef_construction, partial))
+    elapsed = time.perf_counter() - start
+    info = index_info(conn, name)
+    if not info or not info["valid"]:
+        # CONCURRENTLY lỗi giữa chừng để lại index INVALID, không được dùng nhưng vẫn tốn ghi
+        _exec(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.{name}")
+        raise RuntimeError(f"Build index {name} thất bại (index không hợp lệ đã được xóa)")
+    logger.info(f"[vector_index] Đã build {name} trong {elapsed:.1f}s ({info['bytes'] / 2**20:.1f}MB)")
+    return elapsed
+
+
+def create(conn, name=VECTOR_INDEX_NAME, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, partial=True):
+    """Tạo index nếu chưa có. Index cũ INVALID (build trước đó bị ngắt) thì build lại."""
+    info = index_info(conn, name)
+    if info and info["valid"]:
+        logger.info(f"[vector_index] {name} đã tồn tại")
+        return False
+    if info:
+        _exec(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.{name}")
+    _exec(conn, "ANALYZE whoisme.messages")
+    _build(conn, name, m, ef_construction, partial)
+    return True
+
+
+def rebuild(conn, name=VECTOR_INDEX_NAME, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, partial=True):
+    """
+    Build index mới (có thể đổi m / ef_construction / partial) song song với index đang chạy,
+    rồi đổi tên và bỏ index cũ: truy vấn luôn có index để dùng trong suốt quá trình.
+    """
+    tmp = f"{name}_new"
+    _exec(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.{tmp}")
+    _build(conn, tmp, m, ef_construction, partial)
+    old = f"{name}_old"
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"ALTER INDEX IF EXISTS {SCHEMA}.{name} RENAME TO {old}")
+            cur.execute(f"ALTER INDEX {SCHEMA}.{tmp} RENAME TO {name}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+    _exec(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.{old}")
+
+
+def drop(conn, name=VECTOR_INDEX_NAME):
+    _exec(conn, f"DROP INDEX CONCURRENTLY IF EXISTS {SCHEMA}.{name}")
+
+
+def explain_search(conn, sql, params, ef_search=None, top_k=None):
+    """Plan (text) của truy vấn vector với tham số HNSW như lúc app chạy."""
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(search_sql("SELECT 1", ef_search, top_k))
+            cur.execute("EXPLAIN " + sql, params)
+            return "\n".join(r["QUERY PLAN"] for r in cur.fetchall())
+    finally:
+        conn.rollback()
+        conn.autocommit = autocommit
+
+
+def verify(conn, name=VECTOR_INDEX_NAME, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, partial=True):
+    """Trả về list lỗi (rỗng = OK): tồn tại, hợp lệ, đúng tham số, planner chọn index."""
+    problems = []
+    info = index_info(conn, name)
+    if not info:
+        return [f"Chưa có index {name}"]
+    definition = info["definition"].lower()
+    if not info["valid"] or not info["ready"]:
+        problems.append(f"{name} không hợp lệ (build CONCURRENTLY bị ngắt?) → chạy create / rebuild")
+    expected = [
+        "using hnsw", OPCLASS, f"m='{int(m)}'", f"ef_construction='{int(ef_construction)}'",
+    ]
+    if partial:
+        expected.append("is_deleted = false")
+    for part in expected:
+        if part.replace(" ", "") not in definition.replace(" ", ""):
+            problems.append(f"Định nghĩa index thiếu `{part}`: {info['definition']}")
+
+    # Planner có chọn index cho top-k toàn bảng không (truy vấn lọc theo session thì planner có
+    # thể chọn btree (user_id, session_id) + sort chính xác khi session ít dòng, đó là plan đúng)
+    rows = _exec(conn, "SELECT embedding_vector::text AS v FROM whoisme.messages "
+                       "WHERE embedding_vector IS NOT NULL AND is_deleted = FALSE LIMIT 1")
+    if rows:
+        plan = explain_search(
+            conn,
+            "SELECT id FROM whoisme.messages WHERE is_deleted = FALSE "
+            "ORDER BY embedding_vector <=> %s::vector LIMIT 5",
+            (rows[0]["v"],),
+        )
+        if name not in plan:
+            problems.append(f"Planner không dùng {name} cho truy vấn top-k toàn bảng:\n{plan}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quản lý index HNSW của whoisme.messages")
+    parser.add_argument("command", choices=["create", "rebuild", "verify", "drop", "info"])
+    parser.add_argument("--pg-url", default=DB_URL)
+    parser.add_argument("--name", default=VECTOR_INDEX_NAME)
+    parser.add_argument("--m", type=int, default=HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--no-partial", action="store_true", help=f"index toàn bảng, không WHERE {PARTIAL_WHERE}")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    conn = connect(args.pg_url)
+    try:
+        partial = not args.no_partial
+        if args.command == "create":
+            create(conn, args.name, args.m, args.ef_construction, partial)
+        elif args.command == "rebuild":
+            rebuild(conn, args.name, args.m, args.ef_construction, partial)
+        elif args.command == "drop":
+            drop(conn, args.name)
+        elif args.command == "info":
+            print(index_info(conn, args.name))
+        else:
+            problems = verify(conn, args.name, args.m, args.ef_construction, partial)
+            for p in problems:
+                print(f"FAIL: {p}")
+            if problems:
+                return 1
+            print(f"OK: {args.name}")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
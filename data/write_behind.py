@@ -0,0 +1,347 @@
+"""
+Write-behind cho lượt hội thoại (whoisme.messages).
+
+Request chỉ enqueue; một thread nền gom các lượt thành micro-batch (tối đa
+WRITE_BEHIND_BATCH_SIZE lượt hoặc chờ WRITE_BEHIND_MAX_WAIT_MS), embed cả batch bằng
+embed_batch và ghi bằng một INSERT nhiều dòng. Lượt đã có vector (câu hỏi đã embed lúc truy
+xuất long-term trong cùng request, truyền qua submit(vector=...)) không encode lại.
+
+- Backpressure: hàng đợi giới hạn WRITE_BEHIND_MAX_QUEUE; đầy thì submit chờ tối đa
+  WRITE_BEHIND_ENQUEUE_TIMEOUT giây rồi ghi thẳng lượt đó ra spool trên đĩa thay vì giữ trong RAM
+- Batch ghi DB lỗi → spool ra đĩa, thử lại định kỳ (WRITE_BEHIND_REPLAY_INTERVAL). File replay
+  lỗi dữ liệu WRITE_BEHIND_MAX_REPLAYS lần (vi phạm constraint, DataError, payload hỏng) hoặc không
+  đọc được (JSON hỏng) được chuyển sang `*.bad` để xem tay, không chặn các file sau. Lỗi kết nối /
+  PoolTimeout không tính lần thử: file giữ nguyên và dừng replay tới lượt sau (DB sập lâu không
+  làm mất lượt)
+- stop() (atexit / gunicorn worker_exit / ASGI lifespan shutdown): ghi nốt hàng đợi, phần
+  không kịp ghi được spool; worker khởi động sau sẽ replay spool
+"""
+import os
+import json
+import time
+import glob
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+import numpy as np
+import psycopg2
+from psycopg2.pool import PoolError
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "64"))
+WRITE_BEHIND_MAX_WAIT_MS = int(os.getenv("WRITE_BEHIND_MAX_WAIT_MS", "200"))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "5000"))
+WRITE_BEHIND_ENQUEUE_TIMEOUT = float(os.getenv("WRITE_BEHIND_ENQUEUE_TIMEOUT", "0.05"))
+WRITE_BEHIND_REPLAY_INTERVAL = int(os.getenv("WRITE_BEHIND_REPLAY_INTERVAL", "30"))
+WRITE_BEHIND_MAX_REPLAYS = int(os.getenv("WRITE_BEHIND_MAX_REPLAYS", "10"))
+WRITE_BEHIND_SPOOL_DIR = os.getenv(
+    "WRITE_BEHIND_SPOOL_DIR", os.path.join(os.getenv("PROJECT_ROOT", "."), "logs", "write_behind")
+)
+
+_STOP = object()
+# Lỗi lặp lại y hệt ở mọi lần replay (dữ liệu / constraint / payload hỏng): tính vào WRITE_BEHIND_MAX_REPLAYS
+_PERMANENT_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError, KeyError, TypeError, ValueError)
+# DB mất kết nối / pool hết chỗ: giữ nguyên file, dừng replay tới lượt sau
+_TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+
+
+class WriteBehindQueue:
+    def __init__(self, embed_batch_fn, insert_batch_fn, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 max_wait_ms=WRITE_BEHIND_MAX_WAIT_MS, max_queue=WRITE_BEHIND_MAX_QUEUE,
+                 enqueue_timeout=WRITE_BEHIND_ENQUEUE_TIMEOUT, spool_dir=WRITE_BEHIND_SPOOL_DIR,
+                 replay_interval=WRITE_BEHIND_REPLAY_INTERVAL, max_replays=WRITE_BEHIND_MAX_REPLAYS):
+        self.embed_batch_fn = embed_batch_fn
+        self.insert_batch_fn = insert_batch_fn
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.enqueue_timeout = enqueue_timeout
+        self.spool_dir = spool_dir
+        self.replay_interval = replay_interval
+        self.max_replays = max_replays
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+        self.last_replay = 0
+        self.counters = {"written": 0, "batches": 0, "spooled": 0, "replayed": 0, "failed_batches": 0,
+                         "quarantined": 0}
+
+    # ---------------- PUBLIC ----------------
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, daemon=True, name="write-behind")
+            self.thread.start()
+        metrics.watch_queue("write_behind", self.queue.qsize)
+
+    def submit(self, user_id, message, reply=None, session_id=None, time_spent=None, vector=None):
+        turn = {
+            "user_id": str(user_id),
+            "session_id": session_id,
+            "message": message,
+            "reply": reply,
+            "time": time_spent,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        if vector is not None:
+            turn["vector"] = np.asarray(vector, dtype=np.float32).tolist()
+        if self.stopped:
+            self._spool([turn])
+            return False
+        try:
+            self.queue.put(turn, timeout=self.enqueue_timeout)
+            return True
+        except queue.Full:
+            logger.warning("[write_behind] Hàng đợi đầy, spool lượt hội thoại ra đĩa")
+            self._spool([turn])
+            return False
+
+    def stop(self, timeout=10):
+        """Ghi nốt hàng đợi; quá timeout thì spool phần còn lại."""
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        if self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            self.thread.join(timeout)
+        leftover = self._drain_nowait()
+        if leftover:
+            self._spool(leftover)
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "queued": self.queue.qsize()}
+
+    # ---------------- WORKER ----------------
+    def _count(self, key, n=1):
+        with self.lock:
+            self.counters[key] += n
+        if key in ("written", "spooled", "replayed"):
+            metrics.PERSIST_TURNS.labels(key).inc(n)
+
+    def _drain_nowait(self):
+        items = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is not _STOP:
+                items.append(item)
+
+    def _next_batch(self):
+        """Chờ lượt đầu tiên, sau đó gom thêm tới batch_size hoặc hết max_wait. Trả về (batch, stop)."""
+        try:
+            first = self.queue.get(timeout=1)
+        except queue.Empty:
+            return [], False
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        try:
+            self._replay_spool()
+        except Exception as e:
+            logger.error(f"[write_behind] Replay spool lỗi: {e}")
+        while True:
+            # Lỗi bất kỳ không được làm chết thread: submit sau đó sẽ vào hàng đợi không ai đọc
+            try:
+                batch, stop = self._next_batch()
+                if batch:
+                    self._flush(batch)
+                if stop:
+                    # Những lượt vào sau _STOP vẫn được ghi trước khi thoát
+                    rest = self._drain_nowait()
+                    for i in range(0, len(rest), self.batch_size):
+                        self._flush(rest[i:i + self.batch_size])
+                    return
+                if time.monotonic() - self.last_replay > self.replay_interval:
+                    self._replay_spool()
+            except Exception as e:
+                logger.error(f"[write_behind] Lỗi thread ghi: {e}")
+
+    def _embed(self, turns):
+        """embed_batch bỏ qua text rỗng nên map lại theo index; text rỗng → None."""
+        vectors = [t.get("vector") for t in turns]
+        reused = sum(v is not None for v in vectors)
+        if reused:
+            metrics.EMBEDDING_REUSED.labels("persist").inc(reused)
+        idx = [i for i, t in enumerate(turns)
+               if vectors[i] is None and t["message"] and t["message"].strip()]
+        if idx:
+            embedded = self.embed_batch_fn([turns[i]["message"] for i in idx])
+            for i, vec in zip(idx, np.asarray(embedded)):
+                vectors[i] = vec.tolist()
+        return vectors
+
+    def _rows(self, turns):
+        vectors = self._embed(turns)
+        return [
+            (t["user_id"], t["session_id"], t["message"], t["reply"], vec, t["time"], t["created_at"])
+            for t, vec in zip(turns, vectors)
+        ]
+
+    def _write(self, turns):
+        with metrics.EMBEDDING_SECONDS.labels("persist").time():
+            rows = self._rows(turns)
+        self.insert_batch_fn(rows)
+
+    def _flush(self, turns):
+        try:
+            self._write(turns)
+            self._count("written", len(turns))
+            self._count("batches")
+        except Exception as e:
+            logger.error(f"[write_behind] Ghi batch {len(turns)} lượt lỗi, spool ra đĩa: {e}")
+            self._count("failed_batches")
+            self._spool(turns)
+
+    # ---------------- SPOOL ----------------
+    @staticmethod
+    def _write_spool_file(path, turns):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for t in turns:
+                f.write(json.dumps(t, ensure_ascii=False) + "\n")
+        os.replace(tmp, path)
+
+    def _spool(self, turns):
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._write_spool_file(os.path.join(self.spool_dir, f"turns-{os.getpid()}-{time.time_ns()}.jsonl"), turns)
+            self._count("spooled", len(turns))
+        except Exception as e:
+            logger.error(f"[write_behind] Không spool được {len(turns)} lượt: {e}")
+
+    def _quarantine(self, claimed, path, turns=None):
+        """Chuyển file (hoặc phần turns còn lại) sang `<path>.bad`, không replay nữa."""
+        bad = f"{path}.bad"
+        if turns is None:
+            os.replace(claimed, bad)
+        else:
+            self._write_spool_file(bad, turns)
+            os.remove(claimed)
+        self._count("quarantined")
+        logger.error(f"[write_behind] Đã chuyển {os.path.basename(path)} sang {os.path.basename(bad)}")
+
+    def _recover_claims(self):
+        """File `.replaying-<pid>` của process đã chết (hoặc lần replay trước của chính process này bị ngắt) → trả lại spool."""
+        for claimed in glob.glob(os.path.join(self.spool_dir, "turns-*.jsonl.replaying-*")):
+            path, _, pid = claimed.rpartition(".replaying-")
+            try:
+                pid = int(pid)
+                if pid != os.getpid():
+                    os.kill(pid, 0)
+                    continue
+            except ProcessLookupError:
+                pass
+            except (ValueError, OSError):
+                continue
+            try:
+                os.replace(claimed, path)
+            except OSError:
+                pass
+
+    def _replay_spool(self):
+        self.last_replay = time.monotonic()
+        self._recover_claims()
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "turns-*.jsonl"))):
+            # rename để các worker khác không replay trùng file
+            claimed = f"{path}.replaying-{os.getpid()}"
+            try:
+                os.replace(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed, encoding="utf-8") as f:
+                    turns = [json.loads(line) for line in f if line.strip()]
+            except (OSError, ValueError) as e:
+                logger.error(f"[write_behind] Không đọc được {os.path.basename(path)}: {e}")
+                try:
+                    self._quarantine(claimed, path)
+                except OSError as e:
+                    logger.error(f"[write_behind] Không chuyển được {os.path.basename(path)} sang .bad: {e}")
+                continue
+            written = 0
+            try:
+                for i in range(0, len(turns), self.batch_size):
+                    batch = turns[i:i + self.batch_size]
+                    self._write(batch)
+                    written += len(batch)
+            except Exception as e:
+                # Chỉ giữ lại phần chưa ghi để lần sau thử tiếp, tránh chèn trùng
+                remaining = turns[written:]
+                permanent = isinstance(e, _PERMANENT_ERRORS)
+                attempts = max(t.get("replay_attempts", 0) for t in remaining) + (1 if permanent else 0)
+                try:
+                    if permanent and attempts >= self.max_replays:
+                        self._quarantine(claimed, path, remaining)
+                    elif written or permanent:
+                        for t in remaining:
+                            t["replay_attempts"] = attempts
+                        self._write_spool_file(path, remaining)
+                        os.remove(claimed)
+                    else:
+                        os.replace(claimed, path)
+                except Exception as e2:
+                    # Giữ file claimed: lần replay sau (_recover_claims) trả lại spool, không mất lượt
+                    logger.error(f"[write_behind] Không ghi lại được {os.path.basename(path)}: {e2}")
+                if isinstance(e, _TRANSIENT_ERRORS):
+                    # DB / pool chưa sẵn sàng: không tính lần thử, không thử tiếp các file sau
+                    logger.warning(f"[write_behind] Replay {os.path.basename(path)} tạm dừng, DB chưa sẵn sàng: {e}")
+                    break
+                if permanent:
+                    logger.error(f"[write_behind] Replay {os.path.basename(path)} lỗi (lần {attempts}): {e}")
+                else:
+                    logger.error(f"[write_behind] Replay {os.path.basename(path)} lỗi, thử lại lượt sau: {e}")
+                continue
+            finally:
+                if written:
+                    self._count("replayed", written)
+            os.remove(claimed)
+            logger.info(f"[write_behind] Đã replay {written} lượt từ {os.path.basename(path)}")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """WriteBehindQueue dùng chung trong process, tạo và start ở lần gọi đầu."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                from data.embed_messages import embedder
+                from data.import_data import insert_messages_batch
+                writer = WriteBehindQueue(embedder.embed_batch, insert_messages_batch)
+                writer.start()
+                atexit.register(writer.stop)
+                _writer = writer
+    return _writer
+
+def shutdown(timeout=10):
+    if _writer is not None:
+        _writer.stop(timeout)
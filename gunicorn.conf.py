@@ -1,6 +1,7 @@
 # Gunicorn configuration file
 import multiprocessing
 import os
+import shutil
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -11,9 +12,17 @@ PROJECT_ROOT = os.getenv('PROJECT_ROOT', '/home/chatbotySia/chatbot.whoisme.ai')
 bind = "127.0.0.1:8200"
 backlog = 2048
 
+# Serving mode: "sync" (Flask WSGI, ai_bot:app) hoặc "asgi" (asyncio, asgi_app:app)
+SERVING_MODE = os.getenv("SERVING_MODE", "sync")
+
 # Worker processes
 workers = 4  # Giảm workers để tiết kiệm memory
-worker_class = "sync"
+if SERVING_MODE == "asgi":
+    wsgi_app = "asgi_app:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "ai_bot:app"
+    worker_class = "sync"
 worker_connections = 1000
 timeout = 120  # Tăng timeout lên 120s cho AI API calls
 keepalive = 2
@@ -44,4 +53,55 @@ tmp_upload_dir = "/tmp"
 raw_env = [
     f'PYTHONPATH={PROJECT_ROOT}/chatbot_base',
     f'PROJECT_ROOT={PROJECT_ROOT}'
-]
\ No newline at end of file
+]
+
+# Prometheus multiprocess: mỗi worker ghi metrics ra file riêng, /metrics gộp lại khi scrape
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", f"{PROJECT_ROOT}/logs/prometheus")
+
+# Server hooks
+_embed_sidecar = None
+
+def on_starting(server):
+    # Bỏ metrics của lần chạy trước (pid cũ) trước khi fork worker
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Embedding sidecar: một process giữ model cho mọi worker, chờ sẵn sàng rồi mới fork worker
+    if os.getenv("EMBED_SIDECAR") == "1" and os.getenv("EMBED_SIDECAR_SPAWN", "1") == "1":
+        from data import embed_sidecar
+        global _embed_sidecar
+        _embed_sidecar = embed_sidecar.spawn(cwd=os.path.dirname(os.path.abspath(__file__)))
+        dim = embed_sidecar.wait_ready(proc=_embed_sidecar)
+        server.log.info(f"Embedding sidecar ready (pid {_embed_sidecar.pid}, dim={dim})")
+
+def on_exit(server):
+    if _embed_sidecar is not None and _embed_sidecar.poll() is None:
+        _embed_sidecar.terminate()
+        try:
+            _embed_sidecar.wait(timeout=10)
+        except Exception:
+            _embed_sidecar.kill()
+
+def child_exit(server, worker):
+    # Gauge "live*" của worker đã chết không còn được tính
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def worker_exit(server, worker):
+    # Ghi nốt các lượt hội thoại đang chờ trong write-behind (phần còn lại được spool ra đĩa)
+    from data import write_behind, db_pool
+    write_behind.shutdown()
+    db_pool.close()
+
+def post_fork(server, worker):
+    import threading
+    # Mở sẵn kết nối keep-alive tới API WhoIsMe và provider của model config đang dùng
+    # (tải config trước để biết provider) ở thread nền để không chặn worker khởi động
+    def _prewarm_upstream():
+        from model import upstream_hosts
+        from utils import http_client
+        http_client.prewarm(upstream_hosts())
+    threading.Thread(target=_prewarm_upstream, daemon=True, name="http-prewarm").start()
+    # Mở sẵn DB_POOL_MIN kết nối PostgreSQL ở thread nền để không chặn worker khởi động
+    from data import db_pool
+    threading.Thread(target=db_pool.prewarm, daemon=True, name="db-pool-prewarm").start()
@@ -2,20 +2,17 @@ from flask import Blueprint, request, jsonify, session
 import os
 import sys
 import bcrypt
-import psycopg2
-from psycopg2.extras import RealDictCursor
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from utils.jwt_helper import generate_jwt_token
+from data import db_pool
 
 login_bp = Blueprint("login", __name__)
 
 # ================== Kết nối PostgreSQL local ==================
-LOCAL_DB_URL = os.getenv("POSTGRES_URL")
-
 def get_connection():
-    """Tạo kết nối đến PostgreSQL local"""
-    return psycopg2.connect(LOCAL_DB_URL, cursor_factory=RealDictCursor)
+    """Mượn kết nối PostgreSQL từ pool dùng chung (dùng với `with`)"""
+    return db_pool.connection()
 
 
 # ================== LOGIN THƯỜNG ==================
@@ -29,12 +26,9 @@ def login():
         return jsonify({"error": "Thiếu email hoặc password"}), 400
 
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM whoisme.users WHERE email = %s LIMIT 1;", (email,))
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT * FROM whoisme.users WHERE email = %s LIMIT 1;", (email,))
+            user = cur.fetchone()
     except Exception as e:
         print("❌ Lỗi kết nối PostgreSQL:", e)
         return jsonify({"error": "Lỗi máy chủ"}), 500
@@ -64,12 +58,9 @@ def api_login():
         return jsonify({"error": "Thiếu email hoặc password"}), 400
 
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM whoisme.users WHERE email = %s LIMIT 1;", (email,))
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT * FROM whoisme.users WHERE email = %s LIMIT 1;", (email,))
+            user = cur.fetchone()
     except Exception as e:
         print("❌ Lỗi kết nối PostgreSQL:", e)
         return jsonify({"error": "Lỗi máy chủ"}), 500
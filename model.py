@@ -1,8 +1,13 @@
 from langchain_openai import ChatOpenAI
 import os
-import requests
+import time
+import hashlib
+import threading
 import json
+import httpx
+from collections import OrderedDict
 from dotenv import load_dotenv
+from utils import http_client, tracing
 
 load_dotenv()
 
@@ -13,6 +18,12 @@ google_api_key = os.getenv("GOOGLE_API_KEY")
 deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
 grok_api_key = os.getenv("GROK_API_KEY")
 openai_api_key = os.getenv("OPEN_API_KEY")
+# Trỏ các model OpenAI sang endpoint tương thích khác (vd. fake server trong benchmark/)
+openai_base_url = os.getenv("OPENAI_BASE_URL") or None
+
+def openai_http_clients():
+    # ChatOpenAI dùng chung connection pool của utils.http_client
+    return {"http_client": http_client.get_client(), "http_async_client": http_client.get_async_client()}
 
 # ======================
 # Base wrapper classes
@@ -30,6 +41,13 @@ class ModelWrapper:
         except Exception as e:
             yield type('obj', (object,), {'content': f"Error with {self.name}: {str(e)}"})
 
+    async def astream(self, prompt):
+        try:
+            async for chunk in self.model.astream(prompt):
+                yield chunk
+        except Exception as e:
+            yield type('obj', (object,), {'content': f"Error with {self.name}: {str(e)}"})
+
     def invoke(self, prompt):
         try:
             if self.system_prompt:
@@ -49,53 +67,125 @@ class DummyModel:
         self.msg = msg
     def stream(self, prompt):
         yield type('obj', (object,), {'content': self.msg})
+    async def astream(self, prompt):
+        yield type('obj', (object,), {'content': self.msg})
     def invoke(self, prompt):
         return type('obj', (object,), {'content': self.msg})
 
 # ======================
 # Gemini wrapper
 # ======================
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
+GEMINI_ROLES = {"user": "user", "human": "user", "assistant": "model", "ai": "model", "model": "model"}
+
+def _chunk(text):
+    return type('obj', (object,), {'content': text})
+
 class GeminiAPIWrapper:
     def __init__(self, model_name, api_key, temperature=0.7, max_output_tokens=2048):
         self.model_name = model_name
         self.api_key = api_key
         self.temperature = temperature
         self.max_output_tokens = max_output_tokens
-        self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}"
+        self.base_url = f"{GEMINI_API_BASE}/{model_name}"
+
+    @staticmethod
+    def _role_and_text(msg):
+        if isinstance(msg, dict):
+            return msg.get("role", "user"), msg.get("content", "")
+        return getattr(msg, "type", "user"), getattr(msg, "content", str(msg))
+
+    def _build_payload(self, prompt):
+        """system → systemInstruction, user/assistant → contents (role user/model), gộp các lượt liền nhau cùng role."""
+        messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": str(prompt)}]
+        system_parts, contents = [], []
+        for msg in messages:
+            role, text = self._role_and_text(msg)
+            if not text:
+                continue
+            if role == "system":
+                system_parts.append({"text": text})
+                continue
+            role = GEMINI_ROLES.get(role, "user")
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"].append({"text": text})
+            else:
+                contents.append({"role": role, "parts": [{"text": text}]})
+
+        payload = {
+            "contents": contents,
+            "generationConfig": {
+                "temperature": self.temperature,
+                "maxOutputTokens": self.max_output_tokens
+            }
+        }
+        if system_parts:
+            payload["systemInstruction"] = {"parts": system_parts}
+        return payload
 
-    def _prepare_prompt(self, prompt):
-        if isinstance(prompt, list):
-            return "\n".join([msg.get("content", str(msg)) for msg in prompt])
-        return str(prompt)
+    @staticmethod
+    def _extract_text(data):
+        parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+        return "".join(p.get("text", "") for p in parts)
 
     def invoke(self, prompt):
         try:
-            prompt_text = self._prepare_prompt(prompt)
-            payload = {
-                "contents": [{"parts": [{"text": prompt_text}]}],
-                "generationConfig": {
-                    "temperature": self.temperature,
-                    "maxOutputTokens": self.max_output_tokens
-                }
-            }
-            response = requests.post(
-                f"{self.base_url}:generateContent?key={self.api_key}",
-                headers={"Content-Type": "application/json"},
-                json=payload,
+            response = http_client.post(
+                f"{self.base_url}:generateContent",
+                params={"key": self.api_key},
+                json=self._build_payload(prompt),
                 timeout=15
             )
             if response.status_code == 200:
-                data = response.json()
-                text = (
-                    data.get("candidates", [{}])[0]
-                    .get("content", {})
-                    .get("parts", [{}])[0]
-                    .get("text", "Không có phản hồi từ Gemini")
-                )
-                return type('obj', (object,), {'content': text})
-            return type('obj', (object,), {'content': f"Gemini API error {response.status_code}: {response.text[:80]}"})
+                text = self._extract_text(response.json()) or "Không có phản hồi từ Gemini"
+                return _chunk(text)
+            return _chunk(f"Gemini API error {response.status_code}: {response.text[:80]}")
+        except Exception as e:
+            return _chunk(f"Gemini error: {str(e)}")
+
+    def stream(self, prompt):
+        try:
+            with http_client.get_client().stream(
+                "POST",
+                f"{self.base_url}:streamGenerateContent",
+                params={"alt": "sse", "key": self.api_key},
+                json=self._build_payload(prompt),
+                timeout=httpx.Timeout(30, connect=5)
+            ) as response:
+                if response.status_code != 200:
+                    response.read()
+                    yield _chunk(f"Gemini API error {response.status_code}: {response.text[:80]}")
+                    return
+                for line in response.iter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    text = self._extract_text(json.loads(line[5:]))
+                    if text:
+                        yield _chunk(text)
+        except Exception as e:
+            yield _chunk(f"Gemini error: {str(e)}")
+
+    async def astream(self, prompt):
+        try:
+            async with http_client.get_async_client().stream(
+                "POST",
+                f"{self.base_url}:streamGenerateContent",
+                params={"alt": "sse", "key": self.api_key},
+                json=self._build_payload(prompt),
+                timeout=httpx.Timeout(30, connect=5)
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    yield _chunk(f"Gemini API error {response.status_code}: {response.text[:80]}")
+                    return
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    text = self._extract_text(json.loads(line[5:]))
+                    if text:
+                        yield _chunk(text)
         except Exception as e:
-            return type('obj', (object,), {'content': f"Gemini error: {str(e)}"})
+            yield _chunk(f"Gemini error: {str(e)}")
 
 # ======================
 # Các nhóm model
@@ -109,7 +199,8 @@ def init_deepseek_models():
                     temperature=0.7,
                     api_key=deepseek_api_key, 
                     base_url="https://api.deepseek.com", 
-                    timeout=30
+                    timeout=30,
+                    **openai_http_clients()
                     ),
                 "DeepSeek Chat"),
             "deepseek-reasoner": ModelWrapper(
@@ -118,7 +209,8 @@ def init_deepseek_models():
                     temperature=0.7,
                     api_key=deepseek_api_key, 
                     base_url="https://api.deepseek.com", 
-                    timeout=30
+                    timeout=30,
+                    **openai_http_clients()
                     ),
                 "DeepSeek Reasoner")
         }
@@ -137,7 +229,8 @@ def init_grok_models():
                     temperature=0.7,
                     api_key=grok_api_key, 
                     base_url=base, 
-                    timeout=30), 
+                    timeout=30,
+                    **openai_http_clients()), 
                     "Grok 2"
                     ),
             "grok-3": ModelWrapper(
@@ -146,7 +239,8 @@ def init_grok_models():
                     temperature=0.7,
                     api_key=grok_api_key, 
                     base_url=base, 
-                    timeout=30), 
+                    timeout=30,
+                    **openai_http_clients()), 
                     "Grok 3"),
             "grok-4": ModelWrapper(
                 ChatOpenAI(
@@ -154,7 +248,8 @@ def init_grok_models():
                     temperature=0.7,
                     api_key=grok_api_key, 
                     base_url=base, 
-                    timeout=30), 
+                    timeout=30,
+                    **openai_http_clients()), 
                     "Grok 4"),
         }
     return {f"grok-{i}": DummyModel("Grok API key chưa được cấu hình") for i in [2, 3, 4]}
@@ -198,7 +293,9 @@ def init_openai_models():
                     temperature=cfg["temperature"],
                     max_tokens=cfg["max_tokens"],
                     api_key=openai_api_key,
-                    timeout=30
+                    base_url=openai_base_url,
+                    timeout=30,
+                    **openai_http_clients()
                 ),
                 name
             )
@@ -224,38 +321,153 @@ models.update({
 # ======================
 # API CONFIG LOADER
 # ======================
-def load_prompt_config():
+PROMPT_CONFIG_URL = os.getenv("PROMPT_CONFIG_URL", "https://prompt.whoisme.ai/api/public/prompt/chatgpt_prompt_chatbot")
+CONFIG_REFRESH_INTERVAL = int(os.getenv("PROMPT_CONFIG_REFRESH", "60"))
+# Cache còn trống mà tải config lỗi: các request trong khoảng này dùng model mặc định, không gọi API lại
+CONFIG_RETRY_INTERVAL = float(os.getenv("PROMPT_CONFIG_RETRY", "10"))
+CLIENT_POOL_SIZE = 16
+
+# Config hiện hành + version tăng mỗi khi nội dung config đổi
+CONFIG_CACHE = {"config": None, "hash": None, "version": 0, "timestamp": 0, "retry_at": 0}
+CONFIG_LOCK = threading.Lock()
+_updater_started = False
 
-    url = "https://prompt.whoisme.ai/api/public/prompt/chatgpt_prompt_chatbot"
+# Model client đã dựng sẵn, key = hash của config (model, temperature, max_tokens, top_p, penalties)
+CLIENT_POOL = OrderedDict()
+CLIENT_POOL_LOCK = threading.Lock()
+
+def parse_prompt_config(data: dict) -> dict:
+    return {
+        "model": data.get("model", "gpt-4o"),
+        "temperature": data.get("temperature", 0.7),
+        "max_tokens": data.get("maxTokens", 2001),
+        "top_p": data.get("topP", 1),
+        "frequency_penalty": data.get("frequencyPenalty", 0),
+        "presence_penalty": data.get("presencePenalty", 0),
+    }
+
+def config_hash(config: dict) -> str:
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+def fetch_prompt_config():
+    resp = http_client.get(PROMPT_CONFIG_URL, timeout=10)
+    return parse_prompt_config(resp.json().get("data", {}))
+
+def refresh_prompt_config():
     try:
-        resp = requests.get(url, timeout=10)
-        data = resp.json().get("data", {})
-        model_key = data.get("model", "gpt-4o")
-        temperature = data.get("temperature", 0.7)
-        max_tokens = data.get("maxTokens", 2001)
-        top_p = data.get("topP", 1)
-        freq_penalty = data.get("frequencyPenalty", 0)
-        pres_penalty = data.get("presencePenalty", 0)
-
-        model = models.get(model_key) or models.get("gpt-4o")
-        print(f"🔧 Loaded prompt config: {model_key} ({temperature}, max={max_tokens})")
-
-        # Nếu là OpenAI ChatOpenAI → tạo lại instance với config mới
-        if isinstance(model, ModelWrapper) and isinstance(model.model, ChatOpenAI):
-            model.model = ChatOpenAI(
-                model=model_key,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                frequency_penalty=freq_penalty,
-                presence_penalty=pres_penalty,
-                api_key=openai_api_key,
-                timeout=30
-            )
-        return model
+        config = fetch_prompt_config()
     except Exception as e:
         print(f"Lỗi khi tải prompt config: {e}")
-        return models.get("gpt-4o")
+        CONFIG_CACHE["retry_at"] = time.monotonic() + CONFIG_RETRY_INTERVAL
+        return CONFIG_CACHE["config"]
+
+    digest = config_hash(config)
+    with CONFIG_LOCK:
+        if digest != CONFIG_CACHE["hash"]:
+            CONFIG_CACHE.update({
+                "config": config,
+                "hash": digest,
+                "version": CONFIG_CACHE["version"] + 1,
+            })
+            print(f"🔧 Loaded prompt config v{CONFIG_CACHE['version']}: {config['model']} "
+                  f"({config['temperature']}, max={config['max_tokens']})")
+        CONFIG_CACHE["timestamp"] = time.time()
+    return config
+
+def background_config_updater(interval=CONFIG_REFRESH_INTERVAL):
+    while True:
+        time.sleep(interval)
+        refresh_prompt_config()
+
+def start_config_updater():
+    global _updater_started
+    with CONFIG_LOCK:
+        if _updater_started:
+            return
+        _updater_started = True
+    threading.Thread(target=background_config_updater, daemon=True).start()
+
+def _build_client(config: dict):
+    model_key = config["model"]
+    base = models.get(model_key) or models.get("gpt-4o")
+
+    # Model không phải ChatOpenAI (Gemini, Dummy) → dùng instance có sẵn
+    if not (isinstance(base, ModelWrapper) and isinstance(base.model, ChatOpenAI)):
+        return base
+
+    # Giữ base_url / api_key của provider (DeepSeek, Grok, OpenAI), chỉ đổi tham số sinh
+    return ModelWrapper(
+        ChatOpenAI(
+            model=base.model.model_name,
+            temperature=config["temperature"],
+            max_tokens=config["max_tokens"],
+            top_p=config["top_p"],
+            frequency_penalty=config["frequency_penalty"],
+            presence_penalty=config["presence_penalty"],
+            api_key=base.model.openai_api_key,
+            base_url=base.model.openai_api_base,
+            timeout=30,
+            **openai_http_clients()
+        ),
+        base.name
+    )
+
+def get_pooled_client(config: dict):
+    digest = config_hash(config)
+    with CLIENT_POOL_LOCK:
+        client = CLIENT_POOL.get(digest)
+        if client is not None:
+            CLIENT_POOL.move_to_end(digest)
+            return client
+
+    client = _build_client(config)
+    with CLIENT_POOL_LOCK:
+        client = CLIENT_POOL.setdefault(digest, client)
+        while len(CLIENT_POOL) > CLIENT_POOL_SIZE:
+            CLIENT_POOL.popitem(last=False)
+    return client
+
+def resolve_model_key(config) -> str:
+    """Key trong `models` mà config trỏ tới (model không có trong `models` → gpt-4o như _build_client)."""
+    key = (config or {}).get("model")
+    return key if key in models and models[key] is not None else "gpt-4o"
+
+def load_model():
+    """(key trong `models`, model client) theo config đang cache; key dùng làm label metrics.
+
+    Chỉ gọi mạng khi cache config còn trống (tối đa một lần mỗi CONFIG_RETRY_INTERVAL nếu API lỗi).
+    """
+    start_config_updater()
+    with tracing.span("config.load", **{"config.cached": bool(CONFIG_CACHE["config"])}):
+        config = CONFIG_CACHE["config"]
+        if config is None and time.monotonic() >= CONFIG_CACHE["retry_at"]:
+            config = refresh_prompt_config()
+        if not config:
+            return "gpt-4o", models.get("gpt-4o")
+        try:
+            return resolve_model_key(config), get_pooled_client(config)
+        except Exception as e:
+            print(f"Lỗi khi dựng model client: {e}")
+            return "gpt-4o", models.get("gpt-4o")
+
+def load_prompt_config():
+    """Trả về model theo config đang cache. Không gọi mạng, trừ lần đầu khi cache còn trống."""
+    return load_model()[1]
+
+def provider_host(model):
+    """Host LLM provider mà model gọi tới; None nếu model không gọi mạng (DummyModel)."""
+    if isinstance(model, GeminiAPIWrapper):
+        url = model.base_url
+    elif isinstance(model, ModelWrapper) and isinstance(model.model, ChatOpenAI):
+        url = model.model.openai_api_base or "https://api.openai.com/v1"
+    else:
+        return None
+    return httpx.URL(url).host
+
+def upstream_hosts():
+    """Host cần prewarm: API WhoIsMe + provider của model theo config (nạp config nếu cache còn trống)."""
+    host = provider_host(load_model()[1])
+    return http_client.API_HOSTS + ([host] if host and host not in http_client.API_HOSTS else [])
 
 # ======================
 # Test usage
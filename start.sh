@@ -36,7 +36,7 @@ start() {
     fi
     
     # Start the application
-    gunicorn --config gunicorn.conf.py ai_bot:app &
+    gunicorn --config gunicorn.conf.py &
     
     echo "Application started successfully"
     sleep 2
@@ -59,7 +59,7 @@ stop() {
     else
         echo "PID file not found. Application may not be running."
         # Try to kill by process name
-        pkill -f "gunicorn.*ai_bot:app"
+        pkill -f "gunicorn --config .*gunicorn.conf.py"
     fi
 }
 
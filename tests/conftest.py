@@ -0,0 +1,5 @@
+"""Unit test cho các cấu trúc dữ liệu trong process (không cần DB / model / mạng)."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,235 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+from data import db_pool
+from data.db_pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        if self.conn.dead:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.conn.executed.append(sql)
+        self.conn.info.transaction_status = extensions.TRANSACTION_STATUS_INTRANS
+
+
+class FakeConn:
+    def __init__(self, n):
+        self.n = n
+        self.closed = 0
+        self.dead = False
+        self.commits = 0
+        self.rollbacks = 0
+        self.executed = []
+        self.info = SimpleNamespace(transaction_status=extensions.TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        if self.dead:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.rollbacks += 1
+        self.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    conns = []
+
+    def connect(dsn, **kwargs):
+        conn = FakeConn(len(conns))
+        conns.append(conn)
+        return conn
+
+    monkeypatch.setattr(db_pool.psycopg2, "connect", connect)
+    return conns
+
+
+def make_pool(**kwargs):
+    opts = dict(minconn=1, maxconn=2, timeout=0.2, check_idle=30, max_lifetime=1800)
+    opts.update(kwargs)
+    return ConnectionPool("postgres://test", **opts)
+
+
+def test_reuses_connection_and_commits(opened):
+    pool = make_pool()
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("INSERT 1")
+    with pool.connection() as again:
+        pass
+    assert again is conn and len(opened) == 1
+    assert conn.commits == 2
+    assert pool.stats() == {"idle": 1, "in_use": 0, "max": 2}
+
+
+def test_exception_rolls_back_and_keeps_connection(opened):
+    pool = make_pool()
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            conn.cursor().execute("UPDATE 1")
+            raise ValueError("lỗi ứng dụng")
+    assert conn.rollbacks == 1 and conn.commits == 0
+    assert pool.stats()["idle"] == 1
+
+
+def test_broken_connection_is_dropped(opened):
+    pool = make_pool()
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            conn.dead = True
+            conn.cursor().execute("SELECT 1")
+    assert conn.closed and pool.stats()["idle"] == 0
+    with pool.connection() as fresh:
+        pass
+    assert fresh is not conn and len(opened) == 2
+
+
+def test_open_transaction_is_rolled_back_on_release(opened):
+    pool = make_pool()
+    with pool.connection() as conn:
+        try:
+            conn.cursor().execute("SELECT 1")
+            raise RuntimeError
+        except RuntimeError:
+            pass   # caller tự nuốt exception, không commit
+        conn.info.transaction_status = extensions.TRANSACTION_STATUS_INERROR
+        conn.commit = lambda: None   # commit không làm gì (như psycopg2 khi transaction aborted)
+    assert conn.rollbacks == 1
+    assert conn.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE
+    assert pool.stats()["idle"] == 1
+
+
+def test_timeout_when_exhausted_then_waiter_is_woken(opened):
+    pool = make_pool(maxconn=1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            with pool.connection():
+                pass
+
+    pool.timeout = 2
+    got = []
+    release = threading.Event()
+
+    def holder():
+        with pool.connection():
+            release.wait(2)
+
+    t = threading.Thread(target=holder)
+    t.start()
+    while pool.stats()["in_use"] == 0:
+        time.sleep(0.001)
+
+    def waiter():
+        with pool.connection() as conn:
+            got.append(conn)
+
+    w = threading.Thread(target=waiter)
+    w.start()
+    time.sleep(0.05)
+    assert not got
+    release.set()
+    t.join(2)
+    w.join(2)
+    assert got == [opened[0]] and len(opened) == 1
+
+
+def test_idle_connection_is_pinged_and_replaced_when_dead(opened):
+    pool = make_pool(check_idle=0)
+    with pool.connection() as conn:
+        pass
+    conn.dead = True
+    with pool.connection() as fresh:
+        pass
+    assert fresh is not conn and conn.closed
+    with pool.connection() as same:
+        pass
+    assert same is fresh and "SELECT 1" in fresh.executed
+
+
+def test_old_connection_is_recycled(opened):
+    pool = make_pool(max_lifetime=0)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first.closed and second is not first
+
+
+def test_prewarm_and_close(opened):
+    pool = make_pool(minconn=2, maxconn=4)
+    assert pool.prewarm() == 2
+    assert pool.prewarm() == 0
+    assert pool.stats()["idle"] == 2
+    pool.close()
+    assert all(c.closed for c in opened)
+    with pytest.raises(PoolTimeout):
+        with pool.connection():
+            pass
+
+
+def test_prewarm_stops_on_connect_error(monkeypatch):
+    def connect(dsn, **kwargs):
+        raise psycopg2.OperationalError("could not connect")
+
+    monkeypatch.setattr(db_pool.psycopg2, "connect", connect)
+    pool = make_pool(minconn=2)
+    assert pool.prewarm() == 0
+    assert pool.opening == 0
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection():
+            pass
+    assert pool.opening == 0 and pool.stats()["in_use"] == 0
+
+
+def test_concurrent_borrowers_never_exceed_max(opened):
+    pool = make_pool(maxconn=3, timeout=5)
+    peak = []
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(20):
+                with pool.connection():
+                    peak.append(pool.stats()["in_use"])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert not errors
+    assert max(peak) <= 3 and len(opened) <= 3
+    assert pool.stats()["in_use"] == 0
+
+
+def test_get_pool_is_process_singleton(opened, monkeypatch):
+    monkeypatch.setattr(db_pool, "_pool", None)
+    assert db_pool.get_pool() is db_pool.get_pool()
+    with db_pool.connection() as conn:
+        pass
+    assert conn is opened[0]
@@ -0,0 +1,48 @@
+import os
+
+from data import embed_onnx
+
+
+def _patch(monkeypatch):
+    calls = []
+
+    def export(model_name, out_dir=None, quantize=True):
+        calls.append(("export", quantize))
+        os.makedirs(out_dir, exist_ok=True)
+        open(os.path.join(out_dir, embed_onnx.FP32_FILE), "w").close()
+        if quantize:
+            embed_onnx.quantize_int8(out_dir)
+
+    def quantize_int8(out_dir):
+        calls.append(("quantize",))
+        open(os.path.join(out_dir, embed_onnx.INT8_FILE), "w").close()
+
+    monkeypatch.setattr(embed_onnx, "export", export)
+    monkeypatch.setattr(embed_onnx, "quantize_int8", quantize_int8)
+    return calls
+
+
+def test_exports_when_nothing_exists(tmp_path, monkeypatch):
+    calls = _patch(monkeypatch)
+    path = embed_onnx.ensure_exported("org/model", quantized=True, root=str(tmp_path))
+    assert os.path.exists(path)
+    assert calls == [("export", True), ("quantize",)]
+
+
+def test_quantizes_from_existing_fp32(tmp_path, monkeypatch):
+    calls = _patch(monkeypatch)
+    embed_onnx.ensure_exported("org/model", quantized=False, root=str(tmp_path))
+    calls.clear()
+
+    path = embed_onnx.ensure_exported("org/model", quantized=True, root=str(tmp_path))
+    assert path.endswith(embed_onnx.INT8_FILE)
+    assert calls == [("quantize",)]
+
+
+def test_existing_file_is_reused(tmp_path, monkeypatch):
+    calls = _patch(monkeypatch)
+    embed_onnx.ensure_exported("org/model", quantized=True, root=str(tmp_path))
+    calls.clear()
+    embed_onnx.ensure_exported("org/model", quantized=True, root=str(tmp_path))
+    embed_onnx.ensure_exported("org/model", quantized=False, root=str(tmp_path))
+    assert calls == []
@@ -0,0 +1,151 @@
+import os
+import socket
+import time
+
+import numpy as np
+import pytest
+
+from data.embed_sidecar import SidecarClient, SidecarEncoder, SidecarUnavailable
+
+
+class FakeClient:
+    """Sidecar giả: `error` = SidecarUnavailable raise ở mỗi lượt gọi, None = trả vector."""
+
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.error = None
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+
+    def ping(self):
+        self._call()
+        return self.dim
+
+    def embed(self, texts):
+        self._call()
+        return np.ones((len(texts), self.dim), dtype=np.float32)
+
+
+class FakeLocal:
+    dim = 4
+
+    def encode(self, texts, batch_size=32):
+        return np.zeros((len(texts), self.dim), dtype=np.float32)
+
+
+def make_encoder(client, **kw):
+    loads = []
+
+    def factory():
+        loads.append(1)
+        return FakeLocal()
+
+    kw.setdefault("retry_interval", 10)
+    kw.setdefault("max_backoff", 60)
+    kw.setdefault("fallback_after", 3)
+    return SidecarEncoder(factory, client=client, **kw), loads
+
+
+def test_timeout_opens_breaker_without_loading_local_model():
+    client = FakeClient()
+    client.error = SidecarUnavailable("timeout")
+    encoder, loads = make_encoder(client)
+
+    with pytest.raises(SidecarUnavailable):
+        encoder.encode(["a"])
+    # Trong back-off: raise ngay, không gọi sidecar, không nạp model
+    with pytest.raises(SidecarUnavailable):
+        encoder.encode(["b"])
+    assert client.calls == 1
+    assert loads == []
+
+
+def test_timeout_backoff_grows_and_is_capped():
+    client = FakeClient()
+    client.error = SidecarUnavailable("timeout")
+    encoder, _ = make_encoder(client, retry_interval=10, max_backoff=30)
+
+    delays = []
+    for _ in range(4):
+        encoder.down_until = 0.0
+        with pytest.raises(SidecarUnavailable):
+            encoder.encode(["a"])
+        delays.append(round(encoder.down_until - time.monotonic()))
+    assert delays == [10, 20, 30, 30]
+
+
+def test_falls_back_only_after_repeated_refusals():
+    client = FakeClient()
+    client.error = SidecarUnavailable("refused", refused=True)
+    encoder, loads = make_encoder(client, fallback_after=3)
+
+    for _ in range(2):
+        with pytest.raises(SidecarUnavailable):
+            encoder.encode(["a"])
+    assert loads == []
+    assert encoder.down_until == 0.0
+
+    vectors = encoder.encode(["a"])
+    assert loads == [1]
+    assert not vectors.any()
+    # Đã nạp model: trong khoảng chờ dùng luôn model trong process
+    encoder.encode(["b"])
+    assert client.calls == 3
+
+
+def test_success_resets_counters_and_uses_sidecar():
+    client = FakeClient()
+    client.error = SidecarUnavailable("refused", refused=True)
+    encoder, loads = make_encoder(client, fallback_after=3)
+    for _ in range(2):
+        with pytest.raises(SidecarUnavailable):
+            encoder.encode(["a"])
+
+    client.error = None
+    assert encoder.encode(["a"]).all()
+    assert encoder.refused == 0 and encoder.failures == 0
+
+    client.error = SidecarUnavailable("refused", refused=True)
+    with pytest.raises(SidecarUnavailable):
+        encoder.encode(["a"])
+    assert loads == []
+
+
+def test_dim_follows_breaker():
+    client = FakeClient(dim=8)
+    encoder, loads = make_encoder(client)
+    assert encoder.dim == 8
+
+    client = FakeClient()
+    client.error = SidecarUnavailable("timeout")
+    encoder, loads = make_encoder(client)
+    with pytest.raises(SidecarUnavailable):
+        encoder.dim
+    assert loads == []
+
+
+def test_client_does_not_resend_on_timeout(tmp_path):
+    path = str(tmp_path / "slow.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(4)
+    try:
+        client = SidecarClient(path, timeout=0.2)
+        started = time.monotonic()
+        with pytest.raises(SidecarUnavailable) as info:
+            client.embed(["a"])
+        assert not info.value.refused
+        assert time.monotonic() - started < 0.4
+    finally:
+        server.close()
+
+
+def test_client_missing_socket_is_refused(tmp_path):
+    client = SidecarClient(os.path.join(str(tmp_path), "missing.sock"), timeout=0.2)
+    with pytest.raises(SidecarUnavailable) as info:
+        client.ping()
+    assert info.value.refused
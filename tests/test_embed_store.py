@@ -0,0 +1,110 @@
+import os
+import multiprocessing
+import numpy as np
+import pytest
+
+from data.embed_store import MmapEmbeddingStore, LocalEmbeddingCache
+
+DIM = 8
+
+
+def vec(seed):
+    return np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "embeddings-test-8.f16")
+
+
+def test_put_get_roundtrip_and_normalized_key(path):
+    store = MmapEmbeddingStore(path, DIM, "model-a", capacity=64, probe=4)
+    assert store.get("xin chào") is None
+    store.put("xin  chào ", vec(1))
+    got = store.get("xin chào")
+    assert got.dtype == np.float32
+    assert np.allclose(got, vec(1), atol=1e-2)  # lưu float16
+    assert store.get("xin chao") is None
+    assert store.stats()["used"] == 1
+
+
+def test_put_same_key_twice_keeps_one_slot(path):
+    store = MmapEmbeddingStore(path, DIM, "model-a", capacity=64, probe=4)
+    store.put("a", vec(1))
+    store.put("a", vec(2))
+    assert store.stats()["used"] == 1
+    assert np.allclose(store.get("a"), vec(1), atol=1e-2)
+
+
+def test_persists_across_reopen_and_resets_on_header_mismatch(path):
+    MmapEmbeddingStore(path, DIM, "model-a", capacity=64).put("a", vec(1))
+    assert np.allclose(MmapEmbeddingStore(path, DIM, "model-a", capacity=64).get("a"), vec(1), atol=1e-2)
+    # Model khác → key khác và file được tạo lại
+    assert MmapEmbeddingStore(path, DIM, "model-b", capacity=64).get("a") is None
+    assert MmapEmbeddingStore(path, DIM, "model-a", capacity=64).get("a") is None
+    # Capacity khác cũng tạo lại file
+    MmapEmbeddingStore(path, DIM, "model-a", capacity=64).put("a", vec(1))
+    store = MmapEmbeddingStore(path, DIM, "model-a", capacity=32)
+    assert store.get("a") is None
+    assert os.path.getsize(path) == 64 + store.slots.dtype.itemsize * 32
+
+
+def test_full_window_evicts_least_recently_used(path):
+    store = MmapEmbeddingStore(path, DIM, "model-a", capacity=4, probe=4)
+    texts = [f"t{i}" for i in range(4)]
+    for i, t in enumerate(texts):
+        store.put(t, vec(i))
+    # Tick (phút truy cập) giả: t2 lâu nhất không dùng
+    for i, t in enumerate(texts):
+        k0, _ = store.key(t)
+        idx = next(j for j in store._window(k0) if int(store.k0[j]) == k0)
+        store.tick[idx] = 0 if t == "t2" else 100
+    store.put("mới", vec(9))
+    assert store.get("t2") is None
+    assert np.allclose(store.get("mới"), vec(9), atol=1e-2)
+    assert all(store.get(t) is not None for t in ("t0", "t1", "t3"))
+
+
+def test_slot_being_written_is_not_read_and_is_recoverable(path):
+    store = MmapEmbeddingStore(path, DIM, "model-a", capacity=64, probe=4)
+    store.put("a", vec(1))
+    k0, _ = store.key("a")
+    idx = next(j for j in store._window(k0) if int(store.k0[j]) == k0)
+    store.seq[idx] = int(store.seq[idx]) | 1   # process ghi chết giữa chừng
+    assert store.get("a") is None
+    # Slot dở dang vẫn giữ key cũ nên put cùng key là no-op; key khác trong cửa sổ ghi đè được
+    store.k0[idx] = 0
+    store.put("a", vec(2))
+    assert np.allclose(store.get("a"), vec(2), atol=1e-2)
+    assert int(store.seq[idx]) % 2 == 0
+
+
+def _writer(path, start):
+    store = MmapEmbeddingStore(path, DIM, "model-a", capacity=4096, probe=8)
+    for i in range(start, start + 200):
+        store.put(f"text {i}", vec(i))
+
+
+def test_concurrent_processes_share_the_file(path):
+    MmapEmbeddingStore(path, DIM, "model-a", capacity=4096, probe=8)
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_writer, args=(path, n * 200)) for n in range(3)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(30)
+        assert p.exitcode == 0
+    store = MmapEmbeddingStore(path, DIM, "model-a", capacity=4096, probe=8)
+    found = [store.get(f"text {i}") for i in range(600)]
+    assert sum(v is not None for v in found) == 600
+    assert all(np.allclose(v, vec(i), atol=1e-2) for i, v in enumerate(found))
+
+
+def test_local_cache_fallback():
+    cache = LocalEmbeddingCache(maxsize=2)
+    cache.put("a  b", vec(1))
+    assert cache.get("a b") is vec(1) or np.allclose(cache.get("a b"), vec(1))
+    cache.put("c", vec(2))
+    cache.put("d", vec(3))
+    assert cache.get("a b") is None
+    assert cache.stats() == {"capacity": 2, "used": 2}
@@ -0,0 +1,71 @@
+import time
+
+from data.invalidation import HiddenSessions
+
+
+class FakeRedis:
+    """Đủ hset / expire / hgetall / pipeline cho HiddenSessions; `down` = Redis không truy cập được."""
+
+    def __init__(self):
+        self.hashes = {}
+        self.ttls = {}
+        self.down = False
+        self.calls = 0
+
+    def _check(self):
+        self.calls += 1
+        if self.down:
+            raise ConnectionError("redis down")
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hgetall(self, key):
+        self._check()
+        return dict(self.hashes.get(key, {}))
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.ops = []
+
+    def hset(self, key, field, value):
+        self.ops.append(lambda: self.redis.hashes.setdefault(key, {}).__setitem__(field, value))
+
+    def expire(self, key, ttl):
+        self.ops.append(lambda: self.redis.ttls.__setitem__(key, ttl))
+
+    def execute(self):
+        self.redis._check()
+        for op in self.ops:
+            op()
+
+
+def test_publish_then_every_worker_sees_the_stamp():
+    redis = FakeRedis()
+    publisher = HiddenSessions(redis, ttl=660)
+    other_worker = HiddenSessions(redis)
+    assert other_worker.stamps("u") == {}
+
+    before = time.time()
+    assert publisher.publish("u", "s1")
+    stamps = other_worker.stamps("u")
+    assert list(stamps) == ["s1"] and stamps["s1"] >= before
+    assert redis.ttls["hidden:u"] == 660
+    assert other_worker.stamps("v") == {}
+
+
+def test_redis_errors_back_off():
+    redis = FakeRedis()
+    hidden = HiddenSessions(redis, retry_after=30)
+    redis.down = True
+    assert hidden.stamps("u") == {}
+    calls = redis.calls
+    # Trong thời gian chờ không gọi Redis (không cộng thêm timeout vào mỗi request)
+    assert hidden.stamps("u") == {}
+    assert redis.calls == calls
+    # publish vẫn thử ngay: /v1/hidden hiếm, không được bỏ lỡ khi Redis vừa hồi phục
+    redis.down = False
+    assert hidden.publish("u", "s")
+    assert hidden.stats() == {"published": 1, "redis_errors": 1}
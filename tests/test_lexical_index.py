@@ -0,0 +1,154 @@
+import time
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from data.lexical_index import LexicalIndex, rrf_fuse
+
+MESSAGES = [
+    ("s1", "Mình tên là Nguyễn Văn Tuấn"),
+    ("s1", "hôm nay trời đẹp"),
+    ("s1", "phòng 302 ở tầng 3"),
+    ("s2", "Tuấn là bạn của tôi"),
+    ("s1", "tôi thích ăn phở"),
+]
+
+
+def vectorizer(**kw):
+    kw = {"token_pattern": r"(?u)\b\w+\b", "ngram_range": (1, 2), "sublinear_tf": True, **kw}
+    return TfidfVectorizer(**kw).fit([m for _, m in MESSAGES])
+
+
+class Loader:
+    def __init__(self, rows, during=None):
+        self.rows = rows
+        self.calls = 0
+        self.during = during
+
+    def __call__(self, user_id, limit):
+        self.calls += 1
+        if self.during:
+            self.during(user_id)
+        return list(self.rows)[:limit]
+
+
+def user_rows():
+    rows = [{"id": i, "session_id": s, "message": m, "reply": f"r{i}", "created_at": i}
+            for i, (s, m) in enumerate(MESSAGES)]
+    return rows[::-1]  # mới → cũ như SQL_USER_MESSAGES
+
+
+@pytest.fixture
+def index():
+    return LexicalIndex(Loader(user_rows()), vectorizer())
+
+
+# ---------------- rrf_fuse ----------------
+def test_rrf_rewards_rows_found_by_both_lists():
+    dense = [{"message": "a", "reply": ""}, {"message": "b", "reply": ""}, {"message": "c", "reply": ""}]
+    lexical = [{"message": "c", "reply": ""}, {"message": "d", "reply": ""}]
+    fused = rrf_fuse([dense, lexical], top_k=4, k=60)
+    assert [r["message"] for r in fused] == ["c", "a", "b", "d"]
+    assert fused[0]["score"] == pytest.approx((1 / 63 + 1 / 61) / (2 / 61))
+
+
+def test_rrf_top_score_is_one_when_first_everywhere_and_keeps_first_copy():
+    dense = [{"message": "a", "reply": "x", "distance": 0.1}]
+    lexical = [{"message": "a", "reply": "x", "lexical_score": 0.9}]
+    (row,) = rrf_fuse([dense, lexical], top_k=3)
+    assert row["score"] == pytest.approx(1.0)
+    assert row["distance"] == 0.1 and "lexical_score" not in row
+
+
+def test_rrf_ties_keep_input_order_and_handle_empty():
+    fused = rrf_fuse([[{"message": "a"}], [{"message": "b"}]], top_k=2)
+    assert [r["message"] for r in fused] == ["a", "b"]
+    assert rrf_fuse([[], []], top_k=3) == []
+    assert rrf_fuse([[{"message": "a"}]], top_k=0) == []
+
+
+# ---------------- LexicalIndex ----------------
+@pytest.mark.parametrize("kw", [{}, {"binary": True}, {"use_idf": False}, {"norm": "l1"}, {"sublinear_tf": False}])
+def test_query_vector_matches_sklearn_transform(kw):
+    vec = vectorizer(**kw)
+    index = LexicalIndex(None, vec)
+    query = "Tuấn Tuấn phòng 302 tầng"
+    expected = vec.transform([query]).toarray().ravel()
+    assert np.allclose(index._query_vector(query), expected, atol=1e-6)
+    assert index._query_vector("xyzzy") is None
+
+
+def test_search_finds_rare_terms_within_session(index):
+    assert [r["message"] for r in index.search("u", "s1", "phòng 302", 3)] == ["phòng 302 ở tầng 3"]
+    assert [r["message"] for r in index.search("u", "s1", "Tuấn", 3)] == ["Mình tên là Nguyễn Văn Tuấn"]
+    assert [r["message"] for r in index.search("u", "s2", "Tuấn", 3)] == ["Tuấn là bạn của tôi"]
+    assert len(index.search("u", None, "Tuấn", 3)) == 2
+    assert index.search("u", "s1", "không có từ nào khớp xyzzy", 3) == []
+    assert index.search("u", "s9", "Tuấn", 3) == []
+    assert index.loader.calls == 1
+
+
+def test_disabled_without_vectorizer():
+    index = LexicalIndex(Loader(user_rows()))
+    assert not index.enabled
+    assert index.search("u", "s1", "Tuấn") is None
+    index.append("u", "s1", "Tuấn", "x")
+    assert index.loader.calls == 0
+
+
+def test_append_and_empty_user():
+    index = LexicalIndex(Loader([]), vectorizer())
+    assert index.search("u", "s", "Tuấn") == []
+    index.append("u", "s", "Tuấn đi học", "ok")
+    index.append("u", "s", "Tuấn đi học", "ok")  # trùng lượt cuối → bỏ qua
+    hits = index.search("u", "s", "Tuấn")
+    assert [(h["message"], h["id"]) for h in hits] == [("Tuấn đi học", None)]
+
+
+def test_append_to_other_user_during_load_keeps_cache():
+    index = LexicalIndex(None, vectorizer(), shards=1)
+    index.loader = Loader(user_rows(), during=lambda u: index.append("other", "s", "x", "y"))
+    index.search("u", "s1", "Tuấn")
+    index.search("u", "s1", "Tuấn")
+    assert index.loader.calls == 1
+
+
+@pytest.mark.parametrize("race", ["append", "invalidate"])
+def test_same_user_write_during_load_is_not_cached(race):
+    index = LexicalIndex(None, vectorizer(), shards=1)
+
+    def during(user_id):
+        if index.loader.calls == 1:
+            index.append("u", "s1", "x", "y") if race == "append" else index.invalidate("u")
+
+    index.loader = Loader(user_rows(), during=during)
+    index.search("u", "s1", "Tuấn")
+    index.search("u", "s1", "Tuấn")
+    assert index.loader.calls == 2
+    assert index.shards[0].loading == {}
+
+
+def test_oversized_user_is_skipped():
+    index = LexicalIndex(Loader(user_rows()), vectorizer(), max_rows=3)
+    assert index.search("u", "s1", "Tuấn") is None
+    assert index.search("u", "s1", "Tuấn") is None
+    assert index.loader.calls == 1
+
+
+def test_expire_hidden_drops_user_loaded_before_the_stamp(index):
+    index.search("u", "s1", "Tuấn", 3)
+    assert index.expire_hidden("u", {}) == 0
+    assert index.expire_hidden("u", {"s2": time.time() - 60}) == 0
+    assert index.expire_hidden("v", {"s1": time.time()}) == 0
+    # Worker khác ẩn một session của user sau khi worker này nạp: bỏ cả ma trận của user
+    assert index.expire_hidden("u", {"s2": time.time() - 60, "s1": time.time()}) == 1
+    index.search("u", "s1", "Tuấn", 3)
+    assert index.loader.calls == 2
+    assert index.stats()["hidden"] == 1
+
+
+def test_hide_during_load_is_not_missed():
+    stamps = {}
+    index = LexicalIndex(Loader(user_rows(), during=lambda u: stamps.setdefault("s1", time.time())), vectorizer())
+    index.search("u", "s1", "Tuấn", 3)
+    assert index.expire_hidden("u", stamps) == 1
@@ -0,0 +1,70 @@
+import re
+
+from utils.prompt_template import CompiledTemplate, RenderCache, compile_template
+
+
+def legacy_inject(system_prompt, values):
+    # inject_personality trước khi compile template: replace lần lượt rồi xóa %key% còn sót
+    for k, v in values.items():
+        system_prompt = system_prompt.replace(k, v or "")
+    return re.sub(r"%\w+%", "", system_prompt)
+
+
+def test_render_personality_tokens():
+    tpl = CompiledTemplate("Bạn là %name%, tính cách %trait%.")
+    assert tpl.render({"%name%": "Mây", "%trait%": "hướng nội"}) == "Bạn là Mây, tính cách hướng nội."
+
+
+def test_missing_or_empty_personality_token_is_dropped():
+    tpl = CompiledTemplate("A%x%B%y%C")
+    assert tpl.render({"%x%": ""}) == "ABC"
+    assert tpl.render({"%x%": None}) == "ABC"
+
+
+def test_content_token_kept_unless_provided():
+    tpl = CompiledTemplate("Câu hỏi: {{content}} (%tone%)")
+    assert tpl.render({}) == "Câu hỏi: {{content}} ()"
+    assert tpl.render({"{{content}}": "chào", "%tone%": "vui"}) == "Câu hỏi: chào (vui)"
+
+
+def test_values_are_not_rescanned_for_tokens():
+    tpl = CompiledTemplate("{{content}}")
+    assert tpl.render({"{{content}}": "giảm 50%off%"}) == "giảm 50%off%"
+
+
+def test_edge_templates():
+    assert CompiledTemplate("").render({}) == ""
+    assert CompiledTemplate(None).render({}) == ""
+    assert CompiledTemplate("không có token").render({"%a%": "x"}) == "không có token"
+    assert CompiledTemplate("%a%%b%").render({"%a%": "1", "%b%": "2"}) == "12"
+    assert CompiledTemplate("100% chắc, 50 % thôi").render({}) == "100% chắc, 50 % thôi"
+
+
+def test_matches_legacy_inject_personality():
+    prompt = "Tên: %name%\nMBTI: %code%\nGiọng: %tone%\nKhông rõ: %unknown%\n%name% chào bạn."
+    values = {"%name%": "Mây", "%code%": "INFP", "%tone%": None}
+    assert CompiledTemplate(prompt).render(values) == legacy_inject(prompt, values)
+
+
+def test_compile_template_is_cached_by_text():
+    a = compile_template("xin chào %name%")
+    assert compile_template("xin chào %name%") is a
+    assert compile_template("tạm biệt %name%") is not a
+
+
+def test_render_cache_renders_once_per_key():
+    cache = RenderCache(maxsize=2)
+    calls = []
+
+    def render(v):
+        calls.append(v)
+        return v
+
+    assert cache.get_or_render(("v1", "INFP"), lambda: render("a")) == "a"
+    assert cache.get_or_render(("v1", "INFP"), lambda: render("b")) == "a"
+    cache.get_or_render(("v1", "ENTP"), lambda: render("c"))
+    cache.get_or_render(("v1", "ISTJ"), lambda: render("d"))
+    assert cache.get_or_render(("v1", "INFP"), lambda: render("e")) == "e"  # bị LRU loại
+    cache.clear()
+    assert cache.get_or_render(("v1", "ISTJ"), lambda: render("f")) == "f"
+    assert calls == ["a", "c", "d", "e", "f"]
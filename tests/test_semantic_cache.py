@@ -0,0 +1,76 @@
+import zlib
+import numpy as np
+import pytest
+
+from data.semantic_cache import SemanticCache, exact_key
+
+
+def stub_embed(text, dim=16, aliases=None):
+    """Vector giả cố định theo text; aliases gom các câu "cùng nghĩa" về một vector."""
+    text = (aliases or {}).get(text, text)
+    rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+    return rng.standard_normal(dim).astype(np.float32)
+
+
+@pytest.fixture
+def cache():
+    aliases = {"bạn tên gì thế": "bạn tên gì"}
+    return SemanticCache(lambda t: stub_embed(t, aliases=aliases), threshold=0.95, ttl=600, max_hits=5)
+
+
+def test_exact_key_keeps_diacritics():
+    assert exact_key("  Xin   Chào Đức ") == "xin chào đức"
+    assert exact_key("mua áo") != exact_key("múa áo")
+    # NFD và NFC cùng một key
+    assert exact_key("múa áo") == exact_key("múa áo")
+
+
+def test_exact_hit_ignores_case_and_whitespace(cache):
+    cache.add("u", "s", "Bạn là ai", "Mình là bot")
+    assert cache.lookup("u", "s", "  bạn   LÀ ai ") == ("Mình là bot", 1.0)
+    assert cache.stats()["exact_hits"] == 1
+
+
+@pytest.mark.parametrize("cached, asked", [("mua áo", "múa áo"), ("bạn là ai", "bán là ai")])
+def test_accent_variants_do_not_share_answers(cache, cached, asked):
+    cache.add("u", "s", cached, "answer")
+    assert cache.lookup("u", "s", asked) == (None, None)
+    assert cache.stats()["misses"] == 1
+
+
+def test_semantic_hit_goes_through_embedding(cache):
+    cache.add("u", "s", "bạn tên gì", "Mình là bot")
+    answer, similarity = cache.lookup("u", "s", "bạn tên gì thế")
+    assert answer == "Mình là bot"
+    assert similarity == pytest.approx(1.0, abs=1e-5)
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_max_hits_and_ttl(monkeypatch):
+    cache = SemanticCache(stub_embed, ttl=10, max_hits=1)
+    now = [1000.0]
+    monkeypatch.setattr("data.semantic_cache.time.time", lambda: now[0])
+    cache.add("u", "s", "xin chào", "chào bạn")
+    assert cache.lookup("u", "s", "xin chào")[0] == "chào bạn"
+    assert cache.lookup("u", "s", "xin chào")[0] is None  # đã dùng hết max_hits
+    cache.add("u", "s", "tạm biệt", "bye")
+    now[0] += 11
+    assert cache.lookup("u", "s", "tạm biệt")[0] is None
+
+
+def test_ring_overwrite_keeps_newer_mapping_for_same_key():
+    cache = SemanticCache(stub_embed, per_session=2, max_hits=10)
+    cache.add("u", "s", "câu a", "a1")     # slot 0
+    cache.add("u", "s", "câu a", "a2")     # slot 1, key trỏ sang slot 1
+    cache.add("u", "s", "câu b", "b")      # ghi đè slot 0 (key "câu a" cũ)
+    assert cache.lookup("u", "s", "câu a") == ("a2", 1.0)
+    assert cache.lookup("u", "s", "câu b") == ("b", 1.0)
+    assert cache.stats()["exact_hits"] == 2
+
+
+def test_sessions_are_isolated_and_invalidated(cache):
+    cache.add("u", "s1", "xin chào", "hi")
+    assert cache.lookup("u", "s2", "xin chào") == (None, None)
+    cache.invalidate("u", "s1")
+    assert cache.lookup("u", "s1", "xin chào") == (None, None)
+    assert cache.stats()["sessions"] == 0
@@ -0,0 +1,180 @@
+import time
+import threading
+import numpy as np
+import pytest
+
+from data.session_vectors import SessionVectorIndex
+
+
+def make_rows(n, dim=8, seed=0):
+    """Dòng như SQL_SESSION_VECTORS (mới → cũ)."""
+    rng = np.random.default_rng(seed)
+    vecs = rng.standard_normal((n, dim)).astype(np.float32)
+    rows = [{"id": i, "message": f"m{i}", "reply": f"r{i}", "created_at": i, "vec": vecs[i].tolist()}
+            for i in range(n)]
+    return rows[::-1], vecs
+
+
+class Loader:
+    def __init__(self, sessions, during=None):
+        self.sessions = sessions
+        self.calls = []
+        self.during = during
+
+    def __call__(self, user_id, session_id, limit):
+        self.calls.append(session_id)
+        if self.during:
+            self.during(session_id)
+        return list(self.sessions.get(session_id, []))[:limit]
+
+
+def test_search_matches_brute_force_cosine():
+    rows, vecs = make_rows(50)
+    index = SessionVectorIndex(Loader({"s": rows}))
+    q = np.random.default_rng(1).standard_normal(8)
+    hits = index.search("u", "s", q, top_k=5)
+
+    normed = vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+    expected = np.argsort(-(normed @ (q / np.linalg.norm(q))))[:5]
+    assert [h["id"] for h in hits] == expected.tolist()
+    assert hits[0]["distance"] <= hits[-1]["distance"]
+    assert set(hits[0]) == {"id", "message", "reply", "distance", "created_at"}
+
+
+def test_loads_once_and_serves_from_memory():
+    rows, _ = make_rows(10)
+    loader = Loader({"s": rows})
+    index = SessionVectorIndex(loader)
+    for _ in range(3):
+        index.search("u", "s", np.ones(8), 3)
+    assert loader.calls == ["s"]
+    assert index.stats()["hits"] == 2
+
+
+def test_concurrent_misses_share_one_load():
+    rows, _ = make_rows(10)
+    gate = threading.Event()
+    loader = Loader({"s": rows}, during=lambda s: gate.wait(1))
+    index = SessionVectorIndex(loader)
+    threads = [threading.Thread(target=index.search, args=("u", "s", np.ones(8), 3)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    gate.set()
+    for t in threads:
+        t.join()
+    assert loader.calls == ["s"]
+
+
+def test_append_adds_turn_and_is_searchable():
+    rows, _ = make_rows(5)
+    index = SessionVectorIndex(Loader({"s": rows}))
+    index.search("u", "s", np.ones(8), 1)
+    target = np.full(8, 3.0)
+    index.append("u", "s", "mới", "trả lời", target)
+    hit = index.search("u", "s", target, 1)[0]
+    assert (hit["message"], hit["id"]) == ("mới", None)
+    assert hit["distance"] == pytest.approx(0.0, abs=1e-6)
+
+
+def test_append_to_other_session_during_load_keeps_cache():
+    rows, _ = make_rows(5)
+    index = SessionVectorIndex(None, shards=1)
+    loader = Loader({"a": rows, "b": rows}, during=lambda s: index.append("u", "b", "x", "y", np.ones(8)))
+    index.loader = loader
+    index.search("u", "a", np.ones(8), 1)
+    index.search("u", "a", np.ones(8), 1)
+    assert loader.calls == ["a"]
+
+
+@pytest.mark.parametrize("race", ["append", "invalidate"])
+def test_same_session_write_during_load_is_not_cached(race):
+    rows, _ = make_rows(5)
+    index = SessionVectorIndex(None, shards=1)
+
+    def during(session_id):
+        if len(loader.calls) == 1:
+            if race == "append":
+                index.append("u", "a", "x", "y", np.ones(8))
+            else:
+                index.invalidate("u", "a")
+
+    loader = Loader({"a": rows}, during=during)
+    index.loader = loader
+    assert len(index.search("u", "a", np.ones(8), 10)) == 5
+    index.search("u", "a", np.ones(8), 1)
+    assert loader.calls == ["a", "a"]
+    assert index.shards[0].loading == {}
+
+
+def test_failed_load_does_not_leak_loading_state():
+    index = SessionVectorIndex(lambda u, s, n: 1 / 0, shards=1)
+    with pytest.raises(ZeroDivisionError):
+        index.search("u", "a", np.ones(8), 1)
+    assert index.shards[0].loading == {}
+
+
+def test_oversized_session_falls_back_and_is_remembered():
+    rows, _ = make_rows(6)
+    loader = Loader({"s": rows})
+    index = SessionVectorIndex(loader, max_rows=5)
+    assert index.search("u", "s", np.ones(8), 3) is None
+    assert index.search("u", "s", np.ones(8), 3) is None
+    assert loader.calls == ["s"]
+
+
+def test_empty_session_then_first_append():
+    index = SessionVectorIndex(Loader({}))
+    assert index.search("u", "s", np.ones(8), 3) == []
+    index.append("u", "s", "đầu tiên", "ok", np.ones(8))
+    assert [h["message"] for h in index.search("u", "s", np.ones(8), 3)] == ["đầu tiên"]
+
+
+def test_ttl_expiry_reloads(monkeypatch):
+    rows, _ = make_rows(3)
+    loader = Loader({"s": rows})
+    index = SessionVectorIndex(loader, ttl=10)
+    now = [1000.0]
+    monkeypatch.setattr("data.session_vectors.time.time", lambda: now[0])
+    index.search("u", "s", np.ones(8), 1)
+    now[0] += 11
+    index.search("u", "s", np.ones(8), 1)
+    assert loader.calls == ["s", "s"]
+
+
+def test_lru_eviction_by_session_count():
+    rows, _ = make_rows(3)
+    loader = Loader({"a": rows, "b": rows, "c": rows})
+    index = SessionVectorIndex(loader, max_sessions=2, shards=1)
+    for s in ("a", "b", "c"):
+        index.search("u", s, np.ones(8), 1)
+    assert index.stats()["sessions"] == 2
+    index.search("u", "a", np.ones(8), 1)
+    assert loader.calls == ["a", "b", "c", "a"]
+
+
+def test_expire_hidden_drops_sessions_loaded_before_the_stamp():
+    rows, _ = make_rows(5)
+    loader = Loader({"s": rows, "t": rows})
+    index = SessionVectorIndex(loader)
+    index.search("u", "s", np.ones(8), 3)
+    index.search("u", "t", np.ones(8), 3)
+    before = time.time() - 60
+
+    # Mốc cũ hơn lần nạp: giữ nguyên
+    assert index.expire_hidden("u", {"s": before}) == 0
+    # Worker khác ẩn "s" sau khi worker này nạp: bỏ, lần sau nạp lại từ DB
+    assert index.expire_hidden("u", {"s": time.time()}) == 1
+    index.search("u", "s", np.ones(8), 3)
+    index.search("u", "t", np.ones(8), 3)
+    assert loader.calls == ["s", "t", "s"]
+    assert index.stats()["hidden"] == 1
+
+
+def test_hide_during_load_is_not_missed():
+    rows, _ = make_rows(5)
+    stamps = {}
+    # Session bị ẩn (ở worker khác) khi DB đang được đọc: mốc nạp là lúc bắt đầu đọc
+    loader = Loader({"s": rows}, during=lambda s: stamps.setdefault(s, time.time()))
+    index = SessionVectorIndex(loader)
+    index.search("u", "s", np.ones(8), 3)
+    assert index.expire_hidden("u", stamps) == 1
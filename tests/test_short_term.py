@@ -0,0 +1,136 @@
+import threading
+import pytest
+
+from data.short_term import ShortTermStore
+
+
+class Loader:
+    """loader giả: session → list lượt cũ → mới; `during` chạy trong lúc "đọc DB"."""
+
+    def __init__(self, sessions=None, during=None):
+        self.sessions = sessions or {}
+        self.calls = []
+        self.during = during
+
+    def __call__(self, user_id, session_id, n):
+        self.calls.append(session_id)
+        if self.during:
+            self.during(session_id)
+        return list(self.sessions.get(session_id, []))[-n:]
+
+
+def turns(*pairs):
+    return [{"message": m, "reply": r} for m, r in pairs]
+
+
+def test_miss_loads_once_then_hits():
+    loader = Loader({"s": turns(("a", "1"), ("b", "2"), ("c", "3"))})
+    store = ShortTermStore(loader)
+    assert store.get("u", "s", limit=2) == turns(("b", "2"), ("c", "3"))
+    assert store.get("u", "s", limit=5) == turns(("a", "1"), ("b", "2"), ("c", "3"))
+    assert store.get("u", "s", limit=0) == []
+    assert loader.calls == ["s"]
+    assert store.stats()["hits"] == 2
+
+
+def test_concurrent_misses_share_one_load():
+    gate = threading.Event()
+    loader = Loader({"s": turns(("a", "1"))}, during=lambda s: gate.wait(1))
+    store = ShortTermStore(loader)
+    threads = [threading.Thread(target=store.get, args=("u", "s")) for _ in range(8)]
+    for t in threads:
+        t.start()
+    gate.set()
+    for t in threads:
+        t.join()
+    assert loader.calls == ["s"]
+
+
+def test_append_to_loaded_session_and_ring_capacity():
+    store = ShortTermStore(Loader({"s": turns(("a", "1"))}), capacity=2)
+    store.get("u", "s")
+    store.append("u", "s", "b", "2")
+    store.append("u", "s", "c", "3")
+    assert store.get("u", "s", limit=10) == turns(("b", "2"), ("c", "3"))
+
+
+def test_append_to_unloaded_session_skips_turn_already_persisted():
+    # Write-behind đã ghi lượt này xuống DB trước khi store nạp session
+    loader = Loader({"s": turns(("a", "1"), ("b", "2"))})
+    store = ShortTermStore(loader)
+    store.append("u", "s", "b", "2")
+    assert store.get("u", "s", limit=10) == turns(("a", "1"), ("b", "2"))
+    store.append("u", "s2", "x", "y")
+    assert store.get("u", "s2") == turns(("x", "y"))
+
+
+def test_ttl_expiry_reloads(monkeypatch):
+    loader = Loader({"s": turns(("a", "1"))})
+    store = ShortTermStore(loader, ttl=10)
+    now = [1000.0]
+    monkeypatch.setattr("data.short_term.time.time", lambda: now[0])
+    store.get("u", "s")
+    now[0] += 5
+    store.get("u", "s")
+    now[0] += 6
+    store.get("u", "s")
+    assert loader.calls == ["s", "s"]
+
+
+def test_lru_eviction_by_session_count():
+    loader = Loader()
+    store = ShortTermStore(loader, max_sessions=2, shards=1)
+    for s in ("a", "b"):
+        store.get("u", s)
+    store.get("u", "a")          # a mới dùng → b là LRU
+    store.get("u", "c")
+    assert store.stats()["sessions"] == 2
+    store.get("u", "a")
+    store.get("u", "b")
+    assert loader.calls == ["a", "b", "c", "b"]
+    assert store.stats()["evictions"] >= 1
+
+
+def test_eviction_by_bytes_keeps_at_least_one_session():
+    loader = Loader({s: turns(("x" * 1000, "y" * 1000)) for s in "abc"})
+    store = ShortTermStore(loader, max_bytes=1, shards=1)
+    for s in "abc":
+        assert store.get("u", s) == turns(("x" * 1000, "y" * 1000))
+    stats = store.stats()
+    assert stats["sessions"] == 1
+    assert stats["bytes"] > 0
+
+
+def test_invalidate_drops_session():
+    loader = Loader({"s": turns(("a", "1"))})
+    store = ShortTermStore(loader)
+    store.get("u", "s")
+    store.invalidate("u", "s")
+    assert store.stats()["sessions"] == 0
+    store.get("u", "s")
+    assert loader.calls == ["s", "s"]
+
+
+def test_invalidate_racing_a_load_is_not_cached():
+    store = ShortTermStore(None, shards=1)
+
+    def during(session_id):
+        if len(loader.calls) == 1:
+            store.invalidate("u", "s")
+
+    loader = Loader({"s": turns(("a", "1"))}, during=during)
+    store.loader = loader
+    # Lần đọc đang chạy vẫn trả kết quả nhưng không được cache
+    assert store.get("u", "s") == turns(("a", "1"))
+    assert store.stats()["sessions"] == 0
+    store.get("u", "s")
+    store.get("u", "s")
+    assert loader.calls == ["s", "s"]
+
+
+def test_users_and_global_session_are_separate():
+    loader = Loader({None: turns(("g", "1"))})
+    store = ShortTermStore(loader)
+    store.append("u1", None, "x", "y")
+    assert store.get("u1", None, limit=5) == turns(("g", "1"), ("x", "y"))
+    assert store.get("u2", None, limit=5) == turns(("g", "1"))
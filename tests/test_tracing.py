@@ -0,0 +1,53 @@
+import json
+import os
+
+import pytest
+
+from utils import tracing
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "traces.jsonl")
+    monkeypatch.setattr(tracing, "TRACE_FILE", path)
+    monkeypatch.setattr(tracing, "TRACE_ENABLED", True)
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 1.0)
+    return path
+
+
+def export_one(name):
+    root = tracing.start_trace(name)
+    with tracing.use_span(root):
+        with tracing.span("child"):
+            pass
+    root.end()
+    tracing.flush()
+
+
+def test_spans_are_exported_as_otlp_json(trace_file):
+    export_one("POST /v1/chat")
+    with open(trace_file, encoding="utf-8") as f:
+        spans = [s for line in f for s in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+    assert [s["name"] for s in spans] == ["child", "POST /v1/chat"]
+    assert spans[0]["parentSpanId"] == spans[1]["spanId"]
+
+
+def test_unsampled_request_keeps_request_id(trace_file, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 0.0)
+    root = tracing.start_trace("GET /", "req-1")
+    assert root.request_id == "req-1"
+    root.end()
+    tracing.flush()
+    assert not os.path.exists(trace_file)
+
+
+def test_trace_file_is_rotated_and_capped(trace_file, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_MAX_BYTES", 200)
+    monkeypatch.setattr(tracing, "TRACE_BACKUP_COUNT", 2)
+    for i in range(20):
+        export_one(f"req {i}")
+    files = sorted(os.listdir(os.path.dirname(trace_file)))
+    assert files == ["traces.jsonl", "traces.jsonl.1", "traces.jsonl.2"]
+    # Mỗi lần ghi một batch (~1KB) rồi xoay: mỗi file chỉ còn batch gần nhất
+    with open(trace_file, encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
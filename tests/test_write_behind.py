@@ -0,0 +1,213 @@
+import os
+import json
+import glob
+import time
+import psycopg2
+import pytest
+
+from data.write_behind import WriteBehindQueue
+
+
+class FakeDB:
+    """insert_batch_fn giả: ghi nhận các dòng; `fail` = mất kết nối, message trong `poison` = vi phạm constraint."""
+
+    def __init__(self):
+        self.rows = []
+        self.fail = False
+        self.poison = set()
+
+    def insert(self, rows):
+        if self.fail:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if any(r[2] in self.poison for r in rows):
+            raise psycopg2.IntegrityError("duplicate key value violates unique constraint")
+        self.rows.extend(rows)
+
+    @property
+    def messages(self):
+        return [r[2] for r in self.rows]
+
+
+def embed_batch(texts):
+    return [[float(len(t)), 1.0] for t in texts]
+
+
+@pytest.fixture
+def db():
+    return FakeDB()
+
+
+@pytest.fixture
+def writer(tmp_path, db):
+    return WriteBehindQueue(embed_batch, db.insert, batch_size=2, max_wait_ms=10,
+                            spool_dir=str(tmp_path), replay_interval=3600, max_replays=3)
+
+
+def spool_files(tmp_path, pattern="turns-*.jsonl"):
+    return sorted(glob.glob(os.path.join(str(tmp_path), pattern)))
+
+
+def write_spool(tmp_path, name, lines):
+    path = os.path.join(str(tmp_path), name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(lines))
+    return path
+
+
+def turn_line(message, **extra):
+    return json.dumps({"user_id": "u", "session_id": "s", "message": message, "reply": "r",
+                       "time": None, "created_at": "2024-01-01T00:00:00+00:00", **extra}) + "\n"
+
+
+def test_flush_reuses_vector_and_embeds_the_rest(writer, db):
+    writer._flush([
+        {**json.loads(turn_line("có vector")), "vector": [9.0, 9.0]},
+        json.loads(turn_line("abc")),
+    ])
+    assert [r[4] for r in db.rows] == [[9.0, 9.0], [3.0, 1.0]]
+
+
+def test_failed_batch_is_spooled_then_replayed(writer, db, tmp_path):
+    db.fail = True
+    writer._flush([json.loads(turn_line("a")), json.loads(turn_line("b"))])
+    assert len(spool_files(tmp_path)) == 1
+    assert writer.stats()["spooled"] == 2
+
+    db.fail = False
+    writer._replay_spool()
+    assert db.messages == ["a", "b"]
+    assert spool_files(tmp_path) == []
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_partial_replay_keeps_only_unwritten_turns(writer, db, tmp_path):
+    path = write_spool(tmp_path, "turns-1-1.jsonl", [turn_line(m) for m in ("a", "b", "poison", "c")])
+    db.poison = {"poison"}
+    writer._replay_spool()
+    assert db.messages == ["a", "b"]
+    with open(path, encoding="utf-8") as f:
+        left = [json.loads(line) for line in f]
+    assert [t["message"] for t in left] == ["poison", "c"]
+    assert all(t["replay_attempts"] == 1 for t in left)
+
+
+def test_corrupt_spool_file_is_quarantined_and_does_not_block(writer, db, tmp_path):
+    bad = write_spool(tmp_path, "turns-1-1.jsonl", [turn_line("a"), '{"user_id": "u", "mess'])
+    write_spool(tmp_path, "turns-1-2.jsonl", [turn_line("b")])
+    writer._replay_spool()
+    assert db.messages == ["b"]
+    assert os.path.exists(bad + ".bad")
+    assert spool_files(tmp_path) == []
+    assert writer.stats()["quarantined"] == 1
+
+
+def test_poison_file_is_quarantined_after_max_replays(writer, db, tmp_path):
+    poison = write_spool(tmp_path, "turns-1-1.jsonl", [turn_line("poison")])
+    write_spool(tmp_path, "turns-1-2.jsonl", [turn_line("ok")])
+    db.poison = {"poison"}
+    writer._replay_spool()
+    # File lỗi không chặn file sau
+    assert db.messages == ["ok"]
+    writer._replay_spool()
+    writer._replay_spool()
+    assert spool_files(tmp_path) == []
+    with open(poison + ".bad", encoding="utf-8") as f:
+        assert [json.loads(line)["message"] for line in f] == ["poison"]
+    assert glob.glob(os.path.join(str(tmp_path), "*.replaying-*")) == []
+
+
+def test_db_outage_never_quarantines(writer, db, tmp_path):
+    first = write_spool(tmp_path, "turns-1-1.jsonl", [turn_line(m) for m in ("a", "b", "c")])
+    second = write_spool(tmp_path, "turns-1-2.jsonl", [turn_line("d")])
+    db.fail = True
+    for _ in range(writer.max_replays * 3):
+        writer._replay_spool()
+    # File giữ nguyên (không tăng replay_attempts), không file nào sang .bad
+    assert spool_files(tmp_path) == [first, second]
+    assert spool_files(tmp_path, "*.bad") == []
+    with open(first, encoding="utf-8") as f:
+        assert all("replay_attempts" not in json.loads(line) for line in f)
+    assert writer.stats()["quarantined"] == 0
+
+    db.fail = False
+    writer._replay_spool()
+    assert db.messages == ["a", "b", "c", "d"]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_db_outage_stops_the_replay_pass(writer, db, tmp_path):
+    write_spool(tmp_path, "turns-1-1.jsonl", [turn_line("a")])
+    write_spool(tmp_path, "turns-1-2.jsonl", [turn_line("b")])
+    calls = []
+
+    def insert(rows):
+        calls.append(rows)
+        raise psycopg2.pool.PoolError("connection pool exhausted")
+
+    writer.insert_batch_fn = insert
+    writer._replay_spool()
+    assert len(calls) == 1
+    assert len(spool_files(tmp_path)) == 2
+
+
+def test_outage_mid_file_keeps_only_unwritten_turns(writer, db, tmp_path):
+    path = write_spool(tmp_path, "turns-1-1.jsonl", [turn_line(m) for m in ("a", "b", "c")])
+    writes = []
+
+    def insert(rows):
+        if writes:
+            raise psycopg2.OperationalError("connection lost")
+        writes.append(rows)
+        db.rows.extend(rows)
+
+    writer.insert_batch_fn = insert
+    writer._replay_spool()
+    assert db.messages == ["a", "b"]
+    with open(path, encoding="utf-8") as f:
+        left = [json.loads(line) for line in f]
+    assert [t["message"] for t in left] == ["c"]
+    assert all(t.get("replay_attempts", 0) == 0 for t in left)
+
+
+def test_failed_rewrite_keeps_claimed_file(writer, db, tmp_path, monkeypatch):
+    write_spool(tmp_path, "turns-1-1.jsonl", [turn_line("a")])
+    db.poison = {"a"}
+
+    def broken(path, turns):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(writer, "_write_spool_file", broken)
+    writer._replay_spool()
+    assert len(glob.glob(os.path.join(str(tmp_path), "*.replaying-*"))) == 1
+
+    # Lần sau claim mồ côi được trả lại spool và ghi được
+    monkeypatch.undo()
+    db.poison = set()
+    writer._replay_spool()
+    assert db.messages == ["a"]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_thread_survives_unexpected_errors_and_stop_flushes(writer, db, tmp_path, monkeypatch):
+    write_spool(tmp_path, "turns-1-1.jsonl", ['{"broken'])
+    calls = []
+    original = writer._next_batch
+
+    def flaky():
+        if not calls:
+            calls.append(1)
+            raise RuntimeError("boom")
+        return original()
+
+    monkeypatch.setattr(writer, "_next_batch", flaky)
+    writer.start()
+    assert writer.submit("u", "xin chào", "chào", session_id="s")
+    deadline = time.time() + 5
+    while not db.rows and time.time() < deadline:
+        time.sleep(0.01)
+    writer.stop()
+    assert db.messages == ["xin chào"]
+    assert not writer.thread.is_alive()
+    # Sau stop, submit đi thẳng ra spool
+    assert writer.submit("u", "muộn") is False
+    assert len(spool_files(tmp_path)) == 1
@@ -0,0 +1,153 @@
+"""
+Outbound HTTP client dùng chung cho mọi upstream API
+(prompt.whoisme.ai, api.whoisme.ai, Gemini, OpenAI/DeepSeek/Grok qua ChatOpenAI).
+
+- Một httpx.Client (sync) và một httpx.AsyncClient (async) cho cả process,
+  giữ connection keep-alive theo từng host thay vì handshake TCP+TLS mỗi lần gọi
+- HTTP/2 bật bằng HTTP2_ENABLED=1 (cần package `h2`, thiếu thì tự quay về HTTP/1.1)
+- prewarm(hosts) mở sẵn kết nối tới các host khi worker khởi động (mặc định API_HOSTS)
+- get_metrics() trả về số request, lỗi và latency (tới lúc nhận header) theo host
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import importlib.util
+import httpx
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# API của chính WhoIsMe, request nào cũng gọi; host của LLM provider lấy theo model config
+# đang dùng (model.upstream_hosts), không prewarm provider mà config không trỏ tới
+API_HOSTS = [
+    "prompt.whoisme.ai",
+    "api.whoisme.ai",
+]
+
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0") == "1"
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+_metrics = {}
+
+# ---------------- METRICS ----------------
+def record(host: str, elapsed: float, error: bool = False):
+    metrics.UPSTREAM_SECONDS.labels(host, str(error).lower()).observe(elapsed)
+    with _lock:
+        m = _metrics.get(host)
+        if m is None:
+            m = _metrics[host] = {"requests": 0, "errors": 0, "latency_sum": 0.0, "latency_max": 0.0}
+        m["requests"] += 1
+        m["errors"] += int(error)
+        m["latency_sum"] += elapsed
+        m["latency_max"] = max(m["latency_max"], elapsed)
+
+def get_metrics() -> dict:
+    with _lock:
+        return {
+            host: {**m, "latency_avg": round(m["latency_sum"] / m["requests"], 4) if m["requests"] else 0.0}
+            for host, m in _metrics.items()
+        }
+
+class _MeteredTransport(httpx.HTTPTransport):
+    def handle_request(self, request):
+        start = time.perf_counter()
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            record(request.url.host, time.perf_counter() - start, error=True)
+            raise
+        record(request.url.host, time.perf_counter() - start, error=response.status_code >= 500)
+        return response
+
+class _AsyncMeteredTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request):
+        start = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            record(request.url.host, time.perf_counter() - start, error=True)
+            raise
+        record(request.url.host, time.perf_counter() - start, error=response.status_code >= 500)
+        return response
+
+# ---------------- CLIENTS ----------------
+def _http2():
+    if HTTP2_ENABLED and importlib.util.find_spec("h2") is None:
+        logger.warning("[http_client] HTTP2_ENABLED=1 nhưng chưa cài `h2`, dùng HTTP/1.1")
+        return False
+    return HTTP2_ENABLED
+
+def _limits():
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+def get_client() -> httpx.Client:
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = httpx.Client(
+                    transport=_MeteredTransport(http2=_http2(), limits=_limits(), retries=1),
+                    timeout=httpx.Timeout(10, connect=5),
+                    follow_redirects=True,
+                )
+    return _client
+
+def get_async_client() -> httpx.AsyncClient:
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        with _lock:
+            if _async_client is None or _async_client.is_closed:
+                _async_client = httpx.AsyncClient(
+                    transport=_AsyncMeteredTransport(http2=_http2(), limits=_limits(), retries=1),
+                    timeout=httpx.Timeout(10, connect=5),
+                    follow_redirects=True,
+                )
+    return _async_client
+
+def get(url, **kwargs) -> httpx.Response:
+    return get_client().get(url, **kwargs)
+
+def post(url, **kwargs) -> httpx.Response:
+    return get_client().post(url, **kwargs)
+
+# ---------------- WARMUP ----------------
+def prewarm(hosts=None, timeout=3):
+    """Mở sẵn kết nối TLS tới các upstream host (lỗi được bỏ qua)."""
+    def _warm(host):
+        try:
+            get_client().head(f"https://{host}/", timeout=timeout)
+        except Exception as e:
+            logger.info(f"[http_client] prewarm {host} thất bại: {e}")
+
+    threads = [threading.Thread(target=_warm, args=(h,), daemon=True) for h in (hosts or API_HOSTS)]
+    for t in threads:
+        t.start()
+    return threads
+
+async def aprewarm(hosts=None, timeout=3):
+    client = get_async_client()
+
+    async def _warm(host):
+        try:
+            await client.head(f"https://{host}/", timeout=timeout)
+        except Exception as e:
+            logger.info(f"[http_client] prewarm {host} thất bại: {e}")
+
+    await asyncio.gather(*(_warm(h) for h in (hosts or API_HOSTS)))
+
+async def aclose():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
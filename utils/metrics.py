@@ -0,0 +1,158 @@
+"""
+Metrics dạng Prometheus cho /metrics, gộp qua mọi gunicorn worker.
+
+Khi có biến môi trường PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py tự đặt), mỗi
+worker ghi metrics ra file mmap riêng trong thư mục đó và /metrics gộp lại lúc
+scrape. Không có biến này (chạy `python ai_bot.py`) thì dùng registry trong process.
+
+Tỉ lệ cache hit tính bằng PromQL, ví dụ:
+    sum(rate(chatbot_cache_requests_total{result="hit"}[5m])) by (cache)
+      / sum(rate(chatbot_cache_requests_total[5m])) by (cache)
+"""
+import os
+import time
+import logging
+import threading
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY,
+    CONTENT_TYPE_LATEST, generate_latest, multiprocess,
+)
+
+logger = logging.getLogger(__name__)
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+QUEUE_SAMPLE_INTERVAL = float(os.getenv("METRICS_QUEUE_SAMPLE_INTERVAL", "5"))
+
+# Bucket cho request chat (có LLM, tới vài chục giây) và cho các bước nội bộ (ms)
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+TPS_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+REQUEST_SECONDS = Histogram(
+    "chatbot_request_duration_seconds", "Thời gian xử lý request theo endpoint",
+    ["endpoint", "method", "status"], buckets=REQUEST_BUCKETS,
+)
+LLM_TTFT_SECONDS = Histogram(
+    "chatbot_llm_time_to_first_token_seconds", "Thời gian tới token đầu tiên theo model",
+    ["model"], buckets=REQUEST_BUCKETS,
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "chatbot_llm_tokens_per_second", "Tốc độ sinh token (chunk) sau token đầu tiên theo model",
+    ["model"], buckets=TPS_BUCKETS,
+)
+LLM_TOKENS = Counter("chatbot_llm_tokens_total", "Số token (chunk) model đã stream", ["model"])
+LLM_ERRORS = Counter("chatbot_llm_errors_total", "Số lần gọi model lỗi", ["model"])
+CACHE_REQUESTS = Counter(
+    "chatbot_cache_requests_total", "Lượt tra cache theo loại cache và kết quả",
+    ["cache", "result"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "chatbot_db_query_duration_seconds", "Thời gian truy vấn PostgreSQL",
+    ["query"], buckets=STAGE_BUCKETS,
+)
+EMBEDDING_SECONDS = Histogram(
+    "chatbot_embedding_duration_seconds", "Thời gian encode embedding (không tính cache hit)",
+    ["source"], buckets=STAGE_BUCKETS,
+)
+EMBEDDING_REUSED = Counter(
+    "chatbot_embedding_reused_total", "Lượt bỏ qua encode nhờ dùng lại vector đã tính trong cùng request",
+    ["source"],
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "chatbot_embedding_batch_size", "Số câu (không trùng) mỗi lần encode của EmbedDispatcher",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+EMBED_SIDECAR_REQUESTS = Counter(
+    "chatbot_embedding_sidecar_requests_total", "Lượt encode khi bật sidecar: qua sidecar (ok), model trong process (fallback) hay lỗi (unavailable)",
+    ["result"],
+)
+EXECUTOR_QUEUE_DEPTH = Gauge(
+    "chatbot_executor_queue_depth", "Số task đang chờ trong hàng đợi của executor",
+    ["executor"], multiprocess_mode="livesum",
+)
+PERSIST_TURNS = Counter(
+    "chatbot_persist_turns_total", "Lượt hội thoại qua write-behind theo kết quả",
+    ["result"],
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "chatbot_db_pool_connections", "Số kết nối trong pool PostgreSQL theo trạng thái",
+    ["state"], multiprocess_mode="livesum",
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "chatbot_db_pool_wait_seconds", "Thời gian chờ mượn kết nối từ pool PostgreSQL",
+    buckets=STAGE_BUCKETS,
+)
+DB_POOL_EVENTS = Counter(
+    "chatbot_db_pool_events_total", "Sự kiện của pool PostgreSQL (created, closed, recycled, broken, timeout)",
+    ["event"],
+)
+LOCK_WAIT_SECONDS = Histogram(
+    "chatbot_lock_wait_seconds", "Thời gian chờ lock / chờ lần nạp dữ liệu đang chạy (single-flight)",
+    ["lock"], buckets=(0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+UPSTREAM_SECONDS = Histogram(
+    "chatbot_upstream_request_duration_seconds", "Latency tới lúc nhận header của HTTP upstream",
+    ["host", "error"], buckets=STAGE_BUCKETS,
+)
+
+# ---------------- HELPERS ----------------
+def model_label(llm) -> str:
+    """
+    Tên model lấy từ chính client (ModelWrapper.name / GeminiAPIWrapper.model_name), không phải key
+    của model.models. Chỉ là fallback khi caller không có key (load_model trả về key).
+    """
+    return getattr(llm, "name", None) or getattr(llm, "model_name", None) or type(llm).__name__
+
+def observe_request(endpoint, method, status, seconds):
+    REQUEST_SECONDS.labels(endpoint, method, str(status)).observe(seconds)
+
+def observe_llm(model, ttft, total, tokens, error=False):
+    """ttft / total tính bằng giây từ lúc gọi model; tokens/sec đo trên đoạn sau token đầu."""
+    if error:
+        LLM_ERRORS.labels(model).inc()
+    if ttft is not None:
+        LLM_TTFT_SECONDS.labels(model).observe(ttft)
+    if tokens:
+        LLM_TOKENS.labels(model).inc(tokens)
+    if ttft is not None and tokens > 1 and total > ttft:
+        LLM_TOKENS_PER_SECOND.labels(model).observe((tokens - 1) / (total - ttft))
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+# ---------------- EXECUTOR QUEUE ----------------
+_queues = {}
+_sampler = None
+_sampler_lock = threading.Lock()
+
+def _sample_loop():
+    while True:
+        for name, qsize in list(_queues.items()):
+            try:
+                EXECUTOR_QUEUE_DEPTH.labels(name).set(qsize())
+            except Exception as e:
+                logger.debug(f"[metrics] không đọc được queue của {name}: {e}")
+        time.sleep(QUEUE_SAMPLE_INTERVAL)
+
+def watch_executor(name, executor):
+    """Định kỳ ghi độ sâu hàng đợi của một ThreadPoolExecutor vào chatbot_executor_queue_depth."""
+    watch_queue(name, executor._work_queue.qsize)
+
+def watch_queue(name, qsize):
+    """Như watch_executor nhưng cho hàng đợi bất kỳ, qsize là hàm trả về số phần tử đang chờ."""
+    global _sampler
+    _queues[name] = qsize
+    with _sampler_lock:
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = threading.Thread(target=_sample_loop, daemon=True, name="metrics-sampler")
+            _sampler.start()
+
+# ---------------- EXPOSITION ----------------
+def render():
+    """Trả về (body, content_type) cho endpoint /metrics."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
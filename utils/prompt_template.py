@@ -0,0 +1,71 @@
+"""
+Compile template prompt một lần, render nhanh mỗi request.
+
+Placeholder hỗ trợ:
+- %key%        : giá trị personality, thiếu giá trị thì bị xóa (giống inject_personality cũ)
+- {{content}}  : tin nhắn người dùng, thiếu giá trị thì giữ nguyên token
+"""
+import re
+import threading
+from cachetools import LRUCache
+
+_TOKEN_RE = re.compile(r"%\w+%|\{\{\w+\}\}")
+
+
+class CompiledTemplate:
+    __slots__ = ("literals", "tokens")
+
+    def __init__(self, text: str):
+        self.literals = []
+        self.tokens = []
+        pos = 0
+        for m in _TOKEN_RE.finditer(text or ""):
+            self.literals.append(text[pos:m.start()])
+            self.tokens.append(m.group(0))
+            pos = m.end()
+        self.literals.append((text or "")[pos:])
+
+    def render(self, values: dict) -> str:
+        out = [self.literals[0]]
+        for token, literal in zip(self.tokens, self.literals[1:]):
+            value = values.get(token)
+            if value is None and token.startswith("{{"):
+                value = token
+            out.append(value or "")
+            out.append(literal)
+        return "".join(out)
+
+
+_compiled = LRUCache(maxsize=64)
+_compiled_lock = threading.Lock()
+
+def compile_template(text: str) -> CompiledTemplate:
+    """Template được cache theo nội dung, nên mỗi phiên bản prompt chỉ parse một lần."""
+    with _compiled_lock:
+        tpl = _compiled.get(text)
+    if tpl is None:
+        tpl = CompiledTemplate(text)
+        with _compiled_lock:
+            _compiled[text] = tpl
+    return tpl
+
+
+class RenderCache:
+    """LRU các system prompt đã render đầy đủ, key do caller quyết định (vd. phiên bản prompt + archetype)."""
+
+    def __init__(self, maxsize=1024):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def get_or_render(self, key, render_fn):
+        with self.lock:
+            value = self.cache.get(key)
+        if value is None:
+            value = render_fn()
+            with self.lock:
+                self.cache[key] = value
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
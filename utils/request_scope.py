@@ -0,0 +1,33 @@
+"""
+Dữ liệu dùng chung trong một request (vd. vector embedding của câu hỏi tính lúc truy xuất
+long-term được dùng lại khi ghi lượt hội thoại).
+
+    request_scope.begin()              # traced_route (Flask) / traced (ASGI)
+    request_scope.put(("embedding", text), vec)
+    request_scope.get(("embedding", text))
+
+Scope là một dict gắn vào contextvars: thread / executor chạy qua tracing.wrap_context hay
+run_db (copy context) thấy cùng dict đó. begin() không reset khi view return vì response
+stream của Flask chạy sau đó trên cùng thread; request kế tiếp gọi begin() lại.
+Ngoài request (script, thread nền) put() là no-op, get() trả về default.
+"""
+import contextvars
+
+_current = contextvars.ContextVar("request_scope", default=None)
+
+
+def begin():
+    scope = {}
+    _current.set(scope)
+    return scope
+
+def put(key, value):
+    scope = _current.get()
+    if scope is not None:
+        scope[key] = value
+
+def get(key, default=None):
+    scope = _current.get()
+    if scope is None:
+        return default
+    return scope.get(key, default)
@@ -0,0 +1,291 @@
+"""
+Tracing theo request: span lồng nhau gắn với request id.
+
+Span được export ra file JSON Lines theo định dạng OTLP/JSON (mỗi dòng là một
+ExportTraceServiceRequest), đọc được bằng receiver `otlpjsonfile` của
+OpenTelemetry Collector hoặc jq.
+
+    root = tracing.start_trace("POST /v1/chatbot", request_id)
+    with tracing.use_span(root):
+        with tracing.span("cache.lookup"):
+            ...
+    root.end()
+
+Không có trace đang chạy thì span() là no-op, nên code trong data/ dùng được
+cả khi gọi từ script.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.getenv("PROJECT_ROOT", "."), "logs", "traces.jsonl"))
+# Mặc định chỉ sample 1% request; debug một request cụ thể thì tăng lên 1.0
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+# Quá TRACE_MAX_BYTES thì xoay file: traces.jsonl → .1 → ... → .TRACE_BACKUP_COUNT (file cũ nhất bị xóa)
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "3"))
+TRACE_MIN_MS = float(os.getenv("TRACE_MIN_MS", "0"))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "chatbot_whoisme")
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    def __init__(self, request_id):
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.spans = []
+        self.exported = False
+        self.lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    @property
+    def request_id(self):
+        return self.trace.request_id
+
+    @property
+    def duration_ms(self):
+        end = self.end_ns or time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, e):
+        self.error = f"{type(e).__name__}: {e}"
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        _on_span_end(self)
+
+
+class _NoopSpan:
+    """Span rỗng khi tracing tắt / không được sample / không có trace cha."""
+    __slots__ = ("request_id",)
+    duration_ms = 0.0
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, e):
+        pass
+
+    def end(self):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+# ---------------- API ----------------
+def new_request_id():
+    return uuid.uuid4().hex
+
+def start_trace(name, request_id=None, **attributes):
+    """Tạo root span (chưa kích hoạt). Luôn có request_id, kể cả khi không sample."""
+    request_id = request_id or new_request_id()
+    if not TRACE_ENABLED or random.random() >= TRACE_SAMPLE_RATE:
+        return _NoopSpan(request_id)
+    return Span(Trace(request_id), name, attributes=attributes)
+
+def current_span():
+    return _current.get()
+
+def start_span(name, parent=None, **attributes):
+    """Span con của `parent` (mặc định: span hiện tại). Caller tự gọi .end()."""
+    parent = parent or _current.get()
+    if not isinstance(parent, Span):
+        return _NOOP
+    return Span(parent.trace, name, parent_id=parent.span_id, attributes=attributes)
+
+@contextmanager
+def use_span(s):
+    token = _current.set(s)
+    try:
+        yield s
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def span(name, **attributes):
+    s = start_span(name, **attributes)
+    if s is _NOOP:
+        yield s
+        return
+    token = _current.set(s)
+    try:
+        yield s
+    except Exception as e:
+        s.record_error(e)
+        raise
+    finally:
+        _current.reset(token)
+        s.end()
+
+def wrap_context(fn):
+    """Chạy fn trong bản sao context hiện tại (để span đi theo sang thread/executor)."""
+    ctx = contextvars.copy_context()
+
+    def _run(*args, **kwargs):
+        return ctx.run(fn, *args, **kwargs)
+    return _run
+
+# ---------------- EXPORT ----------------
+_queue = queue.Queue(maxsize=10000)
+_writer = None
+_writer_lock = threading.Lock()
+
+def _on_span_end(s):
+    trace = s.trace
+    with trace.lock:
+        if trace.exported:
+            # Span kết thúc sau root (vd. ghi DB trên executor) → export riêng
+            _enqueue([s])
+            return
+        trace.spans.append(s)
+        if s.parent_id is not None:
+            return
+        trace.exported = True
+        spans, trace.spans = trace.spans, []
+    if s.duration_ms >= TRACE_MIN_MS:
+        _enqueue(spans)
+
+def _enqueue(spans):
+    _ensure_writer()
+    for s in spans:
+        try:
+            _queue.put_nowait(s)
+        except queue.Full:
+            return
+
+def _otlp_value(v):
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+def _to_otlp(s):
+    attrs = {"request.id": s.trace.request_id, **s.attributes}
+    return {
+        "traceId": s.trace.trace_id,
+        "spanId": s.span_id,
+        "parentSpanId": s.parent_id or "",
+        "name": s.name,
+        "kind": 1,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attrs.items() if v is not None],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+
+def _write_batch(spans):
+    line = json.dumps({
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+                {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+            ]},
+            "scopeSpans": [{"scope": {"name": "chatbot.tracing"}, "spans": [_to_otlp(s) for s in spans]}],
+        }]
+    }, ensure_ascii=False)
+    try:
+        os.makedirs(os.path.dirname(TRACE_FILE) or ".", exist_ok=True)
+        with _open_trace_file() as f:
+            f.write(line + "\n")
+    except Exception as e:
+        logger.error(f"[tracing] Không ghi được {TRACE_FILE}: {e}")
+
+def _rotate():
+    if TRACE_BACKUP_COUNT <= 0:
+        os.remove(TRACE_FILE)
+        return
+    for i in range(TRACE_BACKUP_COUNT - 1, 0, -1):
+        if os.path.exists(f"{TRACE_FILE}.{i}"):
+            os.replace(f"{TRACE_FILE}.{i}", f"{TRACE_FILE}.{i + 1}")
+    os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+
+def _open_trace_file():
+    """Mở TRACE_FILE để append, giữ flock tới khi đóng; xoay file khi quá TRACE_MAX_BYTES.
+
+    Nhiều worker cùng ghi một file: flock tuần tự hóa việc ghi / xoay, file vừa bị worker khác
+    xoay (inode khác đường dẫn hiện tại) thì mở lại.
+    """
+    while True:
+        f = open(TRACE_FILE, "a", encoding="utf-8")
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            current = os.stat(TRACE_FILE)
+        except FileNotFoundError:
+            current = None
+        if current is None or not os.path.samestat(current, os.fstat(f.fileno())):
+            f.close()
+            continue
+        if TRACE_MAX_BYTES and current.st_size >= TRACE_MAX_BYTES:
+            _rotate()
+            f.close()
+            continue
+        return f
+
+def _drain(max_batch=512):
+    spans = []
+    while len(spans) < max_batch:
+        try:
+            spans.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    if spans:
+        _write_batch(spans)
+    return len(spans)
+
+def _writer_loop(interval=1.0):
+    while True:
+        time.sleep(interval)
+        while _drain():
+            pass
+
+def _ensure_writer():
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_writer_loop, daemon=True, name="trace-writer")
+            _writer.start()
+
+def flush():
+    while _drain():
+        pass
+
+atexit.register(flush)